@@ -1,63 +1,149 @@
 import argparse
+import atexit
 import csv
-import re
+import json
+import os
 
 from urllib.parse import quote
-import httplib2
-from bs4 import BeautifulSoup
 
+from crawlcache import ParametricsCache
+from crawlengine import CrawlEngine, CrawlError
+from digikeypage import extract_parametrics, parametrics_from_rows
 from labelannotator import *
 
-URL_PREFIX = 'http://search.digikey.com/scripts/DkSearch/dksus.dll?Detail?name='
-h = httplib2.Http('.cache')
-PARAMETRICS_BLACKLIST = ['Quantity Available']
-HEADER_CONTINUE = ['Categories']
-
-def parse_digikey_table(soup_table):
-  elements = {}
-  last_header = None
-  for row in soup_table.findChildren('tr'):
-    header = row.find('th')
-    value = row.find('td')
-
-    if value is None:
-      continue
-
-    if header is None and last_header in HEADER_CONTINUE:
-      header = last_header
-    elif header is not None:
-      header = header.get_text().strip()
-      last_header = header
-
-    if header not in PARAMETRICS_BLACKLIST:
-      elements[header] = value.get_text().strip()
-
-  return elements
-
-def DigikeyCrawl(row_dict):
-  if 'digikey_pn' not in row_dict or not row_dict['digikey_pn']:
-    return {}
-
-  url = URL_PREFIX + quote(row_dict['digikey_pn'])
-
-  print("Fetch digikey_pn='%s' from %s" % (row_dict['digikey_pn'], url))
-  _, content = h.request(url, headers={'user-agent': '=)'})
-  content = content.decode('utf-8')
-
-  # The part attributes table has a hanging </a> tag. Fail...
-  content = re.sub(r'</a>', '', content)
-  content = re.sub(r'<a[^>]*>', '', content)
-  content = content.replace('&nbsp;', '')
-  content = content.replace('\n', '')
-  content = content.replace('\t', '')
-
-  soup = BeautifulSoup(content, 'html.parser')
-
+# The crawl backend, target and limits can be overridden from the environment, for example to point
+# the crawler at a local stub server (see benchmarks/stubserver.py).
+# DIGIKEY_BACKEND selects how part details are fetched: 'html' scrapes the product page of each
+# part from DIGIKEY_URL_PREFIX, and 'json' requests the details of DIGIKEY_BATCH_SIZE parts at a
+# time from the DIGIKEY_BATCH_URL endpoint (see JsonBatchBackend).
+BACKEND = os.environ.get('DIGIKEY_BACKEND', 'html')
+URL_PREFIX = os.environ.get('DIGIKEY_URL_PREFIX',
+                            'http://search.digikey.com/scripts/DkSearch/dksus.dll?Detail?name=')
+BATCH_URL = os.environ.get('DIGIKEY_BATCH_URL')
+BATCH_SIZE = int(os.environ.get('DIGIKEY_BATCH_SIZE', '50'))
+CRAWL_CONNECTIONS = int(os.environ.get('DIGIKEY_CRAWL_CONNECTIONS', '4'))
+CRAWL_REQUESTS_PER_SECOND = float(os.environ.get('DIGIKEY_CRAWL_RPS', '4'))
+engine = CrawlEngine(max_in_flight=CRAWL_CONNECTIONS, requests_per_second=CRAWL_REQUESTS_PER_SECOND,
+                     headers={'user-agent': '=)'})
+
+# Parsed parametrics are cached by digikey_pn, in one file shared by all the datasets in a build.
+# PARSER_VERSION must be incremented whenever a change to the page parsing changes its results, so
+# entries extracted by the old parser are fetched again.
+PARSER_VERSION = 1
+CRAWL_CACHE = os.environ.get('DIGIKEY_CRAWL_CACHE', '.crawlcache.sqlite')
+CRAWL_CACHE_TTL_DAYS = float(os.environ.get('DIGIKEY_CRAWL_CACHE_TTL_DAYS', '30'))
+CRAWL_CACHE_MB = float(os.environ.get('DIGIKEY_CRAWL_CACHE_MB', '64'))
+# Workers of a sharded run (see shards.py) look parts up in the build's cache read only, through
+# DIGIKEY_CRAWL_SHARED_CACHE, and write the parts they fetch to their own DIGIKEY_CRAWL_CACHE.
+CRAWL_SHARED_CACHE = os.environ.get('DIGIKEY_CRAWL_SHARED_CACHE')
+shared_crawl_cache = None
+if CRAWL_SHARED_CACHE:
+  shared_crawl_cache = ParametricsCache(CRAWL_SHARED_CACHE, PARSER_VERSION, ttl_days=CRAWL_CACHE_TTL_DAYS,
+                                        read_only=True)
+  atexit.register(shared_crawl_cache.close)
+crawl_cache = ParametricsCache(CRAWL_CACHE, PARSER_VERSION, ttl_days=CRAWL_CACHE_TTL_DAYS,
+                               max_bytes=int(CRAWL_CACHE_MB * 1024 * 1024), base=shared_crawl_cache)
+atexit.register(crawl_cache.close)  # writes out the recency of cache hits
+
+# Distributor backends fetch the parametrics of parts, as dicts like extract_parametrics returns.
+# fetch_many(digikey_pns) takes a list of up to batch_size part numbers and returns a dict of
+# digikey_pn -> parametrics, raising CrawlError if any part cannot be fetched.
+
+# Scrapes the product page of each part, one request per part.
+class HtmlPageBackend:
+  batch_size = 1
+
+  def __init__(self, url_prefix):
+    self.url_prefix = url_prefix
+
+  def fetch_many(self, digikey_pns):
+    parametrics = {}
+    for digikey_pn in digikey_pns:
+      url = self.url_prefix + quote(digikey_pn)
+      print("Fetch digikey_pn='%s' from %s" % (digikey_pn, url))
+      parametrics[digikey_pn] = extract_parametrics(engine.fetch(url).decode('utf-8'))
+    return parametrics
+
+# Returns the parametrics dict of a product from a JSON product details response. Parameters are
+# mapped like the rows of a product page, so a parameter with a list of values (like the Categories
+# breadcrumb) takes the last one.
+def parametrics_from_json(product):
+  rows = []
+  for parameter in product['parameters']:
+    values = parameter['value'] if isinstance(parameter['value'], list) else [parameter['value']]
+    rows.extend((parameter['parameter'], value) for value in values)
+  return parametrics_from_rows(rows)
+
+# Requests the details of a batch of parts in one request, from a JSON product details endpoint
+# queried as url?parts=PN1,PN2,... (with each part number URL-quoted), which answers
+#   {"products": [{"digikeyPartNumber": PN, "parameters": [{"parameter": NAME, "value": VALUE}, ...]}, ...]}
+# with the parameters in product page order. Parts the endpoint does not know are left out.
+class JsonBatchBackend:
+  def __init__(self, url, batch_size):
+    self.url = url
+    self.batch_size = batch_size
+
+  def fetch_many(self, digikey_pns):
+    url = '%s%sparts=%s' % (self.url, '&' if '?' in self.url else '?',
+                            ','.join(quote(digikey_pn, safe='') for digikey_pn in digikey_pns))
+    print("Fetch %i parts from %s" % (len(digikey_pns), self.url))
+    response = json.loads(engine.fetch(url).decode('utf-8'))
+    parametrics = {product['digikeyPartNumber']: parametrics_from_json(product) for product in response['products']}
+    missing = [digikey_pn for digikey_pn in digikey_pns if digikey_pn not in parametrics]
+    if missing:
+      raise CrawlError("no product details for %s from %s" % (', '.join(missing), self.url))
+    return {digikey_pn: parametrics[digikey_pn] for digikey_pn in digikey_pns}
+
+def make_backend(name):
+  if name == 'html':
+    return HtmlPageBackend(URL_PREFIX)
+  elif name == 'json':
+    assert BATCH_URL, "DIGIKEY_BATCH_URL must be set for the json backend"
+    return JsonBatchBackend(BATCH_URL, BATCH_SIZE)
+  else:
+    raise ValueError("unknown DIGIKEY_BACKEND '%s', expected 'html' or 'json'" % name)
+
+backend = make_backend(BACKEND)
+
+# Fetches the parametrics of a batch of parts from the backend into the crawl cache.
+def fetch_batch(digikey_pns):
+  parametrics = backend.fetch_many(digikey_pns)
+  for digikey_pn, part_parametrics in parametrics.items():
+    crawl_cache.put(digikey_pn, part_parametrics)
+  return parametrics
+
+# Returns a dict of digikey_pn -> parametrics dict for a list of distinct part numbers, from the
+# crawl cache where possible. The other parts are fetched in batches of the backend's batch_size,
+# up to CRAWL_CONNECTIONS batches at once.
+def batch_parametrics(digikey_pns):
   parametrics = {}
-  parametrics.update(parse_digikey_table(soup.find('table', id='product-overview')))
-  parametrics.update(parse_digikey_table(soup.find('table', id='product-attribute-table')))
-
-  return {'parametrics': str(parametrics)}
-
-load().map_append(DigikeyCrawl) \
-    .write()
+  missing = []
+  for digikey_pn in digikey_pns:
+    part_parametrics = crawl_cache.get(digikey_pn)
+    if part_parametrics is None:
+      missing.append(digikey_pn)
+    else:
+      parametrics[digikey_pn] = part_parametrics
+
+  batches = [(missing[start:start + backend.batch_size],) for start in range(0, len(missing), backend.batch_size)]
+  for fetched in map_calls(fetch_batch, batches, workers=CRAWL_CONNECTIONS, chunk_size=1, describe_kind='batch'):
+    parametrics.update(fetched)
+  return parametrics
+
+# Fetches the parametrics of the parts of all the rows together (see batch_parametrics).
+def DigikeyCrawlBatch(row_dicts):
+  digikey_pns = list(OrderedDict.fromkeys(row_dict.get('digikey_pn') for row_dict in row_dicts
+                                          if row_dict.get('digikey_pn')))
+  parametrics = batch_parametrics(digikey_pns)
+  return [{'parametrics': format_parametrics(parametrics[row_dict['digikey_pn']])} if row_dict.get('digikey_pn')
+          else {} for row_dict in row_dicts]
+DigikeyCrawlBatch.reads = ('digikey_pn',)
+DigikeyCrawlBatch.writes = ('parametrics',)
+
+# Parts are fetched concurrently, up to the engine's connection and rate limits, in batches if the
+# backend supports them.
+def annotate(rows):
+  return rows.map_append_batch(DigikeyCrawlBatch)
+
+if __name__ == '__main__':
+  annotate(load()).write()
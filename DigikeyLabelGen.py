@@ -1,7 +1,7 @@
 import argparse
-import ast
 import csv
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import functools
 import re
 
 from labelannotator import *
@@ -13,8 +13,11 @@ def RemapParametric(out_name, field_name):
     parametrics_str = row_dict['parametrics']
     if not parametrics_str:
       return {}
-    paramterics = ast.literal_eval(parametrics_str)
+    paramterics = parse_parametrics(parametrics_str)
     return {out_name: paramterics[field_name]}
+  annotate_fn.reads = ('parametrics',)
+  annotate_fn.writes = (out_name,)
+  annotate_fn.row_cache = False
   return annotate_fn
 
 ParametricPreprocess = namedtuple('ParametricPreprocess', ['name', 'fn'])
@@ -393,60 +396,121 @@ def list_regex_map(matches, separator=', ', default=True):
   return fn
 
 
-package_priority_map = {
+# Package name patterns, in priority order: the first pattern matching any of the listed packages
+# wins, so more specific patterns go before the general ones.
+package_priority_map = [
   ('(D\u00B2?Pak)', '%s'),
   ('(TO-220).*', '%s'),
   ('(TO-92).*', '%s'),
-  ('(TO-\d+).*', '%s'),
+  ('SOT-753', 'SOT-23'),
   ('(SOT-23).*', '%s'),
   ('(SOT-\d+).*', '%s'),
+  ('(TO-\d+).*', '%s'),
   ('(SOD-\d+).*', '%s'),
   ('(DO-\d+)', '%s'),
   ('(\d+-TSSOP)', '%s'),
-  ('SOT-753', 'SOT-23'),
   ('(Radial)', '%s'),
-}
+]
 
 paren_removal_regex = re.compile("\s*\([^\(^\)]+\)\s*")
 
+# Parametric values repeat a lot across parts, so the clean-up results are cached.
+QUICKDESC_VALUE_CACHE_SIZE = 65536
+
+# Global pre-process of a parametric value.
+@functools.lru_cache(maxsize=QUICKDESC_VALUE_CACHE_SIZE)
+def clean_parametric(value):
+  # Eliminate supplemental information in parentheses
+  if '(' in value:
+    value = paren_removal_regex.sub('', value)
+  if value == '-':
+    value = '?'
+  return value
+
+# Global package preference selection
+select_package = functools.lru_cache(maxsize=QUICKDESC_VALUE_CACHE_SIZE)(list_regex_map(package_priority_map))
+
+# Mapping which records the keys looked up in it, to find the parametrics a format string uses.
+class KeyRecorder(dict):
+  def __missing__(self, key):
+    self.setdefault(key, '')
+    return ''
+
+def format_keys(format_string):
+  recorder = KeyRecorder()
+  format_string % recorder
+  return list(recorder.keys())
+
+# A quickdesc rule prepared for a family: used_keys are the parametrics read by its preprocessors
+# and format strings (only those need cleaning up).
+CompiledQuickDesc = namedtuple('CompiledQuickDesc', ['family', 'preprocessors', 'title', 'quickdesc', 'used_keys'])
+
+def compile_quickdesc_rules(rules):
+  compiled = {}
+  for family, rule in rules.items():
+    used_keys = set(format_keys(rule.title)) | set(format_keys(rule.quickdesc))
+    used_keys.update(processor.name for processor in rule.preprocessors)
+    used_keys.add('Package / Case')
+    compiled[family] = CompiledQuickDesc(family, rule.preprocessors, rule.title, rule.quickdesc, used_keys)
+  return compiled
+
+# Dispatch table of compiled rules by part family, built once.
+compiled_quickdesc_rules = compile_quickdesc_rules(quickdesc_rules)
+
+# Runs a family's rule over the (modifiable) parametrics dicts of all its parts, returning the
+# appended row dicts in the same order.
+def family_quickdescs(rule, parametrics_list):
+  for parametrics in parametrics_list:
+    for k in rule.used_keys:
+      if k in parametrics:
+        parametrics[k] = clean_parametric(parametrics[k])
+    if 'Package / Case' in parametrics:
+      parametrics['Package / Case'] = select_package(parametrics['Package / Case'])
+
+  for processor in rule.preprocessors:
+    for parametrics in parametrics_list:
+      assert processor.name in parametrics, "Preprocessor for family '%s' needs pamametric '%s'" % (rule.family, processor.name)
+      parametrics[processor.name] = processor.fn(parametrics[processor.name])
+
+  return [{'dist_title': rule.title % parametrics,
+           'dist_package': parametrics.get('Package / Case', ''),
+           'dist_quickdesc': rule.quickdesc % parametrics}
+          for parametrics in parametrics_list]
+
+# Batch annotator (see map_append_batch): groups the rows by part family, so each family's rule is
+# run over all its parts in one pass.
+def DigikeyQuickDescBatch(row_dicts):
+  results = [{} for _ in row_dicts]
+  families = OrderedDict()  # family -> (list of row index, list of parametrics)
+  for i, row_dict in enumerate(row_dicts):
+    print("Processing digikey_pn='%s'" % row_dict['digikey_pn'])
+
+    parametrics_str = row_dict['parametrics']
+    if not parametrics_str:
+      continue
+    parametrics = dict(parse_parametrics(parametrics_str))
+    family = parametrics['Categories']
+    assert family in compiled_quickdesc_rules, "no rule for part family '%s'" % family
+    indices, parametrics_list = families.setdefault(family, ([], []))
+    indices.append(i)
+    parametrics_list.append(parametrics)
+
+  for family, (indices, parametrics_list) in families.items():
+    for i, result in zip(indices, family_quickdescs(compiled_quickdesc_rules[family], parametrics_list)):
+      results[i] = result
+  return results
+DigikeyQuickDescBatch.reads = ('digikey_pn', 'parametrics')
+DigikeyQuickDescBatch.writes = ('dist_title', 'dist_package', 'dist_quickdesc')
+
 def DigikeyQuickDesc(row_dict):
-  print("Processing digikey_pn='%s'" % row_dict['digikey_pn'])
-
-  parametrics_str = row_dict['parametrics']
-  if not parametrics_str:
-    return {}
-  parametrics = ast.literal_eval(parametrics_str)
-  family = parametrics['Categories']
-  assert family in quickdesc_rules, "no rule for part family '%s'" % family
-
-  # Do global pre-process
-  for k, v in parametrics.items():
-    # Eliminate supplemental information in parentheses
-    v = re.sub(paren_removal_regex, '', v)
-    if v == '-':
-      v = '?'
-    parametrics[k] = v
-
-  # Global package preference selection
-  if 'Package / Case' in parametrics:
-    package = list_regex_map(package_priority_map)(parametrics['Package / Case'])
-    parametrics['Package / Case'] = package
-
-  quickdesc_rule = quickdesc_rules[family]
-  for processor in quickdesc_rule.preprocessors:
-    assert processor.name in parametrics, "Preprocessor for family '%s' needs pamametric '%s'" % (family, processor.name)
-    parametrics[processor.name] = processor.fn(parametrics[processor.name])
-  title = quickdesc_rule.title % parametrics
-  if 'Package / Case' in parametrics:
-    package = parametrics['Package / Case']
-  else:
-    package = ''
-  quickdesc = quickdesc_rule.quickdesc % parametrics
-  return {'dist_title': title,
-          'dist_package': package,
-          'dist_quickdesc': quickdesc}
-
-load().map_append(DigikeyQuickDesc) \
-    .map_append(RemapParametric('dist_mfrpn', 'Manufacturer Part Number')) \
-    .map_append(RemapParametric('dist_desc', 'Description')) \
-    .write()
+  return DigikeyQuickDescBatch([row_dict])[0]
+DigikeyQuickDesc.reads = DigikeyQuickDescBatch.reads
+DigikeyQuickDesc.writes = DigikeyQuickDescBatch.writes
+
+def annotate(rows):
+  return rows.map_append_batch(DigikeyQuickDescBatch) \
+      .map_append(RemapParametric('dist_mfrpn', 'Manufacturer Part Number')) \
+      .map_append(RemapParametric('dist_desc', 'Description'))
+
+if __name__ == '__main__':
+  annotate(load()).write()
@@ -1,6 +1,9 @@
 from labelannotator import *
 import re
 
-load() \
-    .filter(FieldEquals('template', 'label')) \
-    .write()
+def annotate(rows):
+  return rows \
+      .filter(FieldEquals('template', 'label'))
+
+if __name__ == '__main__':
+  annotate(load()).write()
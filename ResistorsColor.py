@@ -1,4 +1,6 @@
 from labelannotator import *
+from decimal import Decimal, InvalidOperation
+import functools
 import re
 
 resistor_colors = {
@@ -29,67 +31,186 @@ resistor_tolerance_colors = {
 }
 
 resistance_multiplier = {
+  'm': -3,
+  'R': 0,
   'k': 3,
+  'K': 3,
   'M': 6,
   'G': 9,
 }
 
-def colors_dict(res_str):
-  # Do calculations with string manipulation to avoid floating-point loss of
-  # precision and things like 4.6999999999k.
+MIN_MULTIPLIER_CODE = min(resistor_colors.keys())
+MAX_MULTIPLIER_CODE = max(resistor_colors.keys())
+
+# Standard E-series significant figures. E6 and E12 take every 4th and 2nd E24 value, and E48 and
+# E96 every 4th and 2nd E192 value. E192 follows 10^(i/192) rounded to 3 figures, except for 9.20.
+E24_VALUES = ['1.0', '1.1', '1.2', '1.3', '1.5', '1.6', '1.8', '2.0', '2.2', '2.4', '2.7', '3.0',
+              '3.3', '3.6', '3.9', '4.3', '4.7', '5.1', '5.6', '6.2', '6.8', '7.5', '8.2', '9.1']
+E192_VALUES = ['%.2f' % round(10 ** (i / 192), 2) for i in range(192)]
+E192_VALUES[E192_VALUES.index('9.19')] = '9.20'
+E_SERIES = {
+  'E6': E24_VALUES[::4],
+  'E12': E24_VALUES[::2],
+  'E24': E24_VALUES,
+  'E48': E192_VALUES[::4],
+  'E96': E192_VALUES[::2],
+  'E192': E192_VALUES,
+}
+
+# Color codes use 2 significant digits (3- and 4-band) or 3 (5-band).
+BAND_DIGITS = [2, 3]
+
+# Returns the (digit codes, multiplier code) encoding value with num_digits significant digits, or
+# None if it needs more digits or a multiplier beyond silver (x0.01) or white (x1G).
+def encode_resistance(value, num_digits):
+  sign, digits, exponent = value.normalize().as_tuple()
+  if sign or not isinstance(exponent, int) or len(digits) > num_digits:
+    return None
+  multiplier = exponent - (num_digits - len(digits))
+  if not MIN_MULTIPLIER_CODE <= multiplier <= MAX_MULTIPLIER_CODE:
+    return None
+  return (tuple(digits) + (0,) * (num_digits - len(digits)), multiplier)
+
+# Color code table over every E6-E192 value, in every decade a color code can represent, keyed by
+# the normalized value (in ohms) and holding the encoding for each number of band digits.
+resistor_code_table = {}
+for series_values in E_SERIES.values():
+  for figures in series_values:
+    for decade in range(MIN_MULTIPLIER_CODE + 1, MAX_MULTIPLIER_CODE + 2):
+      value = Decimal(figures).scaleb(decade).normalize()
+      if value not in resistor_code_table:
+        resistor_code_table[value] = {num_digits: encode_resistance(value, num_digits)
+                                      for num_digits in BAND_DIGITS}
+
+resistance_re = re.compile(r'^(\d*\.?\d*)\s*([mRkKMG]?)(\d*)\s*(?:Ω|[oO]hms?)?$')
+
+# Parses a resistance string like '4.7kΩ', '4k7', '0.22Ω', 'R22' or '10 kOhms' into a
+# normalized Decimal number of ohms, or None if it is not a resistance.
+@functools.lru_cache(maxsize=None)
+def parse_resistance(res_str):
+  match = resistance_re.match(res_str.strip())
+  if not match:
+    return None
+  number, prefix, fraction = match.groups()
+  if fraction:
+    if '.' in number:
+      return None
+    number = number + '.' + fraction  # letter as decimal point, like 4k7
+  try:
+    return Decimal(number).scaleb(resistance_multiplier.get(prefix, 0)).normalize()
+  except InvalidOperation:
+    return None
+
+def encoding_for(value, num_digits):
+  codes = resistor_code_table.get(value)
+  if codes is not None:
+    return codes[num_digits]
+  return encode_resistance(value, num_digits)
+
+tolerance_re = re.compile(r'±\s*(\d+(?:\.\d+)?)\s*%')
+
+# Returns the tolerance in percent given in a string like '±5%, 1/4W', or None.
+def parse_tolerance(tolerance_str):
+  match = tolerance_re.search(tolerance_str or '')
+  return float(match.group(1)) if match else None
+
+BLANK_COLORS = {
+  'res_color1': '#FFFFFF',
+  'res_color2': '#FFFFFF',
+  'res_color3': '#FFFFFF',
+  'res_stroke': '#FFFFFF',
+}
 
+# Most bands of a full color code (3 digits, multiplier and tolerance).
+MAX_BANDS = 5
+
+BLANK_BANDS = dict([('res_band%i' % (i + 1), '#FFFFFF') for i in range(MAX_BANDS)] + [('res_bands', '0')])
+
+# Returns the color bands of a resistance as a dict of:
+# - res_color1, res_color2, res_color3 and res_stroke: the 3-band code (2 digits and a multiplier),
+#   which 3-band templates draw. Values that need 3 significant digits are left blank, since 2
+#   digits would show a different resistance.
+# - res_band1 ... res_band5 and res_bands: the full code, bands in order with tolerance last, and
+#   the number of bands, for templates that draw 4 or 5 bands. Precision parts (1% or better) and
+#   values needing 3 significant digits get 5 bands, other parts with a tolerance band color get 4,
+#   and parts without a known tolerance (or 20%) get 3. Unused bands are white.
+# Empty values, and values no color code can represent, are left blank.
+@functools.lru_cache(maxsize=None)
+def band_colors(res_str, tolerance=None):
   if not res_str:
-    return {
-      'res_color1': '#FFFFFF',
-      'res_color2': '#FFFFFF',
-      'res_color3': '#FFFFFF',
-      'res_stroke': '#FFFFFF',
-    }  
-  
-  if res_str[-2].isalpha():
-    mult_str = res_str[-2]
-    res_nopow_str = res_str[:-2]
-    assert mult_str in resistance_multiplier, "Unknown multiplier '%s'" % mult_str
-    mult_pow = resistance_multiplier[mult_str]
-  else:
-    mult_pow = 0
-    res_nopow_str = res_str[:-1]
-
-  dot_point = res_nopow_str.find('.')
-  if dot_point > 0:
-    assert not (dot_point == 1 and res_nopow_str[0] == '0'), "TODO: handle <1ohm codes"
-    mult_code = dot_point - 2 + mult_pow
-    nodot_str = res_nopow_str[0:dot_point] + res_nopow_str[dot_point+1:]
-  else:
-    mult_code = len(res_nopow_str) - 2 + mult_pow
-
-    nodot_str = res_nopow_str
-
-  val1_code = int(nodot_str[0])
-  if len(nodot_str) > 1:
-    val2_code = int(nodot_str[1])
-    assert nodot_str[2:] == '0'*(len(nodot_str) - 2)
-  else:
-    val2_code = 0
-    
-  return {
-    'res_color1': resistor_colors[val1_code],
-    'res_color2': resistor_colors[val2_code],
-    'res_color3': resistor_colors[mult_code],
-    'res_stroke': '#000000',
-  }  
+    return dict(BLANK_COLORS, **BLANK_BANDS)
+  value = parse_resistance(res_str)
+  if value is None:
+    print("Not a resistance: '%s'" % res_str)
+    return dict(BLANK_COLORS, **BLANK_BANDS)
+
+  colors = dict(BLANK_COLORS)
+  two_digit_encoding = encoding_for(value, 2)
+  if two_digit_encoding is not None:
+    digit_codes, multiplier = two_digit_encoding
+    for i, code in enumerate(digit_codes + (multiplier,)):
+      colors['res_color%i' % (i + 1)] = resistor_colors[code]
+    colors['res_stroke'] = '#000000'
+
+  tolerance_color = resistor_tolerance_colors.get(tolerance)
+  encoding = two_digit_encoding
+  if tolerance_color is not None and tolerance <= 1 or encoding is None:
+    encoding = encoding_for(value, 3)
+  if encoding is None:
+    print("No color code for resistance '%s'" % res_str)
+    return dict(BLANK_COLORS, **BLANK_BANDS)
+  if two_digit_encoding is None:
+    print("No 3-band color code for resistance '%s'" % res_str)
+
+  digit_codes, multiplier = encoding
+  bands = [resistor_colors[code] for code in digit_codes] + [resistor_colors[multiplier]]
+  if tolerance_color is not None:
+    bands.append(tolerance_color)
+  colors.update(BLANK_BANDS)
+  colors.update({'res_band%i' % (i + 1): color for (i, color) in enumerate(bands)})
+  colors['res_bands'] = str(len(bands))
+  return colors
+
+# Returns the color code of a resistance, without a tolerance band (see band_colors).
+def colors_dict(res_str):
+  return dict(band_colors(res_str))
+
+value_column_re = re.compile(r'^val_(\d+)$')
+
+# Returns the tolerance of a row's parts, from a tolerance column or the description.
+def row_tolerance(row_dict):
+  if 'tolerance' in row_dict and row_dict['tolerance']:
+    return parse_tolerance('±' + row_dict['tolerance'].lstrip('±'))
+  return parse_tolerance(row_dict['desc'] if 'desc' in row_dict else '')
+
+# Batch annotator (see map_append_batch) adding the color bands of every value column (val_1,
+# val_2, ...) of each row, suffixed with the column number (res_color1_1, res_stroke_1, ...).
+def AddColorBatch(row_dicts):
+  if not row_dicts:
+    return []
+  value_columns = sorted([(int(match.group(1)), key) for key in row_dicts[0]
+                          for match in [value_column_re.match(key)] if match])
+  results = []
+  for row_dict in row_dicts:
+    tolerance = row_tolerance(row_dict)
+    retval = {}
+    for i, key in value_columns:
+      retval.update({k + '_' + str(i): v for (k, v) in band_colors(row_dict[key], tolerance).items()})
+    results.append(retval)
+  return results
+AddColorBatch.row_cache = False  # table lookups, cheaper than the row cache
 
 def AddColor(row_dict):
-  retval = {}
-  for i in range(1,4):
-    res_str = row_dict['val_' + str(i)]
-    retval.update( {k + '_' + str(i): v for (k, v) in colors_dict(res_str).items()} )
-  return retval
-
-load() \
-    .map_append(PriorityMap(['type'], 'title')) \
-    .map_append(PriorityMap(['desc'], 'quickdesc')) \
-    .map_append(StaticField('pcost', '')) \
-    .map_append(StaticField('bg_color', '#FFFFFF')) \
-    .map_append(AddColor) \
-    .write()
+  return AddColorBatch([row_dict])[0]
+AddColor.row_cache = False
+
+def annotate(rows):
+  return rows \
+      .map_append(PriorityMap(['type'], 'title')) \
+      .map_append(PriorityMap(['desc'], 'quickdesc')) \
+      .map_append(StaticField('pcost', '')) \
+      .map_append(StaticField('bg_color', '#FFFFFF')) \
+      .map_append_batch(AddColorBatch)
+
+if __name__ == '__main__':
+  annotate(load()).write()
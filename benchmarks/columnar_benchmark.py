@@ -0,0 +1,67 @@
+# Compares the list-of-lists CsvRowCollection against ColumnarCsvRowCollection on a synthetic
+# parts inventory, running the same kind of chain as SupernodeAnnotator.py.
+# Usage: python benchmarks/columnar_benchmark.py [--sizes 10000 100000 1000000]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from labelannotator import *
+
+HEADER = ['serial', 'template', 'print', 'gridid', 'subgridid', 'digikey_pn', 'cost',
+          'manual_title', 'manual_package', 'manual_quickdesc', 'manual_mfrpn', 'manual_desc',
+          'notes', 'dist_title', 'dist_package', 'dist_quickdesc', 'dist_mfrpn', 'dist_desc']
+
+def synthetic_rows(num_rows):
+  rows = []
+  for i in range(num_rows):
+    rows.append(['S%06i' % i, 'drawer' if i % 4 else 'label', '', 'G%i' % (i % 97) if i % 5 else '', '',
+                 '%i-ND' % i, '0.10' if i % 3 == 0 else '', '', '', '', '', '', '',
+                 'Part %i' % i, 'SOT-23', 'quickdesc', 'MFR%i' % i, 'description'])
+  return rows
+
+def GrididExists(row_dict):
+  return bool(row_dict['gridid'])
+
+def CostPrefix(row_dict):
+  if row_dict['cost']:
+    return {'pcost': ' ' + row_dict['cost']}
+  else:
+    return {'pcost': ''}
+
+# Each operation is a function of collection -> collection.
+OPERATIONS = [
+  ('filter(FieldEquals)', lambda c: c.filter(FieldEquals('template', 'drawer'))),
+  ('filter(GrididExists)', lambda c: c.filter(GrididExists)),
+  ('map_append(PriorityMap)', lambda c: c.map_append(PriorityMap(['manual_title', 'dist_title'], 'title'))),
+  ('map_append(StaticField)', lambda c: c.map_append(StaticField('bg_color', '#FFFFFF'))),
+  ('map_append(CostPrefix)', lambda c: c.map_append(CostPrefix)),
+  ('groupby(gridid)', lambda c: c.groupby(lambda row_dict: row_dict['gridid'])),
+]
+
+def time_operation(collection, op_fn):
+  start = time.perf_counter()
+  op_fn(collection)
+  return time.perf_counter() - start
+
+def main():
+  parser = argparse.ArgumentParser(description="CsvRowCollection representation benchmark")
+  parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                      help="Row counts to benchmark")
+  args = parser.parse_args()
+
+  print("%-28s %10s %12s %12s %8s" % ('operation', 'rows', 'rows (s)', 'columnar (s)', 'speedup'))
+  for num_rows in args.sizes:
+    rows = synthetic_rows(num_rows)
+    row_collection = CsvRowCollection(HEADER, rows, os.devnull)
+    columnar_collection = ColumnarCsvRowCollection.from_rows(HEADER, rows, os.devnull)
+    for op_name, op_fn in OPERATIONS:
+      rows_time = time_operation(row_collection, op_fn)
+      columnar_time = time_operation(columnar_collection, op_fn)
+      print("%-28s %10i %12.3f %12.3f %7.1fx" % (op_name, num_rows, rows_time, columnar_time,
+                                                  rows_time / columnar_time))
+
+if __name__ == '__main__':
+  main()
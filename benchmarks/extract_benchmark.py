@@ -0,0 +1,53 @@
+# Checks that the streaming product page extractor gives the same parametrics as the BeautifulSoup
+# path on every saved fixture page, then times both.
+# Usage: python benchmarks/extract_benchmark.py [--fixtures DIR] [--iterations 50]
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from digikeypage import extract_parametrics, soup_parametrics
+from stubserver import DEFAULT_FIXTURES
+
+def time_extractor(extractor, pages, iterations):
+  start = time.perf_counter()
+  for _ in range(iterations):
+    for page in pages:
+      extractor(page)
+  return (time.perf_counter() - start) / (iterations * len(pages))
+
+def main():
+  parser = argparse.ArgumentParser(description="product page extraction benchmark")
+  parser.add_argument('--fixtures', default=DEFAULT_FIXTURES,
+                      help="Directory of saved product pages")
+  parser.add_argument('--iterations', type=int, default=50)
+  args = parser.parse_args()
+
+  pages = []
+  mismatches = 0
+  for filename in sorted(glob.glob(os.path.join(args.fixtures, '*.html'))):
+    with open(filename, encoding='utf-8') as page_file:
+      page = page_file.read()
+    pages.append(page)
+    expected = soup_parametrics(page)
+    extracted = extract_parametrics(page)
+    if list(expected.items()) != list(extracted.items()):
+      mismatches += 1
+      print("MISMATCH %s" % filename)
+      for key in expected.keys() | extracted.keys():
+        if expected.get(key) != extracted.get(key):
+          print("  %r: %r != %r" % (key, expected.get(key), extracted.get(key)))
+  print("%i pages, %i mismatches" % (len(pages), mismatches))
+  if mismatches:
+    sys.exit(1)
+
+  soup_time = time_extractor(soup_parametrics, pages, args.iterations)
+  extract_time = time_extractor(extract_parametrics, pages, args.iterations)
+  print("%-22s %10.3f ms/page" % ('soup_parametrics', soup_time * 1000))
+  print("%-22s %10.3f ms/page (%.1fx)" % ('extract_parametrics', extract_time * 1000, soup_time / extract_time))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+# Measures streaming groupby / group_map over a synthetic stock-movement export (one row per
+# movement, grouped by drawer gridid), with groups kept in memory and with groups spilled to disk
+# past a memory budget (see spillgroups.py), checking that both give the same output. Each run is a
+# separate process, so its peak memory can be compared.
+# Usage: python benchmarks/groupby_benchmark.py [--rows 1000000] [--budgets 0 64 16]
+
+import argparse
+import csv
+import filecmp
+import os
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+from suite import run_measured
+
+MOVEMENTS_HEADER = ['serial', 'date', 'gridid', 'digikey_pn', 'quantity', 'reason', 'notes']
+REASONS = ['restock', 'build', 'loan', 'return', 'count']
+
+def write_movements(filename, num_rows, num_drawers):
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    output_writer = csv.writer(outfile, delimiter=',')
+    output_writer.writerow(MOVEMENTS_HEADER)
+    for i in range(num_rows):
+      drawer = i * 7919 % num_drawers
+      output_writer.writerow(['M%08i' % i, '2026-%02i-%02i' % (i % 12 + 1, i % 28 + 1),
+                              '%s%i' % (chr(ord('A') + drawer % 26), drawer // 26), 'SYN%06i-ND' % drawer,
+                              str(i % 50 - 25), REASONS[i % len(REASONS)], 'movement note %i' % (i % 1000)])
+
+# Run in the measured process: groups the movements by gridid and writes one summary row per drawer.
+def run_groupby(input, output, memory_mb):
+  import spillgroups
+  from labelannotator import read_csv
+  spillgroups.groupby_memory_mb = memory_mb
+
+  def DrawerSummary(gridid, row_dicts):
+    return [{'gridid': gridid, 'movements': str(len(row_dicts)),
+             'net_quantity': str(sum(int(row_dict['quantity']) for row_dict in row_dicts)),
+             'first': row_dicts[0]['serial'], 'last': row_dicts[-1]['serial']}]
+
+  read_csv(input, output, stream=True).groupby(lambda row_dict: row_dict['gridid']) \
+      .group_map(DrawerSummary).write()
+
+def main():
+  parser = argparse.ArgumentParser(description="groupby benchmark")
+  parser.add_argument('--rows', type=int, default=1000000)
+  parser.add_argument('--drawers', type=int, default=2000)
+  parser.add_argument('--budgets', type=float, nargs='+', default=[0, 64, 16],
+                      help="Groupby memory budgets in MB to compare, 0 for no limit")
+  parser.add_argument('--run', nargs=3, metavar=('INPUT', 'OUTPUT', 'MEMORY_MB'), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run:
+    input, output, memory_mb = args.run
+    run_groupby(input, output, float(memory_mb) or None)
+    return
+
+  with tempfile.TemporaryDirectory(prefix='groupby_benchmark_') as work_dir:
+    movements = os.path.join(work_dir, 'movements.csv')
+    write_movements(movements, args.rows, args.drawers)
+    print("%-12s %10s %10s %12s %10s %8s" % ('budget', 'rows', 'time (s)', 'rows/s', 'peak MB', 'same'))
+    reference = None
+    for memory_mb in args.budgets:
+      output = os.path.join(work_dir, 'summary_%s.csv' % memory_mb)
+      elapsed, peak_mb = run_measured([sys.executable, __file__, '--run', movements, output, str(memory_mb)],
+                                      dict(os.environ), work_dir)
+      if reference is None:
+        reference = output
+      print("%-12s %10i %10.2f %12.0f %10.1f %8s" % ('%g MB' % memory_mb if memory_mb else 'in memory', args.rows,
+                                                     elapsed, args.rows / elapsed, peak_mb,
+                                                     filecmp.cmp(reference, output, shallow=False)))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,43 @@
+# Measures spot lookups in synthetic parts inventories through the CSV index (see csvindex.py):
+# building the index, then reading one part by serial and one drawer by gridid, against reading the
+# whole file and filtering it, and checks that both give the same rows.
+# Usage: python benchmarks/index_benchmark.py [--sizes 10000 100000 1000000]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from labelannotator import *
+from csvindex import CsvIndex
+from inventory import PARTS_HEADER, synthetic_part_rows, write_csv
+
+def timed(fn):
+  start = time.perf_counter()
+  result = fn()
+  return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="CSV index benchmark")
+  parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+  args = parser.parse_args()
+
+  print("%-22s %10s %10s" % ('operation', 'rows', 'time (s)'))
+  with tempfile.TemporaryDirectory(prefix='index_benchmark_') as work_dir:
+    for num_rows in args.sizes:
+      parts = os.path.join(work_dir, 'parts_%i.csv' % num_rows)
+      write_csv(parts, PARTS_HEADER, synthetic_part_rows(num_rows))
+      serial = 'S%07i' % (num_rows * 2 // 3)
+      gridid = 'C7'
+
+      elapsed, index = timed(lambda: CsvIndex(parts, ['serial', 'gridid']))
+      index.close()
+      print("%-22s %10i %10.3f" % ('build index', num_rows, elapsed))
+      for name, where in [('serial', [('serial', serial, serial)]), ('gridid', [('gridid', gridid, gridid)])]:
+        elapsed, indexed = timed(lambda: read_csv(parts, None, where=where))
+        print("%-22s %10i %10.4f" % ('indexed %s lookup' % name, num_rows, elapsed))
+        elapsed, scanned = timed(lambda: read_csv(parts, None).filter(lambda row_dict: row_dict[name] == where[0][1]))
+        print("%-22s %10i %10.4f" % ('scanned %s lookup' % name, num_rows, elapsed))
+        assert indexed.rows == scanned.rows, "indexed %s lookup differs" % name
@@ -0,0 +1,145 @@
+# Generates synthetic inventories at any scale: a parts CSV shaped like data/all_parts.csv whose
+# parts cover every family in DigikeyLabelGen.quickdesc_rules, a resistors CSV shaped like
+# data/resistors_3x.csv, and the product pages for the parts, to serve from benchmarks/stubserver.py.
+# Parts are drawn from a fixed number of distinct Digikey part numbers (an inventory holds several
+# drawers of the same part), so the number of pages, and of crawl requests, stays bounded.
+# Usage: python benchmarks/inventory.py --rows 100000 --out-dir inventory [--distinct-parts 2000]
+
+import argparse
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from DigikeyLabelGen import format_keys, quickdesc_rules
+from productpages import fixture_filename, render_product_page
+
+PARTS_HEADER = ['serial', 'template', 'print', 'gridid', 'subgridid', 'digikey_pn', 'cost',
+                'manual_title', 'manual_package', 'manual_quickdesc', 'manual_mfrpn', 'manual_desc', 'notes']
+RESISTORS_HEADER = ['type', 'package', 'desc', 'val_1', 'val_2', 'val_3', 'gridid']
+
+DEFAULT_DISTINCT_PARTS = 2000
+
+# Values for parametrics which family preprocessors parse, keyed by (family or None, parametric).
+SAMPLE_VALUES = {
+  (None, 'Power (Watts)'): ['0.25W, 1/4W', '0.5W, 1/2W', '1W, 1/1W'],
+  (None, 'Resistance'): ['%i %sOhms' % (value, prefix) for value in (1, 10, 22, 47, 100, 470) for prefix in ('', 'k', 'M')],
+  (None, 'Voltage - Forward (Vf) (Max) @ If'): ['1V @ 1A', '1.1V @ 3A', '700mV @ 10mA'],
+  (None, 'FET Type'): ['N-Channel', 'P-Channel, Logic Level Gate', 'N-Channel, Metal Oxide'],
+  (None, 'Voltage - Output (Min/Fixed)'): ['3.3V', '5V', '1.25V ~ 37V', '12V'],
+  (None, 'Voltage Dropout (Max)'): ['2V @ 1A', '0.3V @ 150mA (Typ)', '?'],
+  (None, 'Topology'): ['Buck', 'Buck, Boost', 'Buck, Boost, Flyback, Forward Converter'],
+  ('Logic - Flip Flops', 'Type'): ['D-Type', 'JK Type'],
+  (None, 'Max Propagation Delay @ V, Max CL'): ['5ns @ 5V, 50pF', '12.5ns @ 3.3V, 15pF', '?'],
+  (None, 'Program Memory Size'): ['32KB (16K x 16)', '128KB (64K x 16)', '8KB (8K x 8)'],
+  (None, 'Memory Size'): ['256Kb (32K x 8)', '1Mb (128K x 8)', '64Kb'],
+}
+
+PACKAGES = ['TO-220-3', 'TO-92-3 (TO-226) Formed Leads', 'TO-263-3, D²Pak (2 Leads + Tab), TO-263AB',
+            'SC-74A, SOT-753', 'TO-236-3, SC-59, SOT-23-3', 'SOT-223-4', 'SOD-123', 'DO-204AL, DO-41, Axial',
+            '20-TSSOP (0.173", 4.40mm Width)', 'Radial, Can', '8-SOIC (0.154", 3.90mm Width)', '-']
+
+MOUNTING_TYPES = ['Through Hole', 'Surface Mount']
+
+# E12 significant figures, for resistor values with two significant digits.
+E12_VALUES = ['1.0', '1.2', '1.5', '1.8', '2.2', '2.7', '3.3', '3.9', '4.7', '5.6', '6.8', '8.2']
+RESISTOR_PREFIXES = ['', 'k', 'M']
+
+FAMILIES = sorted(quickdesc_rules.keys())
+
+# Returns the parametrics of the i-th synthetic part of a family, with every parametric its rule
+# reads (in the format its preprocessors expect) and a few it does not.
+def synthetic_parametrics(family, i):
+  rule = quickdesc_rules[family]
+  parametrics = {'Categories': family, 'Package / Case': PACKAGES[i % len(PACKAGES)],
+                 'Manufacturer Part Number': 'MFR-%i' % i, 'Description': 'PART %i (SYNTHETIC)' % i,
+                 'Operating Temperature': '-40°C ~ 85°C (TA)', 'Mounting Type': MOUNTING_TYPES[i % 2]}
+  for key in format_keys(rule.title) + format_keys(rule.quickdesc):
+    parametrics[key] = '%s %i (typ)' % (key.split(' ')[0], i % 17) if i % 9 else '-'
+  for processor in rule.preprocessors:
+    values = SAMPLE_VALUES.get((family, processor.name)) or SAMPLE_VALUES[(None, processor.name)]
+    parametrics[processor.name] = values[i % len(values)]
+  return parametrics
+
+def part_number(i):
+  return 'SYN%06i-ND' % i
+
+# Returns the family of the i-th distinct part, cycling through every family.
+def part_family(i):
+  return FAMILIES[i % len(FAMILIES)]
+
+# Returns the product page of the i-th distinct part, as the crawler would fetch it.
+def synthetic_product_page(i):
+  pn = part_number(i)
+  parametrics = synthetic_parametrics(part_family(i), i)
+  overview = [('Digi-Key Part Number', pn), ('Quantity Available', str(i * 7 % 10000)),
+              ('Manufacturer', 'Synthetic Devices'),
+              ('Manufacturer Part Number', parametrics.pop('Manufacturer Part Number')),
+              ('Description', parametrics.pop('Description'))]
+  attributes = [('Categories', ['Integrated Circuits (ICs)', parametrics.pop('Categories')])]
+  attributes += list(parametrics.items())
+  return render_product_page(pn, overview, attributes)
+
+# Returns the parts CSV rows. Most rows are drawer parts with a grid position and a Digikey part
+# number; some are manual entries, some labels without a position, and some have a cost.
+def synthetic_part_rows(num_rows, distinct_parts=DEFAULT_DISTINCT_PARTS):
+  rows = []
+  for i in range(num_rows):
+    gridid = '%s%i' % (chr(ord('A') + i % 26), i // 26 % 100) if i % 10 else ''
+    if i % 50 == 0:
+      rows.append(['S%07i' % i, 'drawer', '', gridid, '', '', '',
+                   'Manual part %i' % i, 'DIP-8', 'hand entered', 'MAN-%i' % i, 'manual description', ''])
+    else:
+      rows.append(['S%07i' % i, 'drawer' if i % 7 else 'label', '', gridid, '',
+                   part_number(i % distinct_parts), '0.%02i' % (i % 100) if i % 3 == 0 else '',
+                   '', '', '', '', '', 'note' if i % 11 == 0 else ''])
+  return rows
+
+def resistor_value(i):
+  digits = E12_VALUES[i % len(E12_VALUES)]
+  prefix = RESISTOR_PREFIXES[i // len(E12_VALUES) % 3]
+  decade = i // (len(E12_VALUES) * 3) % 3  # x1, x10, x100
+  if decade == 0:
+    value = digits[:-2] if digits.endswith('.0') else digits
+  else:
+    value = digits.replace('.', '') + '0' * (decade - 1)
+  return '%s%sΩ' % (value, prefix)
+
+# Returns the resistors CSV rows, three E12 values per drawer.
+def synthetic_resistor_rows(num_rows):
+  rows = []
+  for i in range(num_rows):
+    values = [resistor_value(i * 3 + j) for j in range(3)]
+    if i % 13 == 0:
+      values[2] = ''
+    rows.append(['Resistor', 'Axial', '±5%, 1/4W'] + values + ['%s-%i' % (chr(ord('A') + i % 26), i // 26)])
+  return rows
+
+def write_csv(filename, header, rows):
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    output_writer = csv.writer(outfile, delimiter=',')
+    output_writer.writerow(header)
+    output_writer.writerows(rows)
+
+# Writes parts.csv, resistors.csv and the product pages (in pages/) into out_dir, returning the
+# pages directory.
+def write_inventory(out_dir, num_rows, distinct_parts=DEFAULT_DISTINCT_PARTS):
+  pages_dir = os.path.join(out_dir, 'pages')
+  os.makedirs(pages_dir, exist_ok=True)
+  write_csv(os.path.join(out_dir, 'parts.csv'), PARTS_HEADER, synthetic_part_rows(num_rows, distinct_parts))
+  write_csv(os.path.join(out_dir, 'resistors.csv'), RESISTORS_HEADER, synthetic_resistor_rows(num_rows))
+  for i in range(min(num_rows, distinct_parts)):
+    with open(os.path.join(pages_dir, fixture_filename(part_number(i))), 'w', encoding='utf-8') as page_file:
+      page_file.write(synthetic_product_page(i))
+  return pages_dir
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="synthetic inventory generator")
+  parser.add_argument('--rows', type=int, default=10000)
+  parser.add_argument('--out-dir', required=True)
+  parser.add_argument('--distinct-parts', type=int, default=DEFAULT_DISTINCT_PARTS,
+                      help="Number of distinct Digikey part numbers (and product pages)")
+  args = parser.parse_args()
+
+  pages_dir = write_inventory(args.out_dir, args.rows, args.distinct_parts)
+  print("Wrote %i rows to %s, serve %s with benchmarks/stubserver.py --fixtures" % (args.rows, args.out_dir, pages_dir))
@@ -0,0 +1,66 @@
+# Measures merging a pricing sheet into a parts list by digikey_pn with join / lookup, using the
+# hash and sort-merge methods, against the map_append closure scanning the sheet for each row that
+# annotators otherwise use, and checks that all of them give the same results.
+# Usage: python benchmarks/join_benchmark.py [--sizes 10000 100000] [--prices 20000]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from labelannotator import *
+from inventory import PARTS_HEADER, part_number, synthetic_part_rows
+
+PRICES_HEADER = ['pn', 'unit_price', 'stock']
+
+def price_rows(num_prices):
+  return [[part_number(i), '%.3f' % (i % 997 / 100), str(i * 13 % 5000)] for i in range(num_prices)]
+
+# The map_append closure version of lookup, scanning the price rows for each part.
+def ScanLookup(prices):
+  def annotate_fn(row_dict):
+    for price in prices:
+      if price['pn'] == row_dict['digikey_pn']:
+        return {'stock': price['stock'], 'unit_price': price['unit_price']}
+    return {}
+  return annotate_fn
+
+def timed(fn):
+  start = time.perf_counter()
+  result = fn()
+  return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="join benchmark")
+  parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+  parser.add_argument('--prices', type=int, default=20000)
+  parser.add_argument('--scan-rows', type=int, default=2000,
+                      help="Parts to time the scanning map_append on (it is quadratic)")
+  args = parser.parse_args()
+
+  prices = CsvRowCollection(PRICES_HEADER, price_rows(args.prices), None)
+  print("%-22s %10s %10s %12s" % ('operation', 'rows', 'time (s)', 'rows/s'))
+  for num_rows in args.sizes:
+    parts = CsvRowCollection(PARTS_HEADER, synthetic_part_rows(num_rows, args.prices * 2), None)
+    results = []
+    for name, fn in [
+        ('lookup (hash)', lambda: parts.lookup(prices, 'digikey_pn', other_on='pn', method='hash')),
+        ('lookup (merge)', lambda: parts.lookup(prices, 'digikey_pn', other_on='pn', method='merge')),
+        ('join inner (hash)', lambda: parts.join(prices, 'digikey_pn', 'inner', other_on='pn', method='hash')),
+        ('join inner (merge)', lambda: parts.join(prices, 'digikey_pn', 'inner', other_on='pn', method='merge')),
+        ('join anti (hash)', lambda: parts.join(prices, 'digikey_pn', 'anti', other_on='pn', method='hash'))]:
+      elapsed, result = timed(fn)
+      results.append((name, result))
+      print("%-22s %10i %10.3f %12.0f" % (name, num_rows, elapsed, num_rows / elapsed))
+
+    assert results[0][1].rows == results[1][1].rows, "lookup methods differ"
+    assert results[2][1].rows == results[3][1].rows, "join methods differ"
+    assert len(results[2][1].rows) + len(results[4][1].rows) == len(results[0][1].rows)
+
+    scan_parts = CsvRowCollection(PARTS_HEADER, parts.rows[:args.scan_rows], None)
+    price_dicts = list(prices.row_dicts())
+    elapsed, scanned = timed(lambda: scan_parts.map_append(ScanLookup(price_dicts)))
+    assert scanned.rows == results[0][1].rows[:args.scan_rows], "scanning map_append differs"
+    print("%-22s %10i %10.3f %12.0f" % ('map_append scan', len(scan_parts.rows), elapsed,
+                                        len(scan_parts.rows) / elapsed))
@@ -0,0 +1,87 @@
+# Renders stand-in Digikey product detail pages, laid out like the real ones as far as the crawler
+# is concerned: a product-overview table and a product-attribute-table (with the category breadcrumb
+# split over several rows), surrounded by navigation, scripts and links - including the hanging
+# </a> tags the crawler has to work around.
+
+from html import escape
+from urllib.parse import quote
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html lang="en">
+<head>
+\t<meta charset="utf-8">
+\t<title>%(mfrpn)s %(manufacturer)s | %(category)s | DigiKey</title>
+\t<link rel="stylesheet" href="/css/product-detail.css">
+\t<script type="text/javascript">
+\t\tvar utag_data = {"page_type": "PDP", "part_id": "%(pn)s", "note": "<table id='product-overview'> is not here"};
+\t</script>
+</head>
+<body>
+<div id="header"><a href="/">DigiKey</a> <a href="/products/en">Products</a> <a href="/en/resources">Resources</a></div>
+<div id="breadcrumb"><a href="/products/en">Products</a> &gt; <a href="/products/en/%(category_link)s">%(category)s</a></div>
+<div id="content">
+<table id="pricing"><tr><th>Price Break</th><th>Unit Price</th></tr>
+<tr><td>1</td><td>0.25000</td></tr><tr><td>10</td><td>0.19800</td></tr></table>
+"""
+
+PAGE_TAIL = """</div>
+<div id="footer">
+\t<a href="/en/help">Help</a> | <a href="/en/terms-and-conditions">Terms &amp; Conditions</a> | &copy; DigiKey
+</div>
+</body>
+</html>
+"""
+
+# Returns the fixture filename for a Digikey part number.
+def fixture_filename(pn):
+  return quote(pn, safe='') + '.html'
+
+def _overview_row(header, value):
+  if header == 'Manufacturer':
+    value_html = '<h2 itemprop="manufacturer"><a itemprop="name" href="/en/supplier-centers/%s">%s</a></h2>' % (
+        quote(value.lower()), escape(value))
+  elif header == 'Manufacturer Part Number':
+    value_html = '<h1 itemprop="model">%s</h1>' % escape(value)
+  elif header == 'Quantity Available':
+    value_html = '%s&nbsp;Can ship immediately<br>\n\t\t<a href="/en/help/lead-time">Lead time</a></a>' % escape(value)
+  else:
+    value_html = escape(value)
+  return '<tr>\n\t<th>%s</th>\n\t<td>%s</td>\n</tr>\n' % (escape(header), value_html)
+
+def _attribute_rows(attributes):
+  rows = []
+  for header, value in attributes:
+    if header == 'Categories':
+      # The breadcrumb is split over one row per level, only the first one having a header.
+      for i, level in enumerate(value):
+        header_html = '<th>Categories</th>' if i == 0 else ''
+        rows.append('<tr>%s\n\t<td class="attributes-td-categories-link"><a href="/products/en/%s">%s</a></td>\n</tr>\n' % (
+            header_html, quote(level.lower()), escape(level)))
+    else:
+      rows.append('<tr>\n\t<th>%s</th>\n\t<td>%s\n\t</td>\n\t<td><input type="checkbox" name="%s"></td>\n</tr>\n' % (
+          escape(header), escape(value) if value else '-', quote(header)))
+  return ''.join(rows)
+
+# Renders a product page. overview and attributes are lists of (header, value); the 'Categories'
+# attribute value is a list of breadcrumb levels, from the top-level category to the family.
+def render_product_page(pn, overview, attributes):
+  attributes_dict = dict(attributes)
+  overview_dict = dict(overview)
+  category = attributes_dict['Categories'][-1]
+  page = PAGE_HEAD % {
+    'pn': escape(pn),
+    'mfrpn': escape(overview_dict.get('Manufacturer Part Number', '')),
+    'manufacturer': escape(overview_dict.get('Manufacturer', '')),
+    'category': escape(category),
+    'category_link': quote(category.lower()),
+  }
+  page += '<table id="product-overview" class="product-details-overview">\n<tbody>\n'
+  page += ''.join(_overview_row(header, value) for header, value in overview)
+  page += '<tr>\n\t<th>Datasheet</th>\n\t<td><a href="/datasheet/%s.pdf" target="_blank">Datasheet</a></td>\n</tr>\n' % quote(pn)
+  page += '</tbody>\n</table>\n'
+  page += '<h2>Product Attributes</h2>\n'
+  page += '<table id="product-attribute-table" class="table">\n<tbody>\n'
+  page += _attribute_rows(attributes)
+  page += '</tbody>\n</table>\n'
+  page += PAGE_TAIL
+  return page
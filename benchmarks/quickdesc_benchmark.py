@@ -0,0 +1,85 @@
+# Measures DigikeyLabelGen quickdesc throughput on a synthetic set of parts covering every family in
+# quickdesc_rules (see inventory.py), comparing the compiled, family-batched annotator against a
+# per-row version of the rule engine (compiling the package patterns and cleaning every parametric
+# for each row), and checking that both give the same results.
+# Usage: python benchmarks/quickdesc_benchmark.py [--sizes 10000 100000]
+
+import argparse
+import os
+import re
+import sys
+import time
+
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from labelannotator import *
+import DigikeyLabelGen
+from DigikeyLabelGen import *
+from inventory import synthetic_parametrics
+
+def synthetic_rows(num_rows):
+  families = sorted(quickdesc_rules.keys())
+  rows = []
+  for i in range(num_rows):
+    parametrics = synthetic_parametrics(families[i % len(families)], i) if i % 20 else {}
+    rows.append(['%i-ND' % i, format_parametrics(parametrics) if parametrics else ''])
+  return rows
+
+# The rule engine applied row by row, without any precompilation.
+def PerRowQuickDesc(row_dict):
+  print("Processing digikey_pn='%s'" % row_dict['digikey_pn'])
+
+  parametrics_str = row_dict['parametrics']
+  if not parametrics_str:
+    return {}
+  parametrics = dict(parse_parametrics(parametrics_str))
+  family = parametrics['Categories']
+
+  for k, v in parametrics.items():
+    v = re.sub(DigikeyLabelGen.paren_removal_regex, '', v)
+    if v == '-':
+      v = '?'
+    parametrics[k] = v
+  if 'Package / Case' in parametrics:
+    parametrics['Package / Case'] = list_regex_map(package_priority_map)(parametrics['Package / Case'])
+
+  quickdesc_rule = quickdesc_rules[family]
+  for processor in quickdesc_rule.preprocessors:
+    parametrics[processor.name] = processor.fn(parametrics[processor.name])
+  return {'dist_title': quickdesc_rule.title % parametrics,
+          'dist_package': parametrics.get('Package / Case', ''),
+          'dist_quickdesc': quickdesc_rule.quickdesc % parametrics}
+
+# Each method is a function of collection -> collection.
+METHODS = [
+  ('per-row', lambda c: c.map_append(PerRowQuickDesc)),
+  ('compiled, batched', lambda c: c.map_append_batch(DigikeyQuickDescBatch)),
+]
+
+def main():
+  parser = argparse.ArgumentParser(description="quickdesc throughput benchmark")
+  parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+  args = parser.parse_args()
+
+  for size in args.sizes:
+    rows = synthetic_rows(size)
+    print("%i rows, %i families" % (size, len(quickdesc_rules)))
+    outputs = []
+    for name, method in METHODS:
+      parse_parametrics.cache_clear()
+      clean_parametric.cache_clear()
+      select_package.cache_clear()
+      collection = CsvRowCollection(['digikey_pn', 'parametrics'], rows, os.devnull)
+      with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        result = method(collection)
+        elapsed = time.perf_counter() - start
+      outputs.append(result.rows)
+      print("  %-20s %8.3f s %12.0f rows/s" % (name, elapsed, size / elapsed))
+    if any(output != outputs[0] for output in outputs):
+      print("  MISMATCH between methods")
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,143 @@
+# Local stand-in for the Digikey product search, serving saved product pages from a fixtures
+# directory so DigikeyCrawler.py can be run and timed offline.
+# Requests for ...?name=<digikey_pn> are answered with <fixtures>/<quoted digikey_pn>.html (see
+# productpages.fixture_filename), or a 404 if there is no such fixture.
+# Requests for /products/details?parts=<digikey_pn>,... are answered like the JSON product details
+# endpoint of DigikeyCrawler.JsonBatchBackend, with the parameters of each part's fixture page.
+# Usage: python benchmarks/stubserver.py [--port 8000] [--latency 0.05] [--fail-every 10]
+# then run the crawler with DIGIKEY_URL_PREFIX=http://localhost:8000/scripts/DkSearch/dksus.dll?Detail?name=
+# or with DIGIKEY_BACKEND=json DIGIKEY_BATCH_URL=http://localhost:8000/products/details
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from digikeypage import extract_parametrics
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'digikey')
+URL_PATH = '/scripts/DkSearch/dksus.dll?Detail?name='
+BATCH_URL_PATH = '/products/details'
+
+class StubHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+
+  def setup(self):
+    super().setup()
+    self.server.count('connections')
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+  def send_body(self, status, body, content_type='text/html; charset=utf-8', headers={}):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for header, value in headers.items():
+      self.send_header(header, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    server = self.server
+    request_num = server.count('requests')
+    if server.latency:
+      time.sleep(server.latency)
+    if server.fail_every and request_num % server.fail_every == 0:
+      self.send_body(503, b'Service Unavailable', 'text/plain', {'Retry-After': '0'})
+      return
+
+    if self.path.startswith(BATCH_URL_PATH):
+      self.send_batch()
+      return
+
+    name_index = self.path.find('name=')
+    if name_index < 0:
+      self.send_body(404, b'Not Found', 'text/plain')
+      return
+    pn = unquote(self.path[name_index + len('name='):])
+    fixture_path = server.fixture_path(pn)
+    if not os.path.exists(fixture_path):
+      self.send_body(404, b'Not Found', 'text/plain')
+      return
+
+    with open(fixture_path, 'rb') as fixture:
+      self.send_body(200, fixture.read())
+
+  def send_batch(self):
+    # Part numbers are split on the raw commas, before unquoting, since they may contain quoted ones.
+    fields = [field.partition('=') for field in urlsplit(self.path).query.split('&')]
+    products = []
+    for pn in ','.join([value for (key, _, value) in fields if key == 'parts']).split(','):
+      pn = unquote(pn)
+      fixture_path = self.server.fixture_path(pn)
+      if not pn or not os.path.exists(fixture_path):
+        continue
+      with open(fixture_path, 'r', encoding='utf-8') as fixture:
+        parametrics = extract_parametrics(fixture.read())
+      products.append({'digikeyPartNumber': pn,
+                       'parameters': [{'parameter': name, 'value': value} for (name, value) in parametrics.items()]})
+    self.send_body(200, json.dumps({'products': products}).encode('utf-8'), 'application/json')
+
+class StubServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  # latency: seconds to wait before answering each request.
+  # fail_every: if set, every fail_every-th request gets a 503 (for exercising retries).
+  def __init__(self, address, fixtures_dir=DEFAULT_FIXTURES, latency=0, fail_every=None, verbose=False):
+    super().__init__(address, StubHandler)
+    self.fixtures_dir = fixtures_dir
+    self.latency = latency
+    self.fail_every = fail_every
+    self.verbose = verbose
+    self.stats = {'requests': 0, 'connections': 0}
+    self.stats_lock = threading.Lock()
+
+  def fixture_path(self, pn):
+    return os.path.join(self.fixtures_dir, quote(pn, safe='') + '.html')
+
+  def count(self, stat):
+    with self.stats_lock:
+      self.stats[stat] += 1
+      return self.stats[stat]
+
+  # Returns the DIGIKEY_URL_PREFIX pointing at this server.
+  def url_prefix(self):
+    return 'http://%s:%i%s' % (self.server_address[0], self.server_address[1], URL_PATH)
+
+  # Returns the DIGIKEY_BATCH_URL pointing at this server.
+  def batch_url(self):
+    return 'http://%s:%i%s' % (self.server_address[0], self.server_address[1], BATCH_URL_PATH)
+
+# Starts a StubServer on a background thread (on a free port, by default), returning the server.
+def start_stub_server(port=0, **kwargs):
+  server = StubServer(('127.0.0.1', port), **kwargs)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Digikey product page stub server")
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument('--fixtures', default=DEFAULT_FIXTURES,
+                      help="Directory of saved product pages")
+  parser.add_argument('--latency', type=float, default=0,
+                      help="Seconds to wait before answering each request")
+  parser.add_argument('--fail-every', type=int, default=None,
+                      help="Answer every N-th request with a 503")
+  args = parser.parse_args()
+
+  server = StubServer(('127.0.0.1', args.port), fixtures_dir=args.fixtures, latency=args.latency,
+                      fail_every=args.fail_every, verbose=True)
+  print("Serving %s, use DIGIKEY_URL_PREFIX=%s or DIGIKEY_BACKEND=json DIGIKEY_BATCH_URL=%s" %
+        (args.fixtures, server.url_prefix(), server.batch_url()))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print(server.stats)
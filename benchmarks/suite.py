@@ -0,0 +1,194 @@
+# End-to-end benchmark suite: generates synthetic inventories (see inventory.py) at several sizes,
+# serves their product pages from a local stub server, and runs each annotator stage of the build
+# (crawl, quickdesc, Supernode annotation, drawers filter, resistor colors) as its own pipeline.py
+# process, reporting its throughput and peak memory.
+# With --baseline, results are compared against a stored baseline (for the sizes it has), and the
+# suite fails if any stage got slower or bigger by more than the tolerance. Stages which took under
+# MIN_GATED_SECONDS in the baseline are only reported, since their time and memory are mostly
+# interpreter startup and vary too much between runs to gate on. Baselines depend on the machine, so
+# record one with --save-baseline before comparing on a new machine, and again when a change moves
+# the numbers on purpose.
+# Usage: python benchmarks/suite.py [--sizes 1000 10000 100000] [--baseline benchmarks/baseline.json]
+#        [--save-baseline] [--tolerance 0.3] [--stream] [--crawl-backend json]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCHMARKS_DIR, '..')
+sys.path.insert(0, REPO_DIR)
+from inventory import DEFAULT_DISTINCT_PARTS, write_inventory
+from stubserver import start_stub_server
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+
+# Baseline stage times under which a slowdown is reported but does not fail the suite.
+MIN_GATED_SECONDS = 1.0
+
+# Stages, as (name, annotator script, input file, output file), in build order. Filenames are
+# relative to the inventory directory.
+STAGES = [
+  ('crawl', 'DigikeyCrawler.py', 'parts.csv', 'crawled.csv'),
+  ('crawl (cached)', 'DigikeyCrawler.py', 'parts.csv', 'crawled.csv'),
+  ('quickdesc', 'DigikeyLabelGen.py', 'crawled.csv', 'quickdesc.csv'),
+  ('supernode', 'SupernodeAnnotator.py', 'quickdesc.csv', 'parts_data.csv'),
+  ('drawers filter', 'DrawersFilter.py', 'parts_data.csv', 'parts_drawers_data.csv'),
+  ('resistors', 'ResistorsColor.py', 'resistors.csv', 'resistors_color.csv'),
+]
+
+# Returns the peak resident memory in MB from a resource usage record (ru_maxrss is in KB on
+# Linux, and in bytes on macOS).
+def peak_rss_mb(rusage):
+  if sys.platform == 'darwin':
+    return rusage.ru_maxrss / (1024 * 1024)
+  return rusage.ru_maxrss / 1024
+
+# Runs a command to completion, returning (wall time in seconds, peak memory in MB) of that process.
+# Raises CalledProcessError, including the end of its stderr, if it fails.
+def run_measured(args, env, cwd):
+  with tempfile.TemporaryFile('w+') as errfile:
+    start = time.perf_counter()
+    process = subprocess.Popen(args, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=errfile)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+      errfile.seek(0)
+      raise subprocess.CalledProcessError(process.returncode, args, stderr=errfile.read()[-4000:])
+  return elapsed, peak_rss_mb(rusage)
+
+# Runs every stage over an inventory of num_rows rows, returning {stage name: result dict}.
+def run_size(num_rows, work_dir, distinct_parts, stream, crawl_backend='html'):
+  inventory_dir = os.path.join(work_dir, str(num_rows))
+  pages_dir = write_inventory(inventory_dir, num_rows, distinct_parts)
+
+  server = start_stub_server(fixtures_dir=pages_dir)
+  env = dict(os.environ,
+             DIGIKEY_BACKEND=crawl_backend,
+             DIGIKEY_URL_PREFIX=server.url_prefix(),
+             DIGIKEY_BATCH_URL=server.batch_url(),
+             DIGIKEY_CRAWL_RPS='0',
+             DIGIKEY_CRAWL_CONNECTIONS='8',
+             DIGIKEY_CRAWL_CACHE=os.path.join(inventory_dir, 'crawlcache.sqlite'))
+  results = {}
+  try:
+    for name, script, input, output in STAGES:
+      args = [sys.executable, os.path.join(REPO_DIR, 'pipeline.py'), '-i', input, '-o', output,
+              os.path.join(REPO_DIR, script)]
+      if stream:
+        args.insert(2, '--stream')
+      requests_before = server.stats['requests']
+      elapsed, peak_mb = run_measured(args, env, inventory_dir)
+      results[name] = {
+        'rows': num_rows,
+        'seconds': elapsed,
+        'rows_per_sec': num_rows / elapsed,
+        'peak_rss_mb': peak_mb,
+        'requests': server.stats['requests'] - requests_before,
+      }
+  finally:
+    server.shutdown()
+    server.server_close()
+  return results
+
+def result_key(name, num_rows):
+  return '%s/%i' % (name, num_rows)
+
+# Returns (regressions, reported) lists of descriptions, comparing results against baseline results
+# (both as {result key: result dict}); reported are those of stages too short to gate on.
+def find_regressions(results, baseline, tolerance):
+  regressions = []
+  reported = []
+  for key, result in results.items():
+    if key not in baseline:
+      continue
+    expected = baseline[key]
+    found = regressions if expected['seconds'] >= MIN_GATED_SECONDS else reported
+    if result['rows_per_sec'] < expected['rows_per_sec'] * (1 - tolerance):
+      found.append("%s: %.0f rows/s, baseline %.0f rows/s" % (key, result['rows_per_sec'], expected['rows_per_sec']))
+    if result['peak_rss_mb'] > expected['peak_rss_mb'] * (1 + tolerance):
+      found.append("%s: %.1f MB peak, baseline %.1f MB" % (key, result['peak_rss_mb'], expected['peak_rss_mb']))
+  return regressions, reported
+
+def main():
+  parser = argparse.ArgumentParser(description="annotator benchmark suite")
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                      help="Inventory row counts to benchmark")
+  parser.add_argument('--distinct-parts', type=int, default=DEFAULT_DISTINCT_PARTS,
+                      help="Number of distinct Digikey part numbers (and product pages) per inventory")
+  parser.add_argument('--stream', action='store_true',
+                      help="Run the stages with --stream")
+  parser.add_argument('--crawl-backend', choices=['html', 'json'], default='html',
+                      help="Crawler backend (DIGIKEY_BACKEND): product pages, or batched JSON details")
+  parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                      help="Baseline results file")
+  parser.add_argument('--save-baseline', action='store_true',
+                      help="Write the results to the baseline file instead of comparing against it")
+  parser.add_argument('--tolerance', type=float, default=0.3,
+                      help="Allowed fractional drop in throughput / growth in peak memory")
+  parser.add_argument('--output', default=None,
+                      help="Also write the results as JSON to this file")
+  parser.add_argument('--keep', default=None,
+                      help="Generate the inventories in this directory and keep them")
+  args = parser.parse_args()
+
+  work_dir = args.keep or tempfile.mkdtemp(prefix='labels_benchmark_')
+  results = {}
+  try:
+    print("%-16s %10s %10s %12s %10s %9s" % ('stage', 'rows', 'time (s)', 'rows/s', 'peak MB', 'requests'))
+    for num_rows in args.sizes:
+      for name, result in run_size(num_rows, work_dir, args.distinct_parts, args.stream,
+                                       args.crawl_backend).items():
+        results[result_key(name, num_rows)] = result
+        print("%-16s %10i %10.2f %12.0f %10.1f %9i" % (name, num_rows, result['seconds'], result['rows_per_sec'],
+                                                       result['peak_rss_mb'], result['requests']))
+  finally:
+    if not args.keep:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  report = {
+    'machine': platform.platform(),
+    'python': platform.python_version(),
+    'stream': args.stream,
+    'crawl_backend': args.crawl_backend,
+    'results': results,
+  }
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(report, output_file, indent=2, sort_keys=True)
+
+  if args.save_baseline:
+    with open(args.baseline, 'w') as baseline_file:
+      json.dump(report, baseline_file, indent=2, sort_keys=True)
+    print("Saved baseline to %s" % args.baseline)
+    return
+
+  if not os.path.exists(args.baseline):
+    print("No baseline at %s, run with --save-baseline to record one" % args.baseline)
+    return
+  with open(args.baseline) as baseline_file:
+    baseline = json.load(baseline_file)
+  if baseline.get('stream', False) != args.stream:
+    print("Baseline was recorded with stream=%s, not comparing" % baseline.get('stream', False))
+    return
+  if baseline.get('crawl_backend', 'html') != args.crawl_backend:
+    print("Baseline was recorded with the %s crawl backend, not comparing" % baseline.get('crawl_backend', 'html'))
+    return
+  regressions, reported = find_regressions(results, baseline['results'], args.tolerance)
+  for regression in reported:
+    print("Slower (under %.1f s in the baseline, not gated) %s" % (MIN_GATED_SECONDS, regression))
+  for regression in regressions:
+    print("REGRESSION %s" % regression)
+  if regressions:
+    sys.exit(1)
+  print("No regressions against %s (tolerance %i%%)" % (args.baseline, args.tolerance * 100))
+
+if __name__ == '__main__':
+  main()
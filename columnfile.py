@@ -0,0 +1,281 @@
+import array
+import csv
+import json
+import mmap
+import struct
+import sys
+import zlib
+
+from contextlib import contextmanager
+
+# A compact binary column-oriented file format for the intermediate datasets passed between
+# annotator runs, which skips the CSV quoting and parsing of every field on each hop. Source data
+# and final outputs stay CSV; load() (via read_csv) detects the format of its input from the file.
+#
+# Layout: MAGIC, the column blocks of each row group, a JSON footer, the footer length (uint64),
+# then MAGIC again. The footer holds the header, the row count, the compression, and for each row
+# group its number of rows and the (offset, length, encoding, dictionary size) of each column block.
+# Row groups hold up to COLUMNFILE_GROUP_ROWS rows, so files can be written and streamed a row group
+# at a time. A column block is either
+#   plain: the (uint32) character end offsets of each value, followed by the values as UTF-8
+#   dict: the end offsets of each distinct value, the distinct values as UTF-8, then the (uint32)
+#     index of each value into the distinct values, for columns with many repeated values
+# and the whole block may be zlib compressed. Files are memory-mapped for reading, so a row group
+# is only read in when it is decoded.
+
+MAGIC = b'LBLCOLS1'
+TRAILER = struct.Struct('<Q8s')
+
+COLUMNFILE_GROUP_ROWS = 65536
+
+# Columns with at most this fraction of distinct values in a row group are dictionary encoded.
+DICT_MAX_DISTINCT_FRACTION = 0.5
+
+COMPRESSIONS = [None, 'zlib']
+ZLIB_LEVEL = 3
+
+OUTPUT_FORMATS = ['csv', 'columns']
+
+# Format and compression of the files written by the collections' write().
+output_format = 'csv'
+output_compression = None
+
+def _offsets_array(values):
+  offsets = array.array('I')
+  end = 0
+  for value in values:
+    end += len(value)
+    offsets.append(end)
+  return offsets
+
+def _array_bytes(values):
+  if sys.byteorder != 'little':
+    values = array.array(values.typecode, values)
+    values.byteswap()
+  return values.tobytes()
+
+def _bytes_array(typecode, data):
+  values = array.array(typecode)
+  values.frombytes(data)
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values
+
+# Returns the values split out of a block's text by character end offsets.
+def _split_values(text, offsets):
+  values = []
+  start = 0
+  for end in offsets:
+    values.append(text[start:end])
+    start = end
+  return values
+
+# Returns a column's values as strings, the way the csv module writes them (None as '').
+def _string_values(values):
+  if all(type(value) is str for value in values):
+    return values
+  return ['' if value is None else str(value) for value in values]
+
+# Returns (encoding, dictionary size, block bytes) for a column of values in a row group. Values
+# which are not strings are written as csv would write them.
+def encode_column(values):
+  values = _string_values(values)
+  distinct = {}
+  for value in values:
+    if value not in distinct:
+      distinct[value] = len(distinct)
+      if len(distinct) > len(values) * DICT_MAX_DISTINCT_FRACTION:
+        break
+  else:
+    if values:
+      indices = array.array('I', [distinct[value] for value in values])
+      return 'dict', len(distinct), (_array_bytes(_offsets_array(distinct)) + ''.join(distinct).encode('utf-8') +
+                                     _array_bytes(indices))
+  return 'plain', None, _array_bytes(_offsets_array(values)) + ''.join(values).encode('utf-8')
+
+# Returns the list of values of a column block of num_rows values.
+def decode_column(block, encoding, dict_size, num_rows):
+  if encoding == 'plain':
+    offsets = _bytes_array('I', block[:4 * num_rows])
+    return _split_values(bytes(block[4 * num_rows:]).decode('utf-8'), offsets)
+  assert encoding == 'dict', "unknown column encoding '%s'" % encoding
+  offsets = _bytes_array('I', block[:4 * dict_size])
+  text_end = len(block) - 4 * num_rows
+  distinct = _split_values(bytes(block[4 * dict_size:text_end]).decode('utf-8'), offsets)
+  return [distinct[index] for index in _bytes_array('I', block[text_end:])]
+
+# Writes rows to a column file, buffering a row group at a time. Use as a context manager, or call
+# close() to write the footer.
+class ColumnFileWriter:
+  def __init__(self, filename, header, compression=None, group_rows=COLUMNFILE_GROUP_ROWS):
+    assert compression in COMPRESSIONS, "unknown compression '%s', expected one of %s" % (compression, COMPRESSIONS)
+    self.header = list(header)
+    self.compression = compression
+    self.group_rows = group_rows
+    self.outfile = open(filename, 'wb')
+    self.outfile.write(MAGIC)
+    self.buffer = []
+    self.groups = []  # footer entry of each row group written
+    self.num_rows = 0
+
+  def writerow(self, row):
+    self.buffer.append(row)
+    if len(self.buffer) >= self.group_rows:
+      self._write_group()
+
+  def writerows(self, rows):
+    for row in rows:
+      self.writerow(row)
+
+  # Writes a row group given as a list of columns, flushing buffered rows first.
+  def write_columns(self, columns):
+    self._write_group()
+    num_rows = len(columns[0]) if columns else 0
+    for start in range(0, num_rows, self.group_rows):
+      self._write_columns([column[start:start + self.group_rows] for column in columns])
+
+  def _write_group(self):
+    if not self.buffer:
+      return
+    width = len(self.header)
+    columns = [[] for _ in range(width)]
+    for row in self.buffer:
+      assert len(row) == width, "row %s does not match header %s" % (row, self.header)
+      for column, value in zip(columns, row):
+        column.append(value)
+    self.buffer = []
+    self._write_columns(columns)
+
+  def _write_columns(self, columns):
+    num_rows = len(columns[0]) if columns else 0
+    blocks = []
+    for values in columns:
+      encoding, dict_size, block = encode_column(values)
+      if self.compression == 'zlib':
+        block = zlib.compress(block, ZLIB_LEVEL)
+      blocks.append([self.outfile.tell(), len(block), encoding, dict_size])
+      self.outfile.write(block)
+    self.groups.append({'rows': num_rows, 'columns': blocks})
+    self.num_rows += num_rows
+
+  def close(self):
+    self._write_group()
+    footer = json.dumps({'header': self.header, 'rows': self.num_rows, 'compression': self.compression,
+                         'groups': self.groups}, ensure_ascii=False).encode('utf-8')
+    self.outfile.write(footer)
+    self.outfile.write(TRAILER.pack(len(footer), MAGIC))
+    self.outfile.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.outfile.close()
+
+# Returns whether a file is a column file, by its leading magic.
+def is_column_file(filename):
+  with open(filename, 'rb') as infile:
+    return infile.read(len(MAGIC)) == MAGIC
+
+# Reads a column file. Row groups are decoded on demand from the memory-mapped file; use as a
+# context manager, or call close() once done.
+class ColumnFileReader:
+  def __init__(self, filename):
+    self.file = open(filename, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    footer_len, magic = TRAILER.unpack(self.map[-TRAILER.size:])
+    assert self.map[:len(MAGIC)] == MAGIC and magic == MAGIC, "'%s' is not a column file" % filename
+    footer_end = len(self.map) - TRAILER.size
+    footer = json.loads(self.map[footer_end - footer_len:footer_end].decode('utf-8'))
+    self.header = footer['header']
+    self.num_rows = footer['rows']
+    self.compression = footer['compression']
+    self.groups = footer['groups']
+
+  def __len__(self):
+    return self.num_rows
+
+  # Returns the columns of the i-th row group, as a list of lists of values. If names is passed,
+  # only those columns are decoded (in that order).
+  def group_columns(self, i, names=None):
+    group = self.groups[i]
+    indices = range(len(self.header)) if names is None else [self.header.index(name) for name in names]
+    columns = []
+    view = memoryview(self.map)
+    try:
+      for index in indices:
+        offset, length, encoding, dict_size = group['columns'][index]
+        block = view[offset:offset + length]
+        if self.compression == 'zlib':
+          block = zlib.decompress(block)
+        columns.append(decode_column(block, encoding, dict_size, group['rows']))
+        del block
+    finally:
+      view.release()
+    return columns
+
+  # Returns every row as a list of columns, each a list of values.
+  def columns(self):
+    columns = [[] for _ in self.header]
+    for i in range(len(self.groups)):
+      for column, group_column in zip(columns, self.group_columns(i)):
+        column.extend(group_column)
+    return columns
+
+  # Generator over the rows, as lists of values, decoding one row group at a time.
+  def rows(self):
+    for i in range(len(self.groups)):
+      for row in zip(*self.group_columns(i)):
+        yield list(row)
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+# Opens outname for writing rows under header in the configured output format, as a context manager
+# giving a writer with writerow and writerows (a csv.writer or a ColumnFileWriter).
+@contextmanager
+def open_output(outname, header):
+  if output_format == 'columns':
+    with ColumnFileWriter(outname, header, output_compression) as output_writer:
+      yield output_writer
+    return
+  with open(outname, 'w', newline='', encoding='utf-8') as outfile:
+    output_writer = csv.writer(outfile, delimiter=',')
+    output_writer.writerow(header)
+    yield output_writer
+
+# Adds the output format options to an argument parser.
+def add_format_args(parser):
+  parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv',
+                      help="Output file format; 'columns' is a binary format for intermediate files, "
+                           "which load() reads back like CSV")
+  parser.add_argument('--output-compression', choices=['none', 'zlib'], default='none',
+                      help="Compression of 'columns' output files")
+
+# Sets the output format from the options from add_format_args.
+def format_from_args(args):
+  global output_format, output_compression
+  output_format = args.output_format
+  output_compression = args.output_compression if args.output_compression != 'none' else None
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description="column file to CSV converter, for inspecting intermediate files")
+  parser.add_argument('input', help="Column file")
+  parser.add_argument('output', help="Output CSV file")
+  args = parser.parse_args()
+
+  with ColumnFileReader(args.input) as reader, open(args.output, 'w', newline='', encoding='utf-8') as outfile:
+    output_writer = csv.writer(outfile, delimiter=',')
+    output_writer.writerow(reader.header)
+    output_writer.writerows(reader.rows())
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+# A persistent cache of parsed distributor parametrics, keyed by part number, in a single SQLite
+# file which every dataset (and every process) in a build shares.
+# Entries expire after a TTL, are invalidated when the parser which produced them changes version,
+# and the least recently used entries are evicted to keep the cache under a size budget.
+
+DAY_SECONDS = 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parametrics (
+  part_number TEXT PRIMARY KEY,
+  parser_version INTEGER NOT NULL,
+  fetched REAL NOT NULL,
+  last_used REAL NOT NULL,
+  size INTEGER NOT NULL,
+  data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parametrics_last_used ON parametrics (last_used);
+"""
+
+# Number of cache hits whose recency is buffered before it is written to the cache file.
+CRAWL_CACHE_FLUSH_HITS = 1000
+
+class ParametricsCache:
+  # parser_version: entries written with a different version are treated as missing.
+  # ttl_days: entries older than this are treated as missing.
+  # max_bytes: the least recently used entries are evicted when the stored data exceeds this.
+  # read_only: open without writing (lookups do not update recency), for example for workers sharing
+  #   a cache populated beforehand.
+  # base: another (typically read only) cache looked up for entries missing from this one, for
+  #   example a cache shared by the workers of a sharded run, each writing new entries to its own.
+  def __init__(self, path, parser_version, ttl_days=30, max_bytes=64*1024*1024, read_only=False, base=None):
+    self.path = path
+    self.base = base
+    self.parser_version = parser_version
+    self.ttl = ttl_days * DAY_SECONDS
+    self.max_bytes = max_bytes
+    self.read_only = read_only
+    self.lock = threading.Lock()
+    if read_only:
+      # As a URI, so characters like '?', '#' and '%' in the path are escaped.
+      uri = pathlib.Path(os.path.abspath(path)).as_uri() + '?mode=ro'
+      self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    else:
+      self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+      self.db.execute("PRAGMA journal_mode=WAL")  # readers in other processes don't block writers
+      self.db.execute("PRAGMA synchronous=NORMAL")  # losing the latest entries on a crash is fine
+      self.db.executescript(SCHEMA)
+      self.db.commit()
+    self.total_size = self._stored_size()
+    self.used = []  # part numbers looked up since the last flush, whose recency is updated then
+    self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evicted': 0}
+
+  # Returns the cached parametrics dict for part_number, or None if missing, expired or stale.
+  def get(self, part_number):
+    with self.lock:
+      row = self.db.execute("SELECT parser_version, fetched, data FROM parametrics WHERE part_number = ?",
+                            (part_number,)).fetchone()
+      now = time.time()
+      data = None
+      if row is None:
+        self.stats['misses'] += 1
+      elif row[0] != self.parser_version or now - row[1] > self.ttl:
+        self.stats['stale'] += 1
+      else:
+        data = row[2]
+        self.stats['hits'] += 1
+        if not self.read_only:
+          self.used.append(part_number)
+          if len(self.used) >= CRAWL_CACHE_FLUSH_HITS:
+            self._flush_used()
+
+    if data is None:
+      return self.base.get(part_number) if self.base is not None else None
+    return json.loads(data)
+
+  def put(self, part_number, parametrics):
+    if self.read_only:
+      return
+    data = json.dumps(parametrics, ensure_ascii=False)
+    now = time.time()
+    with self.lock:
+      row = self.db.execute("SELECT size FROM parametrics WHERE part_number = ?", (part_number,)).fetchone()
+      self.db.execute("INSERT OR REPLACE INTO parametrics VALUES (?, ?, ?, ?, ?, ?)",
+                      (part_number, self.parser_version, now, now, len(data), data))
+      self.total_size += len(data) - (row[0] if row else 0)
+      if self.total_size > self.max_bytes:
+        self._evict()
+      self.db.commit()
+
+  # Writes out the recency of the entries looked up since the last flush.
+  def _flush_used(self):
+    now = time.time()
+    self.db.executemany("UPDATE parametrics SET last_used = ? WHERE part_number = ?",
+                        [(now, part_number) for part_number in self.used])
+    self.db.commit()
+    self.used = []
+
+  def _stored_size(self):
+    return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM parametrics").fetchone()[0]
+
+  # Deletes least recently used entries until the total size is within max_bytes.
+  def _evict(self):
+    if self.used:
+      self._flush_used()  # so entries looked up since the last flush are not evicted first
+    self.total_size = self._stored_size()  # other processes may have written since
+    if self.total_size <= self.max_bytes:
+      return
+    for part_number, size in self.db.execute("SELECT part_number, size FROM parametrics ORDER BY last_used").fetchall():
+      self.db.execute("DELETE FROM parametrics WHERE part_number = ?", (part_number,))
+      self.stats['evicted'] += 1
+      self.total_size -= size
+      if self.total_size <= self.max_bytes:
+        break
+
+  # Returns (number of entries, total data size, number of stale or expired entries).
+  def summary(self):
+    with self.lock:
+      entries, total_size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM parametrics").fetchone()
+      stale, = self.db.execute("SELECT COUNT(*) FROM parametrics WHERE parser_version != ? OR fetched < ?",
+                               (self.parser_version, time.time() - self.ttl)).fetchone()
+    return entries, total_size, stale
+
+  # Copies in the entries of another cache file (like one written by a shard worker) which are
+  # missing here or were fetched later than the entry here.
+  def merge(self, path):
+    with self.lock:
+      self.db.execute("ATTACH DATABASE ? AS other", (path,))
+      self.db.execute("INSERT OR REPLACE INTO parametrics SELECT other_entry.* FROM other.parametrics other_entry "
+                      "LEFT JOIN parametrics entry ON entry.part_number = other_entry.part_number "
+                      "WHERE entry.part_number IS NULL OR other_entry.fetched > entry.fetched")
+      self.db.commit()
+      self.db.execute("DETACH DATABASE other")
+      self.total_size = self._stored_size()
+      if self.total_size > self.max_bytes:
+        self._evict()
+        self.db.commit()
+
+  # Deletes stale and expired entries.
+  def purge(self):
+    with self.lock:
+      self.db.execute("DELETE FROM parametrics WHERE parser_version != ? OR fetched < ?",
+                      (self.parser_version, time.time() - self.ttl))
+      self.db.commit()
+      self.db.execute("VACUUM")
+      self.total_size = self._stored_size()
+
+  # Writes out pending recency updates and closes the cache file.
+  def close(self):
+    with self.lock:
+      if self.used:
+        self._flush_used()
+      self.db.close()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="parametrics crawl cache maintenance")
+  parser.add_argument('path', help="Cache file")
+  parser.add_argument('--parser-version', type=int, required=True,
+                      help="Current parser version; entries from other versions count as stale")
+  parser.add_argument('--ttl-days', type=float, default=30)
+  parser.add_argument('--purge', action='store_true',
+                      help="Delete stale and expired entries")
+  parser.add_argument('--merge', nargs='+', default=[], metavar='CACHE',
+                      help="Copy in newer entries from other cache files, like those of shard workers")
+  args = parser.parse_args()
+
+  cache = ParametricsCache(args.path, args.parser_version, ttl_days=args.ttl_days)
+  for other_path in args.merge:
+    cache.merge(other_path)
+  if args.purge:
+    cache.purge()
+  entries, total_size, stale = cache.summary()
+  print("%i entries, %i bytes, %i stale or expired" % (entries, total_size, stale))
+  cache.close()
@@ -0,0 +1,167 @@
+import gzip
+import http.client
+import random
+import threading
+import time
+import zlib
+
+from urllib.parse import urljoin, urlsplit
+
+# A thread-safe HTTP fetcher for crawling many pages from the same site concurrently: connections
+# are kept alive and reused through a per-host pool, requests are capped both in rate and in number
+# in flight, and transient failures are retried with exponential backoff.
+# Intended to be called from the worker threads of a parallel map_append.
+
+# Status codes which are worth retrying.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+# Raised when a page could not be fetched, after retries.
+class CrawlError(Exception):
+  pass
+
+# Spaces out calls to wait() so they happen at most requests_per_second times per second
+# (across all threads). A rate of None or 0 disables limiting.
+class RateLimiter:
+  def __init__(self, requests_per_second):
+    self.interval = 1.0 / requests_per_second if requests_per_second else 0
+    self.next_time = 0
+    self.lock = threading.Lock()
+
+  def wait(self):
+    if not self.interval:
+      return
+    with self.lock:
+      now = time.monotonic()
+      slot = max(now, self.next_time)
+      self.next_time = slot + self.interval
+    if slot > now:
+      time.sleep(slot - now)
+
+# Pool of idle keep-alive connections, by (scheme, host:port).
+class ConnectionPool:
+  def __init__(self, timeout):
+    self.timeout = timeout
+    self.idle = {}
+    self.lock = threading.Lock()
+
+  def acquire(self, scheme, netloc):
+    with self.lock:
+      connections = self.idle.get((scheme, netloc))
+      if connections:
+        return connections.pop()
+    if scheme == 'https':
+      return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+    else:
+      return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+  def release(self, scheme, netloc, connection):
+    with self.lock:
+      self.idle.setdefault((scheme, netloc), []).append(connection)
+
+  def close(self):
+    with self.lock:
+      for connections in self.idle.values():
+        for connection in connections:
+          connection.close()
+      self.idle = {}
+
+class CrawlEngine:
+  # max_in_flight: maximum number of requests outstanding at once.
+  # requests_per_second: maximum request rate, including retries and redirects.
+  # max_retries, backoff: a request failing with a connection error or a RETRY_STATUSES response is
+  #   retried up to max_retries times, waiting backoff * 2^attempt seconds (plus jitter) in between,
+  #   or as long as the server asks for with Retry-After.
+  def __init__(self, max_in_flight=8, requests_per_second=4.0, max_retries=3, backoff=1.0,
+               timeout=30, headers=None):
+    self.max_in_flight = max_in_flight
+    self.in_flight = threading.BoundedSemaphore(max_in_flight)
+    self.rate_limiter = RateLimiter(requests_per_second)
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.headers = dict(headers or {})
+    self.headers.setdefault('accept-encoding', 'gzip, deflate')
+    self.pool = ConnectionPool(timeout)
+    self.stats_lock = threading.Lock()
+    self.stats = {'requests': 0, 'retries': 0, 'connections': 0}
+
+  def _count(self, stat):
+    with self.stats_lock:
+      self.stats[stat] += 1
+
+  # Makes a single request on a pooled connection, returning (status, response, body).
+  def _request(self, url):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+      path += '?' + parts.query
+
+    self.rate_limiter.wait()
+    self._count('requests')
+    connection = self.pool.acquire(parts.scheme, parts.netloc)
+    reused = connection.sock is not None
+    while True:
+      if connection.sock is None:
+        self._count('connections')
+      try:
+        connection.request('GET', path, headers=self.headers)
+        response = connection.getresponse()
+        body = response.read()
+        break
+      except (OSError, http.client.HTTPException):
+        connection.close()
+        if not reused:
+          raise
+        # The server may have dropped the idle keep-alive connection, try again on a fresh one.
+        reused = False
+
+    if response.will_close:
+      connection.close()
+    else:
+      self.pool.release(parts.scheme, parts.netloc, connection)
+
+    encoding = response.getheader('content-encoding', '').lower()
+    if encoding == 'gzip':
+      body = gzip.decompress(body)
+    elif encoding == 'deflate':
+      body = zlib.decompress(body)
+    return response.status, response, body
+
+  # Returns the body of the page at url (following redirects) as bytes.
+  def fetch(self, url):
+    with self.in_flight:
+      return self._fetch_redirects(url)
+
+  def _fetch_redirects(self, url):
+    for _ in range(MAX_REDIRECTS + 1):
+      status, response, body = self._fetch_retry(url)
+      if status in REDIRECT_STATUSES and response.getheader('location'):
+        url = urljoin(url, response.getheader('location'))
+      elif status >= 400:
+        raise CrawlError("HTTP %i fetching %s" % (status, url))
+      else:
+        return body
+    raise CrawlError("too many redirects fetching %s" % url)
+
+  def _fetch_retry(self, url):
+    for attempt in range(self.max_retries + 1):
+      delay = self.backoff * (2 ** attempt) * (1 + random.random())
+      try:
+        status, response, body = self._request(url)
+        if status not in RETRY_STATUSES:
+          return status, response, body
+        error = "HTTP %i" % status
+        retry_after = response.getheader('retry-after')
+        if retry_after and retry_after.isdigit():
+          delay = max(delay, int(retry_after))
+      except (OSError, http.client.HTTPException) as e:
+        error = repr(e)
+
+      if attempt < self.max_retries:
+        self._count('retries')
+        time.sleep(delay)
+    raise CrawlError("%s fetching %s (after %i retries)" % (error, url, self.max_retries))
+
+  def close(self):
+    self.pool.close()
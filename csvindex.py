@@ -0,0 +1,177 @@
+import csv
+import io
+import mmap
+import os
+import sqlite3
+
+# Random access into large CSV files by key columns, for tools that only need a few rows (like
+# reprinting one drawer's labels) out of a whole inventory. The byte offset and length of every
+# record is indexed by the values of the chosen key columns in a sidecar SQLite file (FILE.csvindex),
+# so point and range lookups only read and parse the matching records, from the memory-mapped CSV.
+# The index is built on first use, and rebuilt whenever the CSV changes (by size and modification
+# time) or another key column is asked for.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+  name TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+  column INTEGER NOT NULL,
+  key TEXT NOT NULL,
+  offset INTEGER NOT NULL,
+  length INTEGER NOT NULL,
+  PRIMARY KEY (column, key, offset)
+) WITHOUT ROWID;
+"""
+
+# Number of records inserted per statement batch while building an index.
+INDEX_BUILD_BATCH_RECORDS = 10000
+
+def index_filename(filename):
+  return filename + '.csvindex'
+
+# Returns the (size, modification time) identifying a version of a file.
+def file_version(filename):
+  stat = os.stat(filename)
+  return '%i:%i' % (stat.st_size, stat.st_mtime_ns)
+
+# Wraps a binary file as an iterator over its decoded lines, tracking the byte offset of the end of
+# the last line read. csv.reader only reads the lines of the record it is parsing, so after it
+# returns a record, offset is the end of that record.
+class OffsetLines:
+  def __init__(self, infile):
+    self.infile = infile
+    self.offset = infile.tell()
+
+  def __iter__(self):
+    for line in self.infile:
+      self.offset += len(line)
+      yield line.decode('utf-8')
+
+# Generator over (offset, length, row) of each record of an open binary CSV file, after the header.
+def csv_records(infile):
+  lines = OffsetLines(infile)
+  reader = csv.reader(lines, delimiter=',')
+  next(reader)
+  start = lines.offset
+  for row in reader:
+    yield start, lines.offset - start, row
+    start = lines.offset
+
+# Returns the row of a CSV record.
+def parse_record(record_bytes):
+  return next(csv.reader(io.StringIO(record_bytes.decode('utf-8'), newline=''), delimiter=','))
+
+class CsvIndex:
+  # columns: the key columns to index, in addition to any already in the index file.
+  def __init__(self, filename, columns, index_file=None):
+    self.filename = filename
+    self.index_file = index_file or index_filename(filename)
+    with open(filename, 'r', newline='', encoding='utf-8') as infile:
+      self.header = next(csv.reader(infile, delimiter=','))
+    for column in columns:
+      assert column in self.header, "no column '%s' in %s, columns are %s" % (column, filename, self.header)
+
+    self.db = sqlite3.connect(self.index_file, timeout=30)
+    self.db.executescript(SCHEMA)
+    meta = dict(self.db.execute("SELECT name, value FROM meta"))
+    indexed = meta.get('columns', '').split('\x1f') if meta.get('columns') else []
+    if meta.get('version') != file_version(filename) or meta.get('header') != '\x1f'.join(self.header) or \
+        not set(columns) <= set(indexed):
+      self.build(sorted(set(columns) | (set(indexed) & set(self.header))))
+
+  # (Re)builds the index over the given key columns.
+  def build(self, columns):
+    version = file_version(self.filename)
+    column_indices = [self.header.index(column) for column in columns]
+    with self.db:
+      self.db.execute("DELETE FROM records")
+      self.db.execute("DELETE FROM meta")
+      with open(self.filename, 'rb') as infile:
+        batch = []
+        for offset, length, row in csv_records(infile):
+          for column_index in column_indices:
+            batch.append((column_index, row[column_index] if column_index < len(row) else '', offset, length))
+          if len(batch) >= INDEX_BUILD_BATCH_RECORDS:
+            self.db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", batch)
+            batch = []
+        self.db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", batch)
+      self.db.executemany("INSERT INTO meta VALUES (?, ?)",
+                          [('version', version), ('header', '\x1f'.join(self.header)),
+                           ('columns', '\x1f'.join(columns))])
+
+  # Returns the (offset, length) of the records with a column value equal to low, or between low
+  # and high (inclusive, in string order) if high is passed, in file order.
+  def spans(self, column, low, high=None):
+    if high is None:
+      high = low
+    return self.db.execute("SELECT offset, length FROM records WHERE column = ? AND key BETWEEN ? AND ? "
+                           "ORDER BY offset", (self.header.index(column), low, high)).fetchall()
+
+  # Returns the (offset, length) of the records matching every (column, low, high) condition of
+  # where (see spans), in file order.
+  def select(self, where):
+    matching = None
+    for column, low, high in where:
+      spans = set(self.spans(column, low, high))
+      matching = spans if matching is None else matching & spans
+    return sorted(matching or ())
+
+  # Generator over the rows of the records at spans, read from the memory-mapped file.
+  def read_rows(self, spans):
+    if not spans:
+      return
+    with open(self.filename, 'rb') as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as source:
+      for offset, length in spans:
+        yield parse_record(source[offset:offset + length])
+
+  def close(self):
+    self.db.close()
+
+# Parses a --where condition, COLUMN=VALUE or COLUMN=LOW..HIGH, into (column, low, high).
+def parse_where(condition):
+  column, sep, value = condition.partition('=')
+  assert sep and column, "bad condition '%s', expected COLUMN=VALUE or COLUMN=LOW..HIGH" % condition
+  low, sep, high = value.partition('..')
+  return column, low, high if sep else low
+
+# Returns a filter function of row dicts for a list of (column, low, high) conditions.
+def where_filter(where):
+  def filter_fn(row_dict):
+    return all(low <= row_dict[column] <= high for (column, low, high) in where)
+  filter_fn.reads = [column for (column, low, high) in where]
+  return filter_fn
+
+# Returns the header and rows of a CSV file matching every (column, low, high) condition of where,
+# in file order, reading only those records through a CsvIndex on the condition columns.
+def select_rows(filename, where):
+  index = CsvIndex(filename, [column for (column, low, high) in where])
+  try:
+    return index.header, list(index.read_rows(index.select(where)))
+  finally:
+    index.close()
+
+# Adds the row selection option to an argument parser.
+def add_where_args(parser):
+  parser.add_argument('--where', action='append', default=[], metavar='COLUMN=VALUE',
+                      help="Only read rows where COLUMN is VALUE, or between LOW and HIGH for "
+                           "COLUMN=LOW..HIGH, looked up through an index of the input (FILE.csvindex). "
+                           "Can be repeated, selecting rows matching every condition")
+
+# Returns the list of (column, low, high) conditions from the options from add_where_args.
+def where_from_args(args):
+  return [parse_where(condition) for condition in args.where]
+
+if __name__ == '__main__':
+  import argparse
+  import sys
+  parser = argparse.ArgumentParser(description="indexed CSV lookup, writing matching rows as CSV to stdout")
+  parser.add_argument('input', help="Input CSV file")
+  add_where_args(parser)
+  args = parser.parse_args()
+
+  header, rows = select_rows(args.input, where_from_args(args))
+  output_writer = csv.writer(sys.stdout, delimiter=',')
+  output_writer.writerow(header)
+  output_writer.writerows(rows)
@@ -0,0 +1,192 @@
+import re
+
+from html.parser import HTMLParser
+
+# Extraction of part parametrics from Digikey product pages. All the data comes from two tables,
+# product-overview and product-attribute-table, which hold one parametric per row (header in a
+# th, value in a td).
+
+PRODUCT_TABLE_IDS = ['product-overview', 'product-attribute-table']
+PARAMETRICS_BLACKLIST = ['Quantity Available']
+HEADER_CONTINUE = ['Categories']
+
+# Builds the parametrics dict from the (header text, value text) of each table row, where either
+# may be None if the row has no th / td.
+def parametrics_from_rows(rows):
+  elements = {}
+  last_header = None
+  for header, value in rows:
+    if value is None:
+      continue
+
+    if header is None and last_header in HEADER_CONTINUE:
+      header = last_header
+    elif header is not None:
+      last_header = header
+
+    if header not in PARAMETRICS_BLACKLIST:
+      elements[header] = value
+
+  return elements
+
+def parse_digikey_table(soup_table):
+  rows = []
+  for row in soup_table.find_all('tr'):
+    header = row.find('th')
+    value = row.find('td')
+    rows.append((header.get_text().strip() if header is not None else None,
+                 value.get_text().strip() if value is not None else None))
+  return parametrics_from_rows(rows)
+
+# Reference extraction: cleans up the whole page and builds a complete BeautifulSoup tree from it.
+def soup_parametrics(content):
+  from bs4 import BeautifulSoup
+
+  # The part attributes table has a hanging </a> tag. Fail...
+  content = re.sub(r'</a>', '', content)
+  content = re.sub(r'<a[^>]*>', '', content)
+  content = content.replace('&nbsp;', '')
+  content = content.replace('\n', '')
+  content = content.replace('\t', '')
+
+  soup = BeautifulSoup(content, 'html.parser')
+
+  parametrics = {}
+  for table_id in PRODUCT_TABLE_IDS:
+    parametrics.update(parse_digikey_table(soup.find('table', id=table_id)))
+  return parametrics
+
+# Fast extraction, giving the same results as soup_parametrics: locates each table in the raw page,
+# applies the same clean-up to just that table's markup, and runs it through a streaming parser
+# which only keeps the first th and td text of each row.
+
+TABLE_TAG_RE = re.compile(r'<(/?)table\b', re.IGNORECASE)
+RAW_TEXT_SPANS = [('<script', '</script'), ('<style', '</style'), ('<!--', '-->')]
+# Elements which never have content, as treated by BeautifulSoup.
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+                 'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound',
+                 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'}
+
+def _table_start_re(table_id):
+  return re.compile(r'<table\b[^>]*?\bid\s*=\s*["\']?%s(?=["\'\s/>])' % re.escape(table_id), re.IGNORECASE)
+
+TABLE_START_RES = {table_id: _table_start_re(table_id) for table_id in PRODUCT_TABLE_IDS}
+
+# Returns whether pos in the page is inside a script, style or comment, where tags are just text.
+def _in_raw_text(lower_content, pos):
+  for start_marker, end_marker in RAW_TEXT_SPANS:
+    start = lower_content.rfind(start_marker, 0, pos)
+    if start >= 0 and lower_content.find(end_marker, start, pos) < 0:
+      return True
+  return False
+
+# Returns the markup of the first table with the given id, up to its matching </table>.
+def _table_markup(content, lower_content, table_id):
+  for match in TABLE_START_RES[table_id].finditer(content):
+    if not _in_raw_text(lower_content, match.start()):
+      break
+  else:
+    raise ValueError("no table with id '%s'" % table_id)
+
+  depth = 0
+  for tag_match in TABLE_TAG_RE.finditer(content, match.start()):
+    depth += -1 if tag_match.group(1) else 1
+    if depth == 0:
+      end = content.find('>', tag_match.end())
+      return content[match.start():end + 1 if end >= 0 else len(content)]
+  return content[match.start():]
+
+# Open element while parsing a table: its tag name, and the text collected so far if it is the
+# first th / td of a row.
+class _OpenElement:
+  __slots__ = ('tag', 'text')
+
+  def __init__(self, tag, text):
+    self.tag = tag
+    self.text = text
+
+# Follows the open element stack the way BeautifulSoup's html.parser tree builder does, and collects
+# the text of the first th and td descendant of each tr.
+class _TableRowsParser(HTMLParser):
+  def __init__(self):
+    super().__init__(convert_charrefs=True)
+    self.stack = []
+    self.rows = []  # per tr, in document order: [th text list or None, td text list or None]
+    self.open_rows = []  # rows of the tr elements currently open, as (stack entry, row)
+    self.collecting = []  # text lists of open elements being collected
+    self.raw_depth = 0  # number of open script / style elements, whose text is ignored
+
+  def handle_starttag(self, tag, attrs):
+    text = None
+    if tag == 'tr':
+      row = [None, None]
+      self.rows.append(row)
+    elif tag in ('th', 'td'):
+      slot = 0 if tag == 'th' else 1
+      for element, open_row in self.open_rows:
+        if open_row[slot] is None:
+          if text is None:
+            text = []
+            self.collecting.append(text)
+          open_row[slot] = text
+    elif tag in ('script', 'style'):
+      self.raw_depth += 1
+
+    if tag in VOID_ELEMENTS:
+      return
+    element = _OpenElement(tag, text)
+    self.stack.append(element)
+    if tag == 'tr':
+      self.open_rows.append((element, row))
+
+  def handle_startendtag(self, tag, attrs):
+    self.handle_starttag(tag, attrs)
+    if tag not in VOID_ELEMENTS:
+      self.handle_endtag(tag)
+
+  def handle_endtag(self, tag):
+    for i in range(len(self.stack) - 1, -1, -1):
+      if self.stack[i].tag == tag:
+        break
+    else:
+      return  # stray end tag, ignored
+    for element in self.stack[i:]:
+      if element.text is not None:
+        self.collecting = [text for text in self.collecting if text is not element.text]
+      if element.tag in ('script', 'style'):
+        self.raw_depth -= 1
+      if element.tag == 'tr':
+        self.open_rows = [(open_element, row) for (open_element, row) in self.open_rows
+                          if open_element is not element]
+    del self.stack[i:]
+
+  def handle_data(self, data):
+    if self.raw_depth:
+      return
+    for text in self.collecting:
+      text.append(data)
+
+  def unknown_decl(self, data):
+    if data.startswith('CDATA['):
+      self.handle_data(data[len('CDATA['):])
+
+def _joined(text):
+  return ''.join(text).strip() if text is not None else None
+
+def extract_parametrics(content):
+  lower_content = content.lower()
+  parametrics = {}
+  for table_id in PRODUCT_TABLE_IDS:
+    markup = _table_markup(content, lower_content, table_id)
+    markup = re.sub(r'</a>', '', markup)
+    markup = re.sub(r'<a[^>]*>', '', markup)
+    markup = markup.replace('&nbsp;', '')
+    markup = markup.replace('\n', '')
+    markup = markup.replace('\t', '')
+
+    parser = _TableRowsParser()
+    parser.feed(markup)
+    parser.close()
+    parametrics.update(parametrics_from_rows([(_joined(header), _joined(value))
+                                              for header, value in parser.rows]))
+  return parametrics
@@ -1,11 +1,98 @@
 import argparse
+import ast
+import concurrent.futures
 import csv
+import functools
+import json
+import tempfile
+import traceback
 
 from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import ExitStack
+from itertools import islice, zip_longest
+from types import MappingProxyType
+
+from columnfile import ColumnFileReader, ColumnFileWriter, add_format_args, format_from_args, is_column_file, \
+    open_output
+from csvindex import add_where_args, select_rows, where_from_args, where_filter
+from labelprofiler import add_profile_args, profile_from_args, profiled
+from rowjoins import JOIN_HOWS, add_join_args, check_overlap, join_from_args, join_rows, joined_row_dicts, \
+    key_columns, key_fn, match_rows, right_index
+from spillgroups import add_groupby_args, groupby_from_args, new_group_spool
 
 # Provides a functional, lightweight abstraction over CSV files, allowing annotators to focus on
 # the data processing instead of the plumbing.
 
+# Raised when a user function fails in a parallel map_append or group_map, identifying the call
+# (row or group, by position in the collection) which raised. Arguments are plain strings so the
+# error can be passed back from worker processes.
+class RowFunctionError(Exception):
+  def __init__(self, index, description, cause_traceback):
+    super().__init__(index, description, cause_traceback)
+    self.index = index
+    self.description = description
+    self.cause_traceback = cause_traceback
+
+  def __str__(self):
+    return "%s raised:\n%s" % (self.description, self.cause_traceback)
+
+# Runs fn on a chunk of argument tuples, where indices gives the position of each call to report
+# on failure.
+def _call_chunk(fn, indices, args_chunk, describe_kind):
+  results = []
+  for index, args in zip(indices, args_chunk):
+    try:
+      results.append(fn(*args))
+    except Exception as e:
+      described_args = args[0] if len(args) == 1 else args
+      raise RowFunctionError(index, "%s %i (%s)" % (describe_kind, index, str(described_args)[:200]),
+                             traceback.format_exc()) from e
+  return results
+
+# Returns a new worker pool for map_calls: a pool of threads (backend='thread', for I/O-bound
+# functions) or processes (backend='process', for CPU-bound functions, which must then be
+# picklable module-level functions).
+def make_executor(workers, backend):
+  if backend == 'thread':
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+  elif backend == 'process':
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+  else:
+    raise ValueError("unknown backend '%s', expected 'thread' or 'process'" % backend)
+
+# Calls fn(*args) for each argument tuple in args_list and returns the list of results, in order.
+# With workers > 1, calls are split into chunks of chunk_size (by default, four chunks per worker)
+# and run on a pool from make_executor, or on executor if one is passed in.
+# A failing call raises RowFunctionError; if several fail, the earliest one is reported.
+# indices, if passed, gives the position of each call to report instead of its index in args_list.
+def map_calls(fn, args_list, workers=None, backend='thread', chunk_size=None, describe_kind='row',
+              executor=None, indices=None):
+  if not workers or workers <= 1:
+    return [fn(*args) for args in args_list]
+
+  if chunk_size is None:
+    chunk_size = max(1, -(-len(args_list) // (workers * 4)))
+  if indices is None:
+    indices = range(len(args_list))
+  starts = range(0, len(args_list), chunk_size)
+
+  def run(executor):
+    results = []
+    chunk_results = executor.map(_call_chunk,
+                                 [fn] * len(starts),
+                                 [indices[start:start+chunk_size] for start in starts],
+                                 [args_list[start:start+chunk_size] for start in starts],
+                                 [describe_kind] * len(starts))
+    for chunk_result in chunk_results:
+      results.extend(chunk_result)
+    return results
+
+  if executor is not None:
+    return run(executor)
+  with make_executor(workers, backend) as executor:
+    return run(executor)
+
 # An immutable representation of a CSV file, providing functional abstractions for data processing.
 class CsvRowCollection:
   def __init__(self, header, rows, outname):
@@ -13,32 +100,58 @@ class CsvRowCollection:
     self.rows = rows
     self.outname = outname
 
-  # Writes data out to a CSV.
+  def __len__(self):
+    return len(self.rows)
+
+  # Generator over the rows as row dicts (column header -> value).
+  def row_dicts(self):
+    for row in self.rows:
+      yield {k: v for (k, v) in zip(self.header, row)}
+
+  # Writes data out to a CSV (or a column file, see columnfile.py).
+  @profiled('write')
   def write(self):
-    with open(self.outname, 'w', newline='', encoding='utf-8') as outfile:
-      output_writer = csv.writer(outfile, delimiter=',')
-      output_writer.writerow(self.header)
-      for row in self.rows:
-        output_writer.writerow(row)
+    with open_output(self.outname, self.header) as output_writer:
+      output_writer.writerows(self.rows)
 
   # Takes a function of row dict (column header -> value) that returns a row dict of elements to
   # append. Appended column headers may not overlap with existing column headers.
   # If a OrderedDict is passed in, the order of the new header elements will be according to dict
   # order (which must be consistent across all rows), otherwise it will be alphabetical.
+  # If workers is set, fn is run in parallel on a pool of that many workers, see map_calls.
+  # fn may list the columns it reads in a reads attribute, which lets tools like the row cache
+  # (rowcache.py) only consider those columns, and set a false row_cache attribute if it is too
+  # cheap to be worth caching. It may also list the columns it appends in a writes attribute, which
+  # lets the pipeline planner (planner.py) skip it when none of those are used.
+  # Returns a new CsvRowCollection.
+  @profiled('map_append')
+  def map_append(self, fn, workers=None, backend='thread', chunk_size=None):
+    row_dicts = [{k: v for (k, v) in zip(self.header, row)} for row in self.rows]
+    append_dicts = map_calls(fn, [(row_dict,) for row_dict in row_dicts], workers, backend, chunk_size)
+    return self._appended(row_dicts, append_dicts)
+
+  # Like map_append, but fn takes a list of row dicts and returns the list of dicts to append (one
+  # per row, in the same order), so work can be shared between rows - for example grouping them by
+  # some field and processing each group in one pass. Here fn gets every row in a single call.
   # Returns a new CsvRowCollection.
-  def map_append(self, fn):
+  @profiled('map_append_batch')
+  def map_append_batch(self, fn):
+    row_dicts = [{k: v for (k, v) in zip(self.header, row)} for row in self.rows]
+    append_dicts = fn(row_dicts)
+    assert len(append_dicts) == len(row_dicts), "batch function returned %i results for %i rows" % (len(append_dicts), len(row_dicts))
+    return self._appended(row_dicts, append_dicts)
+
+  def _appended(self, row_dicts, append_dicts):
     append_keys = set()
     new_row_dicts = []
-    for row in self.rows:
-      row_dict = {k: v for (k, v) in zip(self.header, row)}
-      append_dict = fn(row_dict)
+    for row_dict, append_dict in zip(row_dicts, append_dicts):
       # TODO: support ordered dict
       assert not isinstance(append_dict, OrderedDict), "Ordering unsupported"
       assert set(row_dict.keys()).isdisjoint(append_dict.keys()), "overlap between row " + row_dict.keys() + " and append " + append_dict.keys()
       append_keys = append_keys | append_dict.keys()
       new_row_dicts.append(dict(row_dict, **append_dict))
 
-    new_header = self.header + list(append_keys)
+    new_header = self.header + sorted(append_keys)
     new_rows = []
     for row_dict in new_row_dicts:
       new_row = [row_dict.get(key, "") for key in new_header]
@@ -47,19 +160,19 @@ class CsvRowCollection:
     return CsvRowCollection(new_header, new_rows, self.outname)
 
   # Takes a function of row dict (column header -> value) that returns a group key.
-  # Returns a CsvGroupedRows object, which can map over groups.
+  # Returns a CsvGroupedRows object, which can map over groups. Groups are kept in a GroupSpool
+  # (see spillgroups.py), which spills them to disk past the --groupby-memory-mb budget.
+  @profiled('groupby')
   def groupby(self, fn):
-    groups_dict = OrderedDict()
+    groups = new_group_spool()
     for row in self.rows:
       row_dict = {k: v for (k, v) in zip(self.header, row)}
-      row_group = fn(row_dict)
-      if row_group not in groups_dict:
-        groups_dict[row_group] = []
-      groups_dict[row_group].append(row_dict)
+      groups.add(fn(row_dict), row_dict)
 
-    return CsvGroupedRows(groups_dict, self.outname)
+    return CsvGroupedRows(groups, self.outname)
 
   # Takes a function of row dict -> boolean. If false, the row is removed from the output.
+  @profiled('filter')
   def filter(self, fn):
     filtered_rows = []
     for row in self.rows:
@@ -69,43 +182,546 @@ class CsvRowCollection:
 
     return CsvRowCollection(self.header, filtered_rows, self.outname)
 
+  # Keeps only the given columns (in their current order), dropping the others.
+  # Returns a new CsvRowCollection.
+  @profiled('select_columns')
+  def select_columns(self, columns):
+    indices = [i for (i, key) in enumerate(self.header) if key in columns]
+    return CsvRowCollection([self.header[i] for i in indices], [[row[i] for i in indices] for row in self.rows],
+                            self.outname)
+
+  # Joins the rows with those of another collection (for example a pricing or stock sheet loaded
+  # with read_csv) whose other_on columns equal this collection's on columns (a column name or a
+  # list; other_on defaults to on). how is 'inner', 'left' or 'anti' (see rowjoins.JOIN_HOWS).
+  # The other collection's columns, except its key columns, are appended in alphabetical order, and
+  # may not overlap with existing column headers, as for map_append. Rows stay in order, with one
+  # row per match, and matches in the other collection's order.
+  # Rows are matched with a hash index on the smaller side, or with a sort-merge join on disk if the
+  # index would be over the --join-memory-mb budget; method forces 'hash' or 'merge'.
+  # Returns a new CsvRowCollection.
+  @profiled('join')
+  def join(self, other, on, how='inner', other_on=None, method=None):
+    return self._join(other, on, how, other_on, method)
+
+  # Like join(how='left'), but only takes the first match of each row, so there is exactly one
+  # output row per row - for looking up columns in a table keyed by serial or digikey_pn.
+  # Returns a new CsvRowCollection.
+  @profiled('lookup')
+  def lookup(self, other, on, other_on=None, method=None):
+    return self._join(other, on, 'lookup', other_on, method)
+
+  def _join(self, other, on, how, other_on, method):
+    header, rows = join_rows(self.header, list(self.row_dicts()), other, on, how, other_on, method)
+    return CsvRowCollection(header, rows, self.outname)
+
 class CsvGroupedRows:
-  def __init__(self, groups_dict, outname):
-    self.groups_dict = groups_dict
+  def __init__(self, groups, outname):
+    self.groups = groups  # GroupSpool
     self.outname = outname
 
   # Takes a function of (group name, list[row_dict]) that returns a list of row dicts.
+  # Groups are passed in the order of their first row, and read one at a time (or one window of a
+  # few groups per worker, if parallel), so spilled groups are never all in memory together.
+  # The header lists columns in the order they first appear in the returned row dicts (so returning
+  # input rows with extra columns keeps the input header first), which is the same on every run.
+  # If workers is set, fn is run in parallel on a pool of that many workers, see map_calls.
   # Returns a CsvRowCollection of the new rows.
-  def group_map(self, fn):
-    all_row_dicts = []
-    for group_name, group_row_dicts in self.groups_dict.items():
-      new_row_dicts = fn(group_name, group_row_dicts)
-      all_row_dicts.extend(new_row_dicts)
-
-    header_set = set()
-    for row_dict in all_row_dicts:
-      header_set.update(row_dict.keys())
-    header = list(header_set)
+  @profiled('group_map')
+  def group_map(self, fn, workers=None, backend='thread', chunk_size=None):
+    header = []
+    header_keys = set()
     new_rows = []
-    for row_dict in all_row_dicts:
-      new_row = [row_dict.get(key, "") for key in header]
-      new_rows.append(new_row)
+    window_groups = 1
+    if workers and workers > 1:
+      window_groups = workers * (chunk_size or 1) * 4
+
+    with ExitStack() as exit_stack:
+      executor = None
+      if workers and workers > 1:
+        executor = exit_stack.enter_context(make_executor(workers, backend))
+
+      group_items = self.groups.items()
+      start = 0
+      while True:
+        window = list(islice(group_items, window_groups))
+        if not window:
+          break
+        for new_row_dicts in map_calls(fn, window, workers, backend, chunk_size, describe_kind='group',
+                                       executor=executor, indices=range(start, start + len(window))):
+          for row_dict in new_row_dicts:
+            for key in row_dict:
+              if key not in header_keys:
+                header_keys.add(key)
+                header.append(key)
+            new_rows.append([row_dict.get(key, "") for key in header])
+        start += len(window)
+
+    for new_row in new_rows:
+      new_row.extend([""] * (len(header) - len(new_row)))
+    return CsvRowCollection(header, new_rows, self.outname)
+
+# Read-only row dict view into a ColumnarCsvRowCollection, so row functions can be called without
+# building a dict for every row.
+class CsvColumnRowView(Mapping):
+  __slots__ = ('columns', 'index')
+
+  def __init__(self, columns, index):
+    self.columns = columns
+    self.index = index
+
+  def __getitem__(self, key):
+    return self.columns[key][self.index]
+
+  def __contains__(self, key):
+    return key in self.columns
+
+  def __iter__(self):
+    return iter(self.columns)
+
+  def __len__(self):
+    return len(self.columns)
+
+# Column-oriented alternative to CsvRowCollection, with the same API. Data is stored as one list
+# per column (in an OrderedDict, in header order), so map_append only adds new column lists and
+# never copies existing rows. Row functions receive a CsvColumnRowView instead of a dict.
+# Filters with a column_filter attribute (like FieldEquals) are evaluated directly on the column.
+class ColumnarCsvRowCollection:
+  def __init__(self, columns, outname):
+    self.columns = columns
+    self.outname = outname
+
+  @classmethod
+  def from_rows(cls, header, rows, outname):
+    columns = OrderedDict((key, []) for key in header)
+    if rows:
+      columns = OrderedDict(zip(header, (list(column) for column in zip_longest(*rows, fillvalue=""))))
+    return cls(columns, outname)
+
+  @property
+  def header(self):
+    return list(self.columns.keys())
+
+  def __len__(self):
+    for column in self.columns.values():
+      return len(column)
+    return 0
+
+  @property
+  def rows(self):
+    return [list(row) for row in zip(*self.columns.values())]
+
+  # Writes data out to a CSV (or a column file, see columnfile.py).
+  @profiled('write')
+  def write(self):
+    with open_output(self.outname, self.header) as output_writer:
+      if isinstance(output_writer, ColumnFileWriter):
+        output_writer.write_columns(list(self.columns.values()))
+      else:
+        output_writer.writerows(zip(*self.columns.values()))
+
+  # Same contract as CsvRowCollection.map_append. Rows are passed to process workers as dicts.
+  @profiled('map_append')
+  def map_append(self, fn, workers=None, backend='thread', chunk_size=None):
+    num_rows = len(self)
+    if workers and backend == 'process':
+      header = self.header
+      rows_args = [({key: self.columns[key][i] for key in header},) for i in range(num_rows)]
+    else:
+      rows_args = [(CsvColumnRowView(self.columns, i),) for i in range(num_rows)]
+    return self._appended(map_calls(fn, rows_args, workers, backend, chunk_size))
+
+  # Same contract as CsvRowCollection.map_append_batch, with the rows passed as CsvColumnRowViews.
+  @profiled('map_append_batch')
+  def map_append_batch(self, fn):
+    num_rows = len(self)
+    append_dicts = fn([CsvColumnRowView(self.columns, i) for i in range(num_rows)])
+    assert len(append_dicts) == num_rows, "batch function returned %i results for %i rows" % (len(append_dicts), num_rows)
+    return self._appended(append_dicts)
+
+  def _appended(self, append_dicts):
+    num_rows = len(self)
+    new_columns = {}
+    for i, append_dict in enumerate(append_dicts):
+      assert not isinstance(append_dict, OrderedDict), "Ordering unsupported"
+      for key, value in append_dict.items():
+        new_column = new_columns.get(key)
+        if new_column is None:
+          assert key not in self.columns, "overlap between row %s and append %s" % (self.header, list(append_dict.keys()))
+          new_column = new_columns[key] = [""] * num_rows
+        new_column[i] = value
+
+    columns = OrderedDict(self.columns)
+    for key in sorted(new_columns.keys()):
+      columns[key] = new_columns[key]
+    return ColumnarCsvRowCollection(columns, self.outname)
+
+  # Same contract as CsvRowCollection.groupby. group_map functions receive real row dicts.
+  @profiled('groupby')
+  def groupby(self, fn):
+    groups = new_group_spool()
+    header = self.header
+    for i in range(len(self)):
+      groups.add(fn(CsvColumnRowView(self.columns, i)), {key: self.columns[key][i] for key in header})
+
+    return CsvGroupedRows(groups, self.outname)
+
+  # Same contract as CsvRowCollection.filter.
+  @profiled('filter')
+  def filter(self, fn):
+    column_filter = getattr(fn, 'column_filter', None)
+    if column_filter is not None:
+      in_field, value_fn = column_filter
+      selected = [i for (i, value) in enumerate(self.columns[in_field]) if value_fn(value)]
+    else:
+      selected = [i for i in range(len(self)) if fn(CsvColumnRowView(self.columns, i))]
+
+    columns = OrderedDict((key, [column[i] for i in selected]) for (key, column) in self.columns.items())
+    return ColumnarCsvRowCollection(columns, self.outname)
+
+  # Same contract as CsvRowCollection.select_columns.
+  @profiled('select_columns')
+  def select_columns(self, columns):
+    return ColumnarCsvRowCollection(OrderedDict((key, column) for (key, column) in self.columns.items()
+                                                if key in columns), self.outname)
+
+  # Generator over the rows as row dicts (column header -> value).
+  def row_dicts(self):
+    header = self.header
+    for i in range(len(self)):
+      yield {key: self.columns[key][i] for key in header}
+
+  # Same contract as CsvRowCollection.join.
+  @profiled('join')
+  def join(self, other, on, how='inner', other_on=None, method=None):
+    return self._join(other, on, how, other_on, method)
+
+  # Same contract as CsvRowCollection.lookup.
+  @profiled('lookup')
+  def lookup(self, other, on, other_on=None, method=None):
+    return self._join(other, on, 'lookup', other_on, method)
+
+  def _join(self, other, on, how, other_on, method):
+    header, rows = join_rows(self.header, list(self.row_dicts()), other, on, how, other_on, method)
+    return ColumnarCsvRowCollection.from_rows(header, rows, self.outname)
+
+# Row dict handed to functions in a CsvRowStream. Columns appended by an earlier stage but not
+# returned for this particular row read as empty, like they would in a materialized
+# CsvRowCollection.
+class CsvStreamRowDict(dict):
+  def __missing__(self, key):
+    return ""
+
+# A lazy counterpart to CsvRowCollection: filter and map_append calls are only recorded, and the
+# whole chain is run as a single generator pass over the input file when write() is called, so
+# memory use does not grow with the number of rows. Rows go through the chain in batches of
+# STREAM_BATCH_ROWS, which is also the unit of work handed to parallel map_append stages.
+# Since the appended columns are only known once every row has been processed, output rows are
+# spooled to a temporary file during the pass and copied into the output once the header is known.
+# Column order matches CsvRowCollection: the source header, followed by the columns appended by
+# each map_append stage (alphabetical within a stage).
+class CsvRowStream:
+  STREAM_BATCH_ROWS = 1024
+
+  def __init__(self, header, row_source, outname, stages=()):
+    self.header = header
+    self.row_source = row_source  # function returning an iterator over (non-header) rows
+    self.outname = outname
+    self.stages = tuple(stages)  # list of (kind, fn, options dict)
+
+  def _with_stage(self, kind, fn, **options):
+    return CsvRowStream(self.header, self.row_source, self.outname,
+                        self.stages + ((kind, fn, options),))
+
+  # Same contract as CsvRowCollection.map_append, but deferred until the stream is consumed.
+  # Parallel stages keep a worker pool for the whole pass.
+  @profiled('map_append')
+  def map_append(self, fn, workers=None, backend='thread', chunk_size=None):
+    return self._with_stage('map', fn, workers=workers, backend=backend, chunk_size=chunk_size)
+
+  # Same contract as CsvRowCollection.map_append_batch, but deferred until the stream is consumed.
+  # fn is called once per batch of up to STREAM_BATCH_ROWS rows rather than once for all rows.
+  @profiled('map_append_batch')
+  def map_append_batch(self, fn):
+    return self._with_stage('map_batch', fn)
+
+  # Same contract as CsvRowCollection.filter, but deferred until the stream is consumed.
+  @profiled('filter')
+  def filter(self, fn):
+    return self._with_stage('filter', fn)
+
+  # Same contract as CsvRowCollection.select_columns, but deferred until the stream is consumed.
+  @profiled('select_columns')
+  def select_columns(self, columns):
+    return self._with_stage('select', None, columns=set(columns))
+
+  # Groups need every row of a group before group_map can run, so this consumes the stream. Rows
+  # past the --groupby-memory-mb budget are spilled to disk (see CsvRowCollection.groupby).
+  @profiled('groupby')
+  def groupby(self, fn):
+    groups = new_group_spool()
+    for row_dict in self.row_dicts():
+      groups.add(fn(row_dict), row_dict)
+
+    return CsvGroupedRows(groups, self.outname)
+
+  # Same contract as CsvRowCollection.join. The other collection is read and indexed now, and the
+  # join is deferred until the stream is consumed. If its index would be over the --join-memory-mb
+  # budget (or method is 'merge'), this instead consumes the stream, sorting both sides on disk, and
+  # returns a stream over the merged rows.
+  @profiled('join')
+  def join(self, other, on, how='inner', other_on=None, method=None):
+    return self._join(other, on, how, other_on, method)
+
+  # Same contract as CsvRowCollection.lookup, deferred as for join.
+  @profiled('lookup')
+  def lookup(self, other, on, other_on=None, method=None):
+    return self._join(other, on, 'lookup', other_on, method)
+
+  def _join(self, other, on, how, other_on, method):
+    assert how in JOIN_HOWS, "unknown join '%s', expected one of %s" % (how, JOIN_HOWS)
+    indexed = None
+    if method != 'merge':
+      indexed = right_index(other, key_columns(other_on if other_on is not None else on), method)
+    if indexed is not None:
+      columns, index = indexed
+      return self._with_stage('join', None, how=how, key=key_fn(key_columns(on)), columns=columns, index=index)
+
+    stage_keys = {}
+    columns, matches = match_rows(self.row_dicts(stage_keys), other, on, other_on, 'merge')
+    header = self._output_header(stage_keys)
+    check_overlap(header, columns)
+    if how != 'anti':
+      header.extend(sorted(columns))
+
+    def row_source():
+      for row_dict, row_matches in matches:
+        for joined_row in joined_row_dicts(row_dict, row_matches, how):
+          yield [joined_row.get(key, "") for key in header]
+    return CsvRowStream(header, row_source, self.outname)
 
-    return CsvRowCollection(list(header_set), new_rows, self.outname)
+  # Returns the header of the rows from row_dicts, given the stage_keys it filled in.
+  def _output_header(self, stage_keys):
+    header = list(self.header)
+    for i, (kind, fn, options) in enumerate(self.stages):
+      header.extend(sorted(stage_keys.get(i, ())))
+      if kind == 'select':
+        header = [key for key in header if key in options['columns']]
+    return header
+
+  # Generator over batches of source rows, as lists of (source row index, row dict).
+  def _source_batches(self):
+    batch_rows = self.STREAM_BATCH_ROWS
+    for (kind, fn, options) in self.stages:
+      if options.get('workers'):
+        batch_rows = max(batch_rows, options['workers'] * (options['chunk_size'] or 1) * 4)
+
+    batch = []
+    for i, row in enumerate(self.row_source()):
+      batch.append((i, CsvStreamRowDict(zip(self.header, row))))
+      if len(batch) >= batch_rows:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  # Generator over the row dicts produced by running every recorded stage, in input order.
+  # stage_keys, if passed, is filled with the set of keys appended by each map stage (by index).
+  def row_dicts(self, stage_keys=None):
+    if stage_keys is None:
+      stage_keys = {}
+    source_keys = set(self.header)
+    key_stage = {}  # appended key -> index of the stage which appends it
+
+    with ExitStack() as exit_stack:
+      executors = {}
+      for i, (kind, fn, options) in enumerate(self.stages):
+        if kind == 'map' and options['workers'] and options['workers'] > 1:
+          executors[i] = exit_stack.enter_context(make_executor(options['workers'], options['backend']))
+
+      for batch in self._source_batches():
+        for i, (kind, fn, options) in enumerate(self.stages):
+          if kind == 'filter':
+            batch = [(index, row_dict) for (index, row_dict) in batch if fn(row_dict)]
+            continue
+
+          if kind == 'select':
+            batch = [(index, CsvStreamRowDict((key, value) for (key, value) in row_dict.items()
+                                              if key in options['columns']))
+                     for (index, row_dict) in batch]
+            continue
+
+          if kind == 'join':
+            row_key, index_dict, how = options['key'], options['index'], options['how']
+            if how != 'anti':
+              for key in options['columns']:
+                assert key not in source_keys and key_stage.setdefault(key, i) == i, \
+                    "overlap between row %s and join %s" % (list(self.header), options['columns'])
+              stage_keys.setdefault(i, set()).update(options['columns'])
+            batch = [(index, joined_row) for (index, row_dict) in batch
+                     for joined_row in joined_row_dicts(row_dict, index_dict.get(row_key(row_dict), []), how)]
+            continue
+
+          if kind == 'map_batch':
+            append_dicts = fn([row_dict for (index, row_dict) in batch])
+            assert len(append_dicts) == len(batch), "batch function returned %i results for %i rows" % (len(append_dicts), len(batch))
+          else:
+            append_dicts = map_calls(fn, [(row_dict,) for (index, row_dict) in batch],
+                                     options['workers'], options['backend'], options['chunk_size'],
+                                     executor=executors.get(i), indices=[index for (index, row_dict) in batch])
+          for (index, row_dict), append_dict in zip(batch, append_dicts):
+            assert not isinstance(append_dict, OrderedDict), "Ordering unsupported"
+            for key in append_dict:
+              assert key not in source_keys and key_stage.setdefault(key, i) == i, \
+                  "overlap between row %s and append %s" % (list(row_dict.keys()), list(append_dict.keys()))
+            stage_keys.setdefault(i, set()).update(append_dict.keys())
+            row_dict.update(append_dict)
+
+        for (index, row_dict) in batch:
+          yield row_dict
+
+  # Runs the recorded chain and writes data out to a CSV (or a column file, see columnfile.py).
+  @profiled('write')
+  def write(self):
+    if all(kind == 'filter' for (kind, fn, options) in self.stages):
+      # Filter-only chains keep the source header, so rows can go straight to the output.
+      with open_output(self.outname, self.header) as output_writer:
+        for row_dict in self.row_dicts():
+          output_writer.writerow([row_dict[key] for key in self.header])
+      return
+
+    stage_keys = {}
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as spoolfile:
+      for row_dict in self.row_dicts(stage_keys):
+        spoolfile.write(json.dumps(row_dict))
+        spoolfile.write('\n')
+
+      header = self._output_header(stage_keys)
+
+      spoolfile.seek(0)
+      with open_output(self.outname, header) as output_writer:
+        for line in spoolfile:
+          row_dict = json.loads(line)
+          output_writer.writerow([row_dict.get(key, "") for key in header])
+
+# Returns the header row of a CSV file (or column file), reading nothing past the first record.
+def read_csv_header(filename):
+  if is_column_file(filename):
+    with ColumnFileReader(filename) as reader:
+      return reader.header
+  with open(filename, 'r', newline='', encoding='utf-8') as infile:
+    return next(csv.reader(infile, delimiter=','))
+
+# Returns a function which, each time it is called, opens the CSV file and returns a generator over
+# its rows (excluding the header).
+def csv_row_source(filename):
+  def row_source():
+    with open(filename, 'r', newline='', encoding='utf-8') as infile:
+      reader = csv.reader(infile, delimiter=',')
+      next(reader)
+      for row in reader:
+        yield row
+  return row_source
+
+# Returns a function which, each time it is called, opens the column file and returns a generator
+# over its rows, decoding a row group at a time.
+def column_file_row_source(filename):
+  def row_source():
+    with ColumnFileReader(filename) as reader:
+      yield from reader.rows()
+  return row_source
+
+# Reads a column file (see columnfile.py) into a collection, as read_csv.
+def read_column_file(filename, outname, stream=False, columnar=False):
+  with ColumnFileReader(filename) as reader:
+    header = reader.header
+    if stream:
+      return CsvRowStream(header, column_file_row_source(filename), outname)
+    columns = reader.columns()
+
+  if columnar:
+    return ColumnarCsvRowCollection(OrderedDict(zip(header, columns)), outname)
+  return CsvRowCollection(header, [list(row) for row in zip(*columns)], outname)
+
+# Reads a CSV file into a collection, which will be written out to outname. Column files (see
+# columnfile.py) are detected and read as well.
+# If stream is set, returns a lazy CsvRowStream instead of reading the whole file into memory.
+# If columnar is set, returns a ColumnarCsvRowCollection.
+# If where is passed, as a list of (column, low, high) conditions (see csvindex.parse_where), only the
+# rows matching every condition are read, looking them up through an index of the file (see
+# csvindex.py) rather than parsing all of it. Column files are filtered instead.
+@profiled('read_csv')
+def read_csv(filename, outname, stream=False, columnar=False, where=None):
+  if is_column_file(filename):
+    rows = read_column_file(filename, outname, stream, columnar)
+    return rows.filter(where_filter(where)) if where else rows
+
+  if where:
+    header, rows = select_rows(filename, where)
+    if stream:
+      return CsvRowStream(header, lambda: iter(rows), outname)
+  elif stream:
+    return CsvRowStream(read_csv_header(filename), csv_row_source(filename), outname)
+  else:
+    with open(filename, 'r', encoding='utf-8') as infile:
+      rows = list(csv.reader(infile, delimiter=','))
+    header, rows = rows[0], rows[1:]
+
+  if columnar:
+    return ColumnarCsvRowCollection.from_rows(header, rows, outname)
+  return CsvRowCollection(header, rows, outname)
+
+# Adds the options selecting the collection representation (see read_csv) to an argument parser.
+def add_representation_args(parser):
+  parser.add_argument('--stream', action='store_true',
+                      help="Run the annotator chain as a single streaming pass at write time")
+  parser.add_argument('--columnar', action='store_true',
+                      help="Use the column-oriented in-memory representation")
 
 # Loads and parses the input dataset, with filenames parsed from system arguments.
-def load(desc="dataset annotator"):
+# The stream and columnar arguments (or the --stream and --columnar options) select the
+# representation, as in read_csv. The input may be a CSV or a column file, and --output-format
+# selects the output format (see columnfile.py). --where selects rows to read by key columns,
+# through an index of the input (see csvindex.py). --groupby-memory-mb and --join-memory-mb set the groupby and join
+# memory budgets (see spillgroups.py and rowjoins.py), and the --profile options enable
+# instrumentation (see labelprofiler.py).
+def load(desc="dataset annotator", stream=False, columnar=False):
   parser = argparse.ArgumentParser(description=desc)
   parser.add_argument('--input', '-i', required=True,
                       help="Input CSV file")
   parser.add_argument('--output', '-o', required=True,
                       help="Output CSV file")
+  add_representation_args(parser)
+  add_format_args(parser)
+  add_where_args(parser)
+  add_groupby_args(parser)
+  add_join_args(parser)
+  add_profile_args(parser)
   args = parser.parse_args()
+  format_from_args(args)
+  groupby_from_args(args)
+  join_from_args(args)
+  profile_from_args(args)
+
+  return read_csv(args.input, args.output,
+                  stream=stream or args.stream, columnar=columnar or args.columnar, where=where_from_args(args))
+
+# The parametrics column holds the distributor data for a part, as a JSON object (see
+# format_parametrics). Older CSVs hold a Python dict repr instead, which parse_parametrics also reads.
+PARAMETRICS_CACHE_SIZE = 65536
 
-  with open(args.input, 'r', encoding='utf-8') as infile:
-    rows = list(csv.reader(infile, delimiter=','))
+# Returns the parametrics column value for a dict of parametrics.
+def format_parametrics(parametrics):
+  return json.dumps(parametrics, ensure_ascii=False)
 
-  return CsvRowCollection(rows[0], rows[1:], args.output)
+# Parses a parametrics column value into a read-only dict. Results are cached, so a value is only
+# parsed once per run however many stages read it; use dict() on the result to get a modifiable copy.
+@functools.lru_cache(maxsize=PARAMETRICS_CACHE_SIZE)
+def parse_parametrics(parametrics_str):
+  try:
+    parametrics = json.loads(parametrics_str)
+  except ValueError:
+    parametrics = ast.literal_eval(parametrics_str)
+  return MappingProxyType(parametrics)
 
 # Standard map functions
 def PriorityMap(in_fields, out_field):
@@ -114,15 +730,23 @@ def PriorityMap(in_fields, out_field):
       if in_field in row_dict and row_dict[in_field]:
         return {out_field: row_dict[in_field]}
     return {}
+  annotate_fn.reads = tuple(in_fields)
+  annotate_fn.writes = (out_field,)
+  annotate_fn.row_cache = False
   return annotate_fn
 
 def StaticField(out_field, out_value):
   def annotate_fn(row_dict):
     return {out_field: out_value}
+  annotate_fn.reads = ()
+  annotate_fn.writes = (out_field,)
+  annotate_fn.row_cache = False
   return annotate_fn
 
 def FieldEquals(in_field, equal_value):
   def filter_fn(row_dict):
     return row_dict[in_field] == equal_value
+  filter_fn.column_filter = (in_field, lambda value: value == equal_value)
+  filter_fn.reads = (in_field,)
   return filter_fn
   
\ No newline at end of file
@@ -0,0 +1,274 @@
+import atexit
+import bisect
+import cProfile
+import functools
+import heapq
+import io
+import itertools
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+  import resource
+except ImportError:  # not available on Windows
+  resource = None
+
+# Opt-in instrumentation of labelannotator operations. Once enable_profiling is called, every
+# collection operation (read_csv, map_append, filter, groupby, group_map, write, ...) is recorded as
+# a stage, with its wall time, row counts and the process peak memory after it (and how much the
+# operation raised it), and every call of the user function it was given is timed, giving a latency
+# histogram and the slowest calls (with the key fields of their row). The stages are written out as a JSON report when the process exits.
+# Operations on a CsvRowStream only record the chain; their functions run (and are timed) during
+# write(), so those stages are marked lazy and their time is the time spent in their function.
+# The process peak memory (ru_maxrss) never goes down, so it is not a per-stage peak: a stage raising
+# it shows the stage needed more memory than any before it, but only --profile-tracemalloc measures
+# each stage's own peak (of Python allocations). Lazy stages have no memory figures of their own.
+# Functions run on process workers are not timed, since they cannot be wrapped.
+
+# Upper bounds (in seconds) of the latency histogram buckets; the last bucket is unbounded.
+LATENCY_BUCKETS = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 10]
+LATENCY_LABELS = ['<1us', '<10us', '<100us', '<1ms', '<10ms', '<100ms', '<1s', '<10s', '>=10s']
+
+# Row fields identifying a row in the slowest calls, when the row has them; otherwise the first
+# PROFILE_FALLBACK_FIELDS fields are used.
+PROFILE_KEY_FIELDS = ['serial', 'digikey_pn', 'gridid']
+PROFILE_FALLBACK_FIELDS = 3
+
+# Kinds of operation taking a user function, by how it is called.
+ROW_FUNCTION_KINDS = {'map_append', 'filter', 'groupby'}  # fn(row_dict)
+BATCH_FUNCTION_KINDS = {'map_append_batch'}  # fn(list of row_dict)
+GROUP_FUNCTION_KINDS = {'group_map'}  # fn(group name, list of row_dict)
+
+# The profiler recording operations, or None if profiling is disabled.
+active_profiler = None
+
+def peak_rss_mb():
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def row_key_fields(row_dict):
+  key_fields = {key: row_dict[key] for key in PROFILE_KEY_FIELDS if key in row_dict}
+  if not key_fields:
+    key_fields = {key: row_dict[key] for key in itertools.islice(row_dict, PROFILE_FALLBACK_FIELDS)}
+  return key_fields
+
+# Statistics of one operation and the calls of its user function.
+class StageProfile:
+  def __init__(self, index, kind, function, script, slowest_count):
+    self.index = index
+    self.kind = kind
+    self.function = function
+    self.script = script
+    self.slowest_count = slowest_count
+    self.lock = threading.Lock()
+    self.lazy = False
+    self.seconds = 0
+    self.rows_in = None
+    self.rows_out = None
+    self.process_peak_rss_mb_after = None
+    self.peak_rss_growth_mb = None  # how much the operation raised the process peak
+    self.traced_peak_mb = None
+    self.calls = 0
+    self.call_rows = 0  # rows passed to the function, over all calls
+    self.call_true = 0  # calls returning a true value (rows kept, for a filter)
+    self.call_seconds = 0
+    self.histogram = [0] * len(LATENCY_LABELS)
+    self.slowest = []  # min-heap of (seconds, call number, key fields)
+
+  def record_call(self, seconds, rows, result, key_fields_fn):
+    with self.lock:
+      call = self.calls
+      self.calls += 1
+      self.call_rows += rows
+      self.call_true += bool(result)
+      self.call_seconds += seconds
+      self.histogram[bisect.bisect_right(LATENCY_BUCKETS, seconds)] += 1
+      if len(self.slowest) < self.slowest_count:
+        heapq.heappush(self.slowest, (seconds, call, key_fields_fn()))
+      elif seconds > self.slowest[0][0]:
+        heapq.heapreplace(self.slowest, (seconds, call, key_fields_fn()))
+
+  # Returns fn wrapped to record each call, keeping its attributes (like column_filter or reads).
+  def timed(self, fn):
+    if self.kind in ROW_FUNCTION_KINDS:
+      def timed_fn(row_dict):
+        start = time.perf_counter()
+        result = fn(row_dict)
+        self.record_call(time.perf_counter() - start, 1, result, lambda: row_key_fields(row_dict))
+        return result
+    elif self.kind in BATCH_FUNCTION_KINDS:
+      def timed_fn(row_dicts):
+        start = time.perf_counter()
+        result = fn(row_dicts)
+        self.record_call(time.perf_counter() - start, len(row_dicts), result,
+                         lambda: row_key_fields(row_dicts[0]) if row_dicts else {})
+        return result
+    else:
+      def timed_fn(group, row_dicts):
+        start = time.perf_counter()
+        result = fn(group, row_dicts)
+        self.record_call(time.perf_counter() - start, len(row_dicts), result, lambda: {'group': group})
+        return result
+    return functools.wraps(fn)(timed_fn)
+
+  def report(self):
+    seconds = self.call_seconds if self.lazy else self.seconds
+    rows_in = self.call_rows if self.lazy else self.rows_in
+    rows_out = self.rows_out
+    if self.lazy:
+      rows_out = self.call_true if self.kind == 'filter' else self.call_rows
+    report = {
+      'index': self.index,
+      'kind': self.kind,
+      'function': self.function,
+      'script': self.script,
+      'lazy': self.lazy,
+      'seconds': seconds,
+      'rows_in': rows_in,
+      'rows_out': rows_out,
+      'rows_per_sec': rows_in / seconds if rows_in and seconds else None,
+      'process_peak_rss_mb_after': self.process_peak_rss_mb_after,
+      'peak_rss_growth_mb': self.peak_rss_growth_mb,
+    }
+    if self.traced_peak_mb is not None:
+      report['traced_peak_mb'] = self.traced_peak_mb
+    if self.calls:
+      report['calls'] = self.calls
+      report['call_seconds'] = self.call_seconds
+      report['latency_histogram'] = dict(zip(LATENCY_LABELS, self.histogram))
+      report['slowest'] = [{'seconds': seconds, 'call': call, 'row': key_fields}
+                           for (seconds, call, key_fields) in sorted(self.slowest, reverse=True)]
+    return report
+
+# Returns the number of rows in a collection, or None if it is lazy (a CsvRowStream) or unknown.
+def _row_count(collection):
+  if hasattr(collection, 'groups'):
+    return collection.groups.row_count
+  if hasattr(collection, 'row_source'):
+    return None
+  if hasattr(collection, 'columns'):
+    return len(collection)
+  rows = getattr(collection, 'rows', None)
+  return len(rows) if isinstance(rows, list) else None
+
+class Profiler:
+  # report_path: JSON report file.
+  # slowest_count: number of slowest calls kept per stage.
+  # cprofile: also run cProfile, adding the top functions (by cumulative time) to the report and
+  #   saving the full stats to report_path + '.prof' (readable with pstats or snakeviz).
+  # trace_memory: also run tracemalloc, reporting the peak Python allocations of each stage.
+  def __init__(self, report_path, slowest_count=10, cprofile=False, trace_memory=False):
+    self.report_path = report_path
+    self.slowest_count = slowest_count
+    self.stages = []
+    self.script = None  # set by pipeline.py to the annotator script being run
+    self.start = time.perf_counter()
+    self.cprofile = cProfile.Profile() if cprofile else None
+    self.trace_memory = trace_memory
+    if trace_memory:
+      tracemalloc.start()
+    if self.cprofile:
+      self.cprofile.enable()
+
+  # Runs a collection operation (method called as method(target, *args, **kwargs)), recording it.
+  def run(self, kind, method, target, args, kwargs):
+    fn = args[0] if args else kwargs.get('fn')
+    function = getattr(fn, '__qualname__', None) if callable(fn) else None
+    stage = StageProfile(len(self.stages), kind, function, self.script, self.slowest_count)
+    self.stages.append(stage)
+
+    workers = kwargs.get('workers', args[1] if len(args) > 1 else None)
+    backend = kwargs.get('backend', args[2] if len(args) > 2 else 'thread')
+    process_workers = workers and workers > 1 and backend == 'process'
+    if callable(fn) and not process_workers and \
+        kind in ROW_FUNCTION_KINDS | BATCH_FUNCTION_KINDS | GROUP_FUNCTION_KINDS:
+      if args:
+        args = (stage.timed(fn),) + tuple(args[1:])
+      else:
+        kwargs = dict(kwargs, fn=stage.timed(fn))
+
+    stage.rows_in = _row_count(target) if kind != 'read_csv' else None
+    if self.trace_memory:
+      tracemalloc.reset_peak()
+    peak_before = peak_rss_mb()
+    start = time.perf_counter()
+    result = method(target, *args, **kwargs)
+    stage.seconds = time.perf_counter() - start
+    stage.lazy = hasattr(result, 'row_source') and kind != 'read_csv'
+    stage.rows_out = _row_count(result) if result is not None else None
+    stage.process_peak_rss_mb_after = peak_rss_mb()
+    if not stage.lazy:
+      if peak_before is not None:
+        stage.peak_rss_growth_mb = stage.process_peak_rss_mb_after - peak_before
+      if self.trace_memory:
+        stage.traced_peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    return result
+
+  def report(self):
+    report = {
+      'argv': sys.argv,
+      'seconds': time.perf_counter() - self.start,
+      'peak_rss_mb': peak_rss_mb(),
+      'stages': [stage.report() for stage in self.stages],
+    }
+    if self.cprofile:
+      self.cprofile.disable()
+      self.cprofile.dump_stats(self.report_path + '.prof')
+      stats = pstats.Stats(self.cprofile, stream=io.StringIO())
+      report['cprofile'] = [
+        {'function': '%s:%i(%s)' % function, 'calls': calls, 'tottime': tottime, 'cumtime': cumtime}
+        for (function, (_, calls, tottime, cumtime, _)) in
+        sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:30]
+      ]
+    return report
+
+  def write_report(self):
+    with open(self.report_path, 'w', encoding='utf-8') as report_file:
+      json.dump(self.report(), report_file, indent=2, ensure_ascii=False)
+
+# Starts recording labelannotator operations, writing the report to report_path when the process
+# exits. See Profiler for the options.
+def enable_profiling(report_path, **options):
+  global active_profiler
+  active_profiler = Profiler(report_path, **options)
+  atexit.register(active_profiler.write_report)
+  return active_profiler
+
+# Sets the annotator script that subsequent stages belong to, if profiling.
+def set_profile_script(script):
+  if active_profiler is not None:
+    active_profiler.script = script
+
+# Decorator recording calls of a collection method (or read_csv) as stages of kind, if profiling.
+def profiled(kind):
+  def decorator(method):
+    @functools.wraps(method)
+    def wrapper(target, *args, **kwargs):
+      if active_profiler is None:
+        return method(target, *args, **kwargs)
+      return active_profiler.run(kind, method, target, args, kwargs)
+    return wrapper
+  return decorator
+
+# Adds the profiling options to an argument parser.
+def add_profile_args(parser):
+  parser.add_argument('--profile', metavar='REPORT', default=None,
+                      help="Write a JSON report of the time, rows and memory of each operation to REPORT")
+  parser.add_argument('--profile-cprofile', action='store_true',
+                      help="With --profile, also run cProfile (saving the stats to REPORT.prof)")
+  parser.add_argument('--profile-tracemalloc', action='store_true',
+                      help="With --profile, also trace Python memory allocations per operation")
+  parser.add_argument('--profile-slowest', type=int, default=10,
+                      help="With --profile, number of slowest calls to report per operation")
+
+# Enables profiling if requested by the options from add_profile_args.
+def profile_from_args(args):
+  if args.profile:
+    enable_profiling(args.profile, slowest_count=args.profile_slowest,
+                     cprofile=args.profile_cprofile, trace_memory=args.profile_tracemalloc)
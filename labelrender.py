@@ -0,0 +1,452 @@
+import argparse
+import collections
+import configparser
+import copy
+import csv
+import hashlib
+import os
+import re
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+from labelannotator import make_executor
+from rendercache import DEFAULT_RENDER_CACHE_MB, RenderCache
+
+# Renders a CSV dataset into sheets of labels from an Inkscape SVG template of a single label, laid
+# out by the [label] / [sheet] geometry of an ini file (like templates/template_front.ini).
+# The template is compiled once into a substitution plan: its directives are resolved, and it is
+# serialized into literal text with slots for each %(column) placeholder (in text or attributes)
+# and each generated element, so rendering a label is a string join rather than a tree operation.
+# Sheets are rendered in parallel on worker processes, and written out in order as they finish to a
+# single multi-page SVG (one Inkscape page per sheet, stacked vertically), so memory use does not
+# grow with the number of labels.
+#
+# Template directives are text elements whose text starts with '#', applying to the other elements
+# of their group (the directive text itself is removed):
+#   #style prop=value ...: sets style properties, like '#style fill=%(bg_color) stroke=%(res_stroke_1)'
+#   #code128 [align=xMin|xMid|xMax] [thickness=LENGTH] DATA: replaces the group's rect with a Code 128
+#     barcode of DATA (like '%(serial)'), with bars of thickness (default 0.254mm) per module.
+# Lengths are numbers with a unit (mm, cm, in, pt, pc or px).
+# With --render-cache FILE, rendered labels are kept in FILE (see rendercache.py), so a rebuild only
+# renders the labels whose rows (or template) changed.
+# Usage: python labelrender.py TEMPLATE.svg CONFIG.ini INPUT.csv OUTPUT.svg [--workers N]
+#   [--render-cache FILE]
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+INKSCAPE_NS = 'http://www.inkscape.org/namespaces/inkscape'
+SODIPODI_NS = 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'
+
+# Template root elements which are document settings rather than label content.
+NON_LABEL_TAGS = {'{%s}defs' % SVG_NS, '{%s}metadata' % SVG_NS, '{%s}namedview' % SODIPODI_NS}
+
+# Vertical gap between pages of the output, in mm.
+PAGE_GAP_MM = 20
+
+UNIT_MM = {'mm': 1.0, 'cm': 10.0, 'in': 25.4, 'pt': 25.4 / 72, 'pc': 25.4 / 6, 'px': 25.4 / 96, '': 25.4 / 96}
+
+length_re = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*([a-z]*)\s*$')
+field_re = re.compile(r'%\((\w+)\)')
+slot_re = re.compile(r'%\((\w+)\)|<!--labelslot (\d+)-->')
+directive_re = re.compile(r'^\s*#(\w+)\s*(.*)$', re.S)
+
+# Entities escaped in substituted values, which can land in text or in attributes.
+ESCAPE_ENTITIES = {'"': '&quot;'}
+
+# Returns a length string like '1.75 in' or '44mm' in mm.
+def length_mm(length_str):
+  match = length_re.match(length_str)
+  if not match or match.group(2) not in UNIT_MM:
+    raise ValueError("bad length '%s'" % length_str)
+  return float(match.group(1)) * UNIT_MM[match.group(2)]
+
+# Label and sheet geometry from the [label] and [sheet] sections of a config ini file, in mm.
+class SheetLayout:
+  def __init__(self, config_file):
+    config = configparser.ConfigParser()
+    with open(config_file, encoding='utf-8') as infile:
+      config.read_file(infile)
+    label, sheet = config['label'], config['sheet']
+    self.label_size = (length_mm(label['sizex']), length_mm(label['sizey']))
+    self.sheet_size = (length_mm(sheet['sizex']), length_mm(sheet['sizey']))
+    self.offset = (length_mm(sheet['offx']), length_mm(sheet['offy']))
+    self.increment = (length_mm(sheet['incx']), length_mm(sheet['incy']))
+    self.nrows = int(sheet['nrows'])
+    self.ncols = int(sheet['ncols'])
+    self.labels_per_sheet = self.nrows * self.ncols
+
+  # Returns the top left corner of the i-th label cell of a sheet, filling rows left to right.
+  def label_origin(self, i):
+    row, col = divmod(i, self.ncols)
+    return (self.offset[0] + col * self.increment[0], self.offset[1] + row * self.increment[1])
+
+  def page_y(self, sheet_index):
+    return sheet_index * (self.sheet_size[1] + PAGE_GAP_MM)
+
+#
+# Code 128
+#
+
+# Bar and space widths (in modules) of each Code 128 symbol, by symbol value.
+CODE128_PATTERNS = [
+  '212222', '222122', '222221', '121223', '121322', '131222', '122213', '122312', '132212', '221213',
+  '221312', '231212', '112232', '122132', '122231', '113222', '123122', '123221', '223211', '221132',
+  '221231', '213212', '223112', '312131', '311222', '321122', '321221', '312212', '322112', '322211',
+  '212123', '212321', '232121', '111323', '131123', '131321', '112313', '132113', '132311', '211313',
+  '231113', '231311', '112133', '112331', '132131', '113123', '113321', '133121', '313121', '211331',
+  '231131', '213113', '213311', '213131', '311123', '311321', '331121', '312113', '312311', '332111',
+  '314111', '221411', '431111', '111224', '111422', '121124', '121421', '141122', '141221', '112214',
+  '112412', '122114', '122411', '142112', '142211', '241211', '221114', '413111', '241112', '134111',
+  '111242', '121142', '121241', '114212', '124112', '124211', '411212', '421112', '421211', '212141',
+  '214121', '412121', '111143', '111341', '131141', '114113', '114311', '411113', '411311', '113141',
+  '114131', '311141', '411131', '211412', '211214', '211232', '2331112',
+]
+CODE128_START_B = 104
+CODE128_STOP = 106
+
+# Returns the bars of data encoded in Code 128 (code set B) as a list of (offset, width) in
+# modules, and the total width in modules. Characters outside code set B are encoded as '?'.
+def code128_bars(data):
+  values = [CODE128_START_B] + [ord(char) - 32 if 32 <= ord(char) < 128 else ord('?') - 32 for char in data]
+  checksum = (values[0] + sum(position * value for (position, value) in enumerate(values[1:], 1))) % 103
+  values += [checksum, CODE128_STOP]
+
+  bars = []
+  offset = 0
+  for value in values:
+    for i, width in enumerate(CODE128_PATTERNS[value]):
+      if i % 2 == 0:  # bars and spaces alternate, starting with a bar
+        bars.append((offset, int(width)))
+      offset += int(width)
+  return bars, offset
+
+#
+# Template compilation
+#
+
+# A slot substituting a column value.
+class FieldSlot:
+  def __init__(self, name):
+    self.name = name
+
+  def render(self, row_dict):
+    return escape(row_dict.get(self.name, ''), ESCAPE_ENTITIES)
+
+# A slot generating a Code 128 barcode in the area of a template rect (in template units).
+class Code128Slot:
+  def __init__(self, data, area, module_width, align, transform):
+    self.data = data  # template string, with %(column) placeholders
+    self.area = area  # (x, y, width, height)
+    self.module_width = module_width
+    self.align = align
+    self.transform = transform
+
+  def render(self, row_dict):
+    data = field_re.sub(lambda match: row_dict.get(match.group(1), ''), self.data)
+    bars, modules = code128_bars(data)
+    x, y, width, height = self.area
+    start = x
+    if self.align == 'xMid':
+      start = x + (width - modules * self.module_width) / 2
+    elif self.align == 'xMax':
+      start = x + width - modules * self.module_width
+    path = ''.join(['M%.4f,%.4fh%.4fv%.4fh%.4fz' % (start + offset * self.module_width, y, bar_width * self.module_width,
+                                                    height, -bar_width * self.module_width)
+                    for (offset, bar_width) in bars])
+    transform = ' transform="%s"' % escape(self.transform, ESCAPE_ENTITIES) if self.transform else ''
+    return '<path d="%s" style="fill:#000000;stroke:none"%s />' % (path, transform)
+
+def parse_style(style_str):
+  style = collections.OrderedDict()
+  for declaration in (style_str or '').split(';'):
+    if ':' in declaration:
+      key, value = declaration.split(':', 1)
+      style[key.strip()] = value.strip()
+  return style
+
+def format_style(style):
+  return ';'.join(['%s:%s' % item for item in style.items()])
+
+# Splits directive arguments into (options dict of key=value arguments, list of other arguments).
+def directive_args(args_str):
+  options = collections.OrderedDict()
+  values = []
+  for arg in args_str.split():
+    if '=' in arg and not arg.startswith('%('):
+      key, value = arg.split('=', 1)
+      options[key] = value
+    else:
+      values.append(arg)
+  return options, values
+
+def attribute_float(elem, name):
+  return float(elem.get(name, 0))
+
+# A compiled label template: the label content as alternating literal text and slots, and the
+# document around it.
+class TemplatePlan:
+  def __init__(self, template_file):
+    # Identifies the rendered output of the template, for the render cache.
+    with open(template_file, 'rb') as template, open(__file__, 'rb') as renderer:
+      self.fingerprint = hashlib.blake2b(template.read() + b'\0' + renderer.read(), digest_size=16).hexdigest()
+
+    namespaces = {}
+    for event, (prefix, uri) in ET.iterparse(template_file, events=('start-ns',)):
+      namespaces.setdefault(prefix, uri)
+    for prefix, uri in namespaces.items():
+      if prefix != 'svg':
+        ET.register_namespace(prefix, uri)
+    ET.register_namespace('inkscape', INKSCAPE_NS)
+    ET.register_namespace('sodipodi', SODIPODI_NS)
+
+    root = ET.parse(template_file).getroot()
+    self.template_size = (length_mm(root.get('width')), length_mm(root.get('height')))
+    if root.get('viewBox'):
+      view_box = [float(value) for value in root.get('viewBox').replace(',', ' ').split()]
+    else:
+      view_box = [0, 0, self.template_size[0] / UNIT_MM['px'], self.template_size[1] / UNIT_MM['px']]
+    self.view_origin = (view_box[0], view_box[1])
+    self.scale = (self.template_size[0] / view_box[2], self.template_size[1] / view_box[3])
+
+    slots = self._resolve_directives(root)
+
+    # Serialize the label content between markers, so namespace declarations end up on the root.
+    document = ET.Element(root.tag, {key: value for (key, value) in root.attrib.items()
+                                     if key in ('version',)})
+    namedview = ET.SubElement(document, '{%s}namedview' % SODIPODI_NS,
+                              {'id': 'namedview', '{%s}document-units' % INKSCAPE_NS: 'mm'})
+    namedview.append(ET.Comment('labelpages'))
+    for child in root:
+      if child.tag == '{%s}defs' % SVG_NS:
+        document.append(copy.deepcopy(child))
+    document.append(ET.Comment('labelbody'))
+    for child in root:
+      if child.tag not in NON_LABEL_TAGS:
+        document.append(child)
+    document.append(ET.Comment('labelbody-end'))
+    document_str = ET.tostring(document, encoding='unicode')
+
+    head, rest = document_str.split('<!--labelbody-->', 1)
+    body, self.tail = rest.split('<!--labelbody-end-->', 1)
+    self.head_before_pages, self.head_after_pages = head.split('<!--labelpages-->', 1)
+
+    self.literals = []
+    self.slots = []
+    self.fields = set()
+    position = 0
+    for match in slot_re.finditer(body):
+      self.literals.append(body[position:match.start()])
+      if match.group(1) is not None:
+        self.slots.append(FieldSlot(match.group(1)))
+        self.fields.add(match.group(1))
+      else:
+        self.slots.append(slots[int(match.group(2))])
+      position = match.end()
+    self.literals.append(body[position:])
+    for slot in slots:
+      self.fields.update(field_re.findall(slot.data))
+
+  # Applies the directives in the template tree, removing their text elements, and returns the
+  # generated slots (referenced from the tree by labelslot comments).
+  def _resolve_directives(self, root):
+    parents = {child: parent for parent in root.iter() for child in parent}
+    slots = []
+    for elem in list(root.iter('{%s}text' % SVG_NS)):
+      match = directive_re.match(' '.join(elem.itertext()))
+      if not match:
+        continue
+      directive, args_str = match.groups()
+      parent = parents[elem]
+      siblings = [child for child in parent if child is not elem]
+      options, values = directive_args(args_str)
+
+      if directive == 'style':
+        assert not values, "unexpected #style arguments %s" % values
+        for sibling in siblings:
+          style = parse_style(sibling.get('style'))
+          style.update(options)
+          sibling.set('style', format_style(style))
+      elif directive == 'code128':
+        rects = [sibling for sibling in siblings if sibling.tag == '{%s}rect' % SVG_NS]
+        assert rects, "#code128 needs a rect in its group for the barcode area"
+        rect = rects[0]
+        module_width = length_mm(options.get('thickness', '0.254mm')) / self.scale[0]
+        align = options.get('align', 'xMin')
+        assert align in ('xMin', 'xMid', 'xMax'), "unknown #code128 align '%s'" % align
+        area = (attribute_float(rect, 'x'), attribute_float(rect, 'y'),
+                attribute_float(rect, 'width'), attribute_float(rect, 'height'))
+        slot_comment = ET.Comment('labelslot %i' % len(slots))
+        slot_comment.tail = rect.tail
+        parent.insert(list(parent).index(rect), slot_comment)
+        parent.remove(rect)
+        slots.append(Code128Slot(' '.join(values), area, module_width, align, rect.get('transform')))
+      else:
+        raise ValueError("unknown template directive '#%s'" % directive)
+      parent.remove(elem)
+    return slots
+
+  # Returns the label content for a row dict.
+  def render(self, row_dict):
+    parts = [self.literals[0]]
+    for slot, literal in zip(self.slots, self.literals[1:]):
+      parts.append(slot.render(row_dict))
+      parts.append(literal)
+    return ''.join(parts)
+
+  # Returns the document text before and after the sheets, for an output of num_sheets pages.
+  def document(self, layout, num_sheets):
+    width, height = layout.sheet_size
+    pages = ''.join(['<inkscape:page id="page%i" x="0" y="%.4f" width="%.4f" height="%.4f" />' %
+                     (i + 1, layout.page_y(i), width, height) for i in range(num_sheets)])
+    head = self.head_before_pages + pages + self.head_after_pages
+    # The root element takes the page size, in mm user units.
+    head = head.replace('<svg ', '<svg width="%.4fmm" height="%.4fmm" viewBox="0 0 %.4f %.4f" ' %
+                        (width, height, width, height), 1)
+    return '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n' + head, self.tail + '\n'
+
+#
+# Rendering
+#
+
+# Returns the SVG text of a sheet, as one Inkscape layer of label contents (see TemplatePlan.render)
+# in cell order.
+def layout_sheet(plan, layout, sheet_index, labels):
+  scale_x, scale_y = plan.scale
+  origin_x, origin_y = plan.view_origin
+  # Templates are centered on their label cell.
+  center_x = (layout.label_size[0] - plan.template_size[0]) / 2
+  center_y = (layout.label_size[1] - plan.template_size[1]) / 2
+  view_transform = ' translate(%.8g,%.8g)' % (-origin_x, -origin_y) if (origin_x, origin_y) != (0, 0) else ''
+  parts = ['<g inkscape:groupmode="layer" inkscape:label="Sheet %i" id="sheet%i" transform="translate(0,%.4f)">\n' %
+           (sheet_index + 1, sheet_index + 1, layout.page_y(sheet_index))]
+  for i, label in enumerate(labels):
+    x, y = layout.label_origin(i)
+    parts.append('<g transform="translate(%.4f,%.4f) scale(%.8g,%.8g)%s">' %
+                 (x + center_x, y + center_y, scale_x, scale_y, view_transform))
+    parts.append(label)
+    parts.append('</g>\n')
+  parts.append('</g>\n')
+  return ''.join(parts)
+
+# Returns the label contents for row_dicts.
+def render_contents(plan, row_dicts):
+  return [plan.render(row_dict) for row_dict in row_dicts]
+
+# Returns the SVG text of a sheet, as one Inkscape layer of labels for row_dicts.
+def render_sheet(plan, layout, sheet_index, row_dicts):
+  return layout_sheet(plan, layout, sheet_index, render_contents(plan, row_dicts))
+
+# Generator over (sheet index, row dicts) of an iterable of row dicts.
+def group_sheets(row_dicts, labels_per_sheet):
+  sheet = []
+  sheet_index = 0
+  for row_dict in row_dicts:
+    sheet.append(row_dict)
+    if len(sheet) == labels_per_sheet:
+      yield sheet_index, sheet
+      sheet_index += 1
+      sheet = []
+  if sheet:
+    yield sheet_index, sheet
+
+# Generator over (sheet index, row dicts) of a CSV file.
+def sheet_rows(csv_file, labels_per_sheet):
+  with open(csv_file, 'r', newline='', encoding='utf-8') as infile:
+    reader = csv.reader(infile, delimiter=',')
+    header = next(reader)
+    yield from group_sheets((dict(zip(header, row)) for row in reader), labels_per_sheet)
+
+# Returns the header and number of rows of a CSV file.
+def csv_shape(csv_file):
+  with open(csv_file, 'r', newline='', encoding='utf-8') as infile:
+    reader = csv.reader(infile, delimiter=',')
+    header = next(reader)
+    return header, sum(1 for row in reader)
+
+# Writes the document of num_sheets sheets, given as (sheet index, row dicts), to output_file.
+# Labels are reused from cache (a RenderCache) if passed, and rendered on executor if passed, with
+# up to in_flight sheets submitted ahead of the one being written.
+def write_sheets(plan, layout, sheets, num_sheets, output_file, cache=None, executor=None, in_flight=0):
+  head, tail = plan.document(layout, num_sheets)
+
+  # Starts rendering a sheet, returning a function which returns its SVG text once rendered.
+  def start_sheet(sheet_index, row_dicts):
+    if cache is None:
+      if executor is None:
+        sheet = render_sheet(plan, layout, sheet_index, row_dicts)
+        return lambda: sheet
+      return executor.submit(render_sheet, plan, layout, sheet_index, row_dicts).result
+
+    keys = [cache.label_key(row_dict) for row_dict in row_dicts]
+    labels = cache.get_many(keys)
+    missing = [i for (i, label) in enumerate(labels) if label is None]
+    missing_rows = [row_dicts[i] for i in missing]
+    if executor is None or not missing:
+      rendered = render_contents(plan, missing_rows)
+      rendered_fn = lambda: rendered
+    else:
+      rendered_fn = executor.submit(render_contents, plan, missing_rows).result
+
+    def finish_sheet():
+      for i, label in zip(missing, rendered_fn()):
+        labels[i] = label
+        cache.put(keys[i], label)
+      return layout_sheet(plan, layout, sheet_index, labels)
+    return finish_sheet
+
+  with open(output_file, 'w', encoding='utf-8') as outfile:
+    outfile.write(head)
+    pending = collections.deque()
+    for sheet_index, row_dicts in sheets:
+      pending.append(start_sheet(sheet_index, row_dicts))
+      while len(pending) > in_flight:
+        outfile.write(pending.popleft()())
+    while pending:
+      outfile.write(pending.popleft()())
+    outfile.write(tail)
+
+# Renders every row of csv_file as a label, writing the sheets to output_file. With workers > 1,
+# sheets are rendered on that many processes, with a few sheets per worker in flight at a time.
+# If cache_file is set, it names a RenderCache file (of up to cache_mb) which labels are reused from,
+# so only labels missing from it are rendered.
+def render_labels(template_file, config_file, csv_file, output_file, workers=None, cache_file=None,
+                  cache_mb=DEFAULT_RENDER_CACHE_MB):
+  plan = TemplatePlan(template_file)
+  layout = SheetLayout(config_file)
+  header, num_rows = csv_shape(csv_file)
+  missing_fields = sorted(plan.fields - set(header))
+  if missing_fields:
+    print("Template fields not in %s, left blank: %s" % (csv_file, ', '.join(missing_fields)))
+  num_sheets = max(1, -(-num_rows // layout.labels_per_sheet))
+
+  cache = RenderCache(cache_file, plan.fingerprint, plan.fields, cache_mb) if cache_file else None
+  executor = make_executor(workers, 'process') if workers and workers > 1 else None
+  try:
+    write_sheets(plan, layout, sheet_rows(csv_file, layout.labels_per_sheet), num_sheets, output_file,
+                 cache, executor, workers * 2 if executor is not None else 0)
+    if cache is not None:
+      cache.finish()
+      print("Render cache: %(hits)i labels reused, %(misses)i labels rendered" % cache.stats)
+  finally:
+    if executor is not None:
+      executor.shutdown()
+    if cache is not None:
+      cache.close()
+  return num_rows, num_sheets
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="SVG label sheet renderer")
+  parser.add_argument('template', help="SVG template of a single label")
+  parser.add_argument('config', help="Label and sheet geometry ini file")
+  parser.add_argument('input', help="Input CSV file, one label per row")
+  parser.add_argument('output', help="Output SVG file")
+  parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                      help="Number of processes rendering sheets")
+  parser.add_argument('--render-cache', default=None,
+                      help="Cache file of rendered labels, so reruns only render changed labels")
+  parser.add_argument('--render-cache-mb', type=float, default=DEFAULT_RENDER_CACHE_MB,
+                      help="Size budget of the render cache; least recently used labels past it are evicted")
+  args = parser.parse_args()
+
+  num_rows, num_sheets = render_labels(args.template, args.config, args.input, args.output, args.workers,
+                                       args.render_cache, args.render_cache_mb)
+  print("Rendered %i labels on %i sheets to %s" % (num_rows, num_sheets, args.output))
@@ -0,0 +1,348 @@
+import argparse
+import csv
+import functools
+import re
+import sqlite3
+import sys
+
+from decimal import Decimal, InvalidOperation
+
+from csvindex import file_version
+from labelannotator import parse_parametrics, read_csv
+
+# Parametric search over a crawled inventory (the output of DigikeyCrawler.py and
+# DigikeyLabelGen.py), to find whether a part is stocked and which drawer holds it without reading
+# the whole file. Each distinct part's parametrics are indexed in a sidecar SQLite file
+# (FILE.partindex): every value by its words, in an inverted index by parametric name and word, and
+# values which are quantities (like '4.7 kOhms' or '1.25V ~ 37V') as numeric ranges in base units
+# (4700 Ω, 1.25 to 37 V), in a range index by parametric name, unit and value. A search intersects
+# the parts matching each condition and returns their rows, usually in a few milliseconds.
+# The index is built on first use, and rebuilt whenever the file changes (by size and modification
+# time) or the way values are normalized changes (INDEX_VERSION).
+
+INDEX_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+  name TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rows (
+  row INTEGER PRIMARY KEY,
+  part INTEGER NOT NULL,
+  serial TEXT NOT NULL,
+  gridid TEXT NOT NULL,
+  digikey_pn TEXT NOT NULL,
+  title TEXT NOT NULL,
+  package TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rows_part ON rows (part);
+CREATE TABLE IF NOT EXISTS words (
+  name TEXT NOT NULL,
+  word TEXT NOT NULL,
+  part INTEGER NOT NULL,
+  PRIMARY KEY (name, word, part)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS words_word ON words (word, part);
+CREATE TABLE IF NOT EXISTS quantities (
+  name TEXT NOT NULL,
+  unit TEXT NOT NULL,
+  low REAL NOT NULL,
+  high REAL NOT NULL,
+  part INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS quantities_name ON quantities (name, unit, low);
+CREATE INDEX IF NOT EXISTS quantities_unit ON quantities (unit, low);
+"""
+
+# Columns of the rows returned by searches.
+RESULT_COLUMNS = ['serial', 'gridid', 'digikey_pn', 'title', 'package']
+
+# Short names for parametrics in search conditions, each searching any of its parametrics.
+NAME_ALIASES = {
+  'category': ['categories'],
+  'package': ['package / case', 'supplier device package'],
+  'mfrpn': ['manufacturer part number'],
+}
+
+# Number of rows inserted per statement batch while building an index.
+INDEX_BUILD_BATCH_ROWS = 10000
+
+# Relative tolerance when comparing quantities, which are stored as floats.
+QUANTITY_TOLERANCE = 1e-9
+
+def index_filename(filename):
+  return filename + '.partindex'
+
+unit_prefixes = {'p': -12, 'n': -9, 'u': -6, 'µ': -6, 'μ': -6, 'm': -3, '': 0, 'k': 3, 'K': 3, 'M': 6, 'G': 9}
+unit_names = {'Ohm': 'Ω', 'Ohms': 'Ω', 'Ω': 'Ω', '°C': '°C', 'Hz': 'Hz', 'F': 'F', 'V': 'V', 'A': 'A',
+              'W': 'W', 's': 's', 'H': 'H', '%': '%'}
+
+quantity_pattern = r'([-±]?)\s*(\d+/\d+|\d*\.?\d+)\s*([pnuµμmkKMG]?)(Ohms?|Ω|°C|Hz|F|V|A|W|s|H|%)?'
+quantity_re = re.compile(r'^%s$' % quantity_pattern)
+quantity_range_re = re.compile(r'^%s\s*~\s*%s$' % (quantity_pattern, quantity_pattern))
+paren_re = re.compile(r'\([^()]*\)')
+word_re = re.compile(r'[^\s,;()]+')
+
+# Returns the Decimal number of base units of a quantity's sign, number and prefix, or None.
+# A prefix without a unit (like the 'M' of 'M3') is not taken as a unitless number, unless
+# bare_prefix is set.
+def quantity_value(sign, number, prefix, unit, bare_prefix=False):
+  if not unit and prefix and not bare_prefix:
+    return None
+  try:
+    if '/' in number:
+      numerator, denominator = number.split('/')
+      value = Decimal(numerator) / Decimal(denominator)
+    else:
+      value = Decimal(number)
+  except (InvalidOperation, ZeroDivisionError):
+    return None
+  value = value.scaleb(unit_prefixes[prefix])
+  return -value if sign == '-' else value
+
+# Parses a parametric value which is a quantity, like '4.7 kOhms', '16V', '0.1µF', '±10%',
+# '1.25V ~ 37V' or '200mA (DC)', into (unit, low, high) in base units ('Ω', 4700, 4700), or None.
+# Only the leading quantity of a list ('0.25W, 1/4W') or a condition ('2V @ 1A') is taken, and
+# plain numbers have the unit ''.
+@functools.lru_cache(maxsize=65536)
+def parse_quantity(value):
+  value = paren_re.sub('', value).split(',')[0].split('@')[0].strip()
+  match = quantity_re.match(value)
+  if match:
+    sign, number, prefix, unit = match.groups()
+    quantity = quantity_value(sign, number, prefix, unit)
+    if quantity is None:
+      return None
+    return unit_names.get(unit, ''), float(quantity), float(quantity)
+  match = quantity_range_re.match(value)
+  if match:
+    low_sign, low_number, low_prefix, low_unit, high_sign, high_number, high_prefix, high_unit = match.groups()
+    unit = high_unit or low_unit  # like '2 ~ 6V'
+    if low_unit and unit_names[low_unit] != unit_names[unit]:
+      return None
+    low = quantity_value(low_sign, low_number, low_prefix, unit)
+    high = quantity_value(high_sign, high_number, high_prefix, unit)
+    if low is None or high is None:
+      return None
+    return unit_names.get(unit, ''), float(min(low, high)), float(max(low, high))
+  return None
+
+# Returns the set of (case-folded) words of a parametric value.
+def value_words(value):
+  return set(word_re.findall(value.casefold()))
+
+# Returns the parametric names (case-folded) a condition name searches.
+def condition_names(name):
+  name = name.strip().casefold()
+  return NAME_ALIASES.get(name, [name])
+
+def _first(row_dict, columns):
+  for column in columns:
+    if row_dict.get(column):
+      return row_dict[column]
+  return ''
+
+class PartIndex:
+  def __init__(self, filename, index_file=None):
+    self.filename = filename
+    self.index_file = index_file or index_filename(filename)
+    self.db = sqlite3.connect(self.index_file, timeout=30)
+    self.db.executescript(SCHEMA)
+    meta = dict(self.db.execute("SELECT name, value FROM meta"))
+    if meta.get('version') != file_version(filename) or meta.get('index_version') != str(INDEX_VERSION):
+      self.build()
+
+  # (Re)builds the index over the rows with parametrics, numbering parts by distinct parametrics.
+  def build(self):
+    version = file_version(self.filename)
+    source = read_csv(self.filename, None, stream=True)
+    assert 'parametrics' in source.header, \
+        "no parametrics column in %s, which should be the output of DigikeyCrawler.py" % self.filename
+    with self.db:
+      for table in ['rows', 'words', 'quantities', 'meta']:
+        self.db.execute("DELETE FROM %s" % table)
+      parts = {}  # parametrics string -> part
+      rows, words, quantities = [], [], []
+      for position, row_dict in enumerate(source.row_dicts()):
+        parametrics_str = row_dict['parametrics']
+        if not parametrics_str:
+          continue
+        part = parts.get(parametrics_str)
+        if part is None:
+          part = parts[parametrics_str] = len(parts)
+          for name, value in parse_parametrics(parametrics_str).items():
+            if name is None or not isinstance(value, str):
+              continue
+            name = name.casefold()
+            words.extend((name, word, part) for word in value_words(value))
+            quantity = parse_quantity(value)
+            if quantity is not None:
+              quantities.append((name,) + quantity + (part,))
+        rows.append((position, part, row_dict.get('serial', ''), row_dict.get('gridid', ''),
+                     row_dict.get('digikey_pn', ''), _first(row_dict, ['title', 'manual_title', 'dist_title']),
+                     _first(row_dict, ['package', 'manual_package', 'dist_package'])))
+        if len(rows) >= INDEX_BUILD_BATCH_ROWS:
+          self._insert(rows, words, quantities)
+          rows, words, quantities = [], [], []
+      self._insert(rows, words, quantities)
+      self.db.executemany("INSERT INTO meta VALUES (?, ?)",
+                          [('version', version), ('index_version', str(INDEX_VERSION))])
+
+  def _insert(self, rows, words, quantities):
+    self.db.executemany("INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    self.db.executemany("INSERT OR IGNORE INTO words VALUES (?, ?, ?)", words)
+    self.db.executemany("INSERT INTO quantities VALUES (?, ?, ?, ?, ?)", quantities)
+
+  # Returns the set of parts with a parametric value having every word of text, in the parametrics
+  # names (or any if None).
+  def parts_with_words(self, names, text):
+    matching = None
+    for word in value_words(text):
+      if names is None:
+        parts = self.db.execute("SELECT part FROM words WHERE word = ?", (word,))
+      else:
+        parts = self.db.execute("SELECT part FROM words WHERE name IN (%s) AND word = ?" % ', '.join('?' * len(names)),
+                                list(names) + [word])
+      parts = {part for (part,) in parts}
+      matching = parts if matching is None else matching & parts
+    return matching or set()
+
+  # Returns the set of parts with a quantity in the unit (or any if None) between low and high
+  # (inclusive; either can be None for no bound), in the parametrics names (or any if None). A value which is a range
+  # matches if it is within low and high, or if low equals high, if it includes that value.
+  def parts_with_quantity(self, names, unit, low, high):
+    if low is not None and low == high:
+      conditions, values = ["low <= ?", "high >= ?"], [low + abs(low) * QUANTITY_TOLERANCE,
+                                                       low - abs(low) * QUANTITY_TOLERANCE]
+    else:
+      conditions, values = [], []
+      if low is not None:
+        conditions.append("low >= ?")
+        values.append(low - abs(low) * QUANTITY_TOLERANCE)
+      if high is not None:
+        conditions.append("high <= ?")
+        values.append(high + abs(high) * QUANTITY_TOLERANCE)
+    if unit is not None:
+      conditions.append("unit = ?")
+      values.append(unit)
+    if names is not None:
+      conditions.append("name IN (%s)" % ', '.join('?' * len(names)))
+      values += names
+    query = "SELECT part FROM quantities WHERE %s" % ' AND '.join(conditions)
+    return {part for (part,) in self.db.execute(query, values)}
+
+  # Returns the set of parts matching a condition (see parse_condition).
+  def parts_matching(self, condition):
+    names, operator, value, quantity = condition
+    if quantity is None:
+      return self.parts_with_words(names, value)
+    unit, low, high = quantity
+    if operator == '>=':
+      return self.parts_with_quantity(names, unit, low, None)
+    if operator == '<=':
+      return self.parts_with_quantity(names, unit, None, high)
+    parts = self.parts_with_quantity(names, unit, low, high)
+    if operator == '=':
+      # Plain numbers are also words, like the '0603' of '0603 (1608 Metric)'.
+      parts |= self.parts_with_words(names, value)
+    return parts
+
+  # Returns the rows (as dicts of RESULT_COLUMNS) whose parts match every condition, in file order.
+  def search(self, conditions):
+    matching = None
+    for condition in conditions:
+      parts = self.parts_matching(condition)
+      matching = parts if matching is None else matching & parts
+    if matching is None:
+      return []
+    parts = sorted(matching)
+    rows = []
+    for start in range(0, len(parts), 500):
+      chunk = parts[start:start + 500]
+      rows += self.db.execute("SELECT row, %s FROM rows WHERE part IN (%s)" %
+                              (', '.join(RESULT_COLUMNS), ', '.join('?' * len(chunk))), chunk).fetchall()
+    return [dict(zip(RESULT_COLUMNS, row[1:])) for row in sorted(rows)]
+
+  def close(self):
+    self.db.close()
+
+# Raised for search conditions which cannot be searched, like NAME>=VALUE where VALUE is not a
+# quantity.
+class ConditionError(ValueError):
+  pass
+
+# Parses a quantity in a search condition, like parse_quantity but also taking a number with a
+# prefix and no unit (like '4.7k'), whose unit is then None. Returns (unit, low, high), or None.
+def parse_condition_quantity(text):
+  match = quantity_re.match(text.strip())
+  if not match or match.group(4) or not match.group(3):
+    return parse_quantity(text)
+  sign, number, prefix, _ = match.groups()
+  value = quantity_value(sign, number, prefix, None, bare_prefix=True)
+  if value is None:
+    return None
+  return None, float(value), float(value)
+
+# Parses a search condition into (names or None, operator, value, quantity or None):
+# - NAME=VALUE matches parts whose parametric NAME is the quantity VALUE (like 'Capacitance=100nF',
+#   also matching '0.1µF'), or else has every word of VALUE (like 'Categories=Ceramic Capacitors').
+# - NAME>=QUANTITY and NAME<=QUANTITY match parametrics at least or at most the quantity, and
+#   NAME=LOW..HIGH those between them. A range bound without a unit has the other bound's unit
+#   (like '1k..10kOhm').
+# - A bare VALUE is matched against every parametric, like '50V', 'X7R' or '0603'.
+# In a named condition, a quantity with a prefix and no unit (like 'Resistance>=10k') matches
+# values in any unit.
+# NAME is case insensitive, and can be an alias (NAME_ALIASES) like category or package.
+# Raises ConditionError for conditions which cannot be searched.
+def parse_condition(condition):
+  match = re.match(r'^([^=<>]+?)\s*(>=|<=|=)\s*(.*)$', condition)
+  if not match:
+    value = condition.strip()
+    return None, '=', value, parse_quantity(value)
+  name, operator, value = match.groups()
+  names = condition_names(name)
+  low, sep, high = value.partition('..')
+  if sep and operator == '=':
+    low_quantity, high_quantity = parse_condition_quantity(low), parse_condition_quantity(high)
+    if low_quantity is None or high_quantity is None:
+      raise ConditionError("bad range '%s', expected two quantities like 1k..10kOhm" % value)
+    if not low_quantity[0]:
+      low_quantity = (high_quantity[0],) + low_quantity[1:]
+    if not high_quantity[0]:
+      high_quantity = (low_quantity[0],) + high_quantity[1:]
+    if low_quantity[0] != high_quantity[0]:
+      raise ConditionError("bad range '%s', the bounds are in different units" % value)
+    return names, '..', value, (low_quantity[0], min(low_quantity[1], high_quantity[1]),
+                                max(low_quantity[2], high_quantity[2]))
+  quantity = parse_condition_quantity(value)
+  if quantity is None and operator != '=':
+    raise ConditionError("'%s' is not a quantity, which %s conditions need" % (value, operator))
+  return names, operator, value, quantity
+
+# Returns the rows of a crawled inventory file matching every condition (see parse_condition), in
+# file order, through its PartIndex.
+def search_parts(filename, conditions):
+  index = PartIndex(filename)
+  try:
+    return index.search([parse_condition(condition) for condition in conditions])
+  finally:
+    index.close()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="parametric part search, writing matching rows as CSV to stdout")
+  parser.add_argument('input', help="Inventory CSV (or column file) with parametrics, like the output of "
+                                    "DigikeyCrawler.py and DigikeyLabelGen.py")
+  parser.add_argument('conditions', nargs='+', metavar='CONDITION',
+                      help="NAME=VALUE, NAME>=QUANTITY, NAME<=QUANTITY, NAME=LOW..HIGH, or a bare VALUE "
+                           "matched against every parametric; rows must match every condition")
+  args = parser.parse_args()
+  try:
+    rows = search_parts(args.input, args.conditions)
+  except ConditionError as error:
+    parser.error(str(error))
+
+  output_writer = csv.writer(sys.stdout, delimiter=',')
+  output_writer.writerow(RESULT_COLUMNS)
+  for row_dict in rows:
+    output_writer.writerow([row_dict[column] for column in RESULT_COLUMNS])
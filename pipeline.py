@@ -0,0 +1,165 @@
+import argparse
+import copy
+import importlib.util
+import os
+import sys
+
+from columnfile import add_format_args, format_from_args
+from csvindex import add_where_args, where_from_args
+from labelannotator import *
+from labelprofiler import add_profile_args, profile_from_args, set_profile_script
+from planner import explain, optimize, plan_pipeline, prune, record_plan
+from rowcache import RowCachedCollection, RowResultCache, module_fingerprint, unwrap_rows
+from rowjoins import add_join_args, join_from_args
+from spillgroups import add_groupby_args, groupby_from_args
+
+# Runs a chain of annotator scripts as stages of a single pipeline in one interpreter, passing the
+# collection from stage to stage in memory instead of writing and reparsing a CSV file per stage.
+# Each annotator script defines annotate(rows), which takes a collection and returns the annotated
+# collection, and only calls load() / write() when run as a standalone script.
+# The stages are planned as a whole first (see planner.py), so filters on input columns run before
+# the expensive stages (like crawling) ahead of them rather than after.
+
+# Loaded stage modules, as absolute script path -> (modification time, module).
+stage_modules = {}
+
+# Imports an annotator script as a module, or returns the already-imported module if the file
+# has not changed since.
+def load_stage(script):
+  path = os.path.abspath(script)
+  mtime = os.path.getmtime(path)
+  if path in stage_modules and stage_modules[path][0] == mtime:
+    return stage_modules[path][1]
+
+  module_name = os.path.splitext(os.path.basename(path))[0]
+  spec = importlib.util.spec_from_file_location(module_name, path)
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[module_name] = module
+  spec.loader.exec_module(module)
+  assert hasattr(module, 'annotate'), "annotator script '%s' does not define annotate(rows)" % script
+
+  stage_modules[path] = (mtime, module)
+  return module
+
+# Returns the filename of the debug checkpoint written after stage i, named like the intermediate
+# files of a script-per-process chain.
+def checkpoint_name(output, i):
+  return '%s_%s' % (output, i)
+
+# Writes a collection to a file other than its output.
+def write_checkpoint(rows, filename):
+  checkpoint_rows = copy.copy(rows)
+  checkpoint_rows.outname = filename
+  checkpoint_rows.write()
+
+# Runs the annotator scripts in order over a collection, returning the final collection.
+# If checkpoints is set, the result of every stage but the last is also written out, see
+# checkpoint_name. If cache is passed, map_append stages go through that RowResultCache (see
+# rowcache.py), so they only run on rows they have not seen before.
+# If plan is set (and not checkpoints, which write the output of each stage as written), the
+# stages run as planned by planner.py.
+# If keep_columns is passed, only those columns are kept, and planned stages skip the map steps
+# which only compute other columns.
+def run_stages(rows, scripts, checkpoints=False, cache=None, plan=True, keep_columns=None):
+  modules = [load_stage(script) for script in scripts]
+  steps = plan_pipeline(modules, rows.header, keep_columns) if plan and not checkpoints else None
+  if steps is not None:
+    for step in steps:
+      set_profile_script(os.path.basename(scripts[step.stage]))
+      if cache:
+        # Keyed by the step's position in its stage as written, like unplanned stages.
+        rows = RowCachedCollection(rows, cache, module_fingerprint(modules[step.stage]), [step.call])
+      rows = unwrap_rows(step.apply(rows))
+    return rows
+
+  for i, (script, module) in enumerate(zip(scripts, modules)):
+    set_profile_script(os.path.basename(script))
+    if cache:
+      rows = RowCachedCollection(rows, cache, module_fingerprint(module))
+    rows = unwrap_rows(module.annotate(rows))
+    if checkpoints and i < len(scripts) - 1:
+      write_checkpoint(rows, checkpoint_name(rows.outname, i))
+      if isinstance(rows, CsvRowStream):
+        # Continue from the checkpoint rather than re-running every earlier stage on the next pass.
+        rows = read_csv(checkpoint_name(rows.outname, i), rows.outname, stream=True)
+  if keep_columns is not None:
+    rows = rows.select_columns(keep_columns)
+  return rows
+
+# Runs the annotator scripts in order over the input CSV, writing the result to output (see
+# run_stages). stream and columnar select the collection representation, as in read_csv.
+# If row_cache is set, it names a RowResultCache file which map_append stages go through.
+# If where is passed, only the input rows matching it are read, as in read_csv.
+# Returns the final collection.
+def run_pipeline(input, output, scripts, checkpoints=False, stream=False, columnar=False, row_cache=None,
+                 where=None, plan=True, keep_columns=None):
+  cache = RowResultCache(row_cache) if row_cache else None
+  rows = read_csv(input, output, stream=stream, columnar=columnar, where=where)
+  rows = run_stages(rows, scripts, checkpoints, cache, plan, keep_columns)
+
+  rows.write()
+  if cache:
+    cache.finish()
+    print("Row cache: %(hits)i rows reused, %(misses)i rows computed" % cache.stats)
+    cache.close()
+  return rows
+
+# Prints the plan of the annotator scripts over the input CSV, with the rows moved filters keep
+# from earlier stages, without running them.
+def explain_pipeline(input, scripts, where=None, keep_columns=None):
+  modules = [load_stage(script) for script in scripts]
+  source_columns = read_csv(input, None, stream=True, where=where).header
+  steps = record_plan(modules)
+  planned = optimize(steps, source_columns)
+  if keep_columns is not None:
+    planned = prune(planned, keep_columns)
+  for line in explain(steps, planned, input, [os.path.basename(script) for script in scripts], where=where):
+    print(line)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="in-process annotator pipeline")
+  parser.add_argument('--input', '-i', required=True,
+                      help="Input CSV file")
+  parser.add_argument('--output', '-o', required=True,
+                      help="Output CSV file")
+  parser.add_argument('--checkpoints', action='store_true',
+                      help="Also write the output of each intermediate stage, to OUTPUT_0, OUTPUT_1, ...")
+  add_representation_args(parser)
+  add_format_args(parser)
+  add_where_args(parser)
+  parser.add_argument('--row-cache', default=None,
+                      help="Cache file of per-row stage results, to only recompute new or changed rows")
+  add_groupby_args(parser)
+  add_join_args(parser)
+  add_profile_args(parser)
+  parser.add_argument('--no-plan', action='store_true',
+                      help="Run the stages as written, without moving filters ahead (see planner.py)")
+  parser.add_argument('--explain', action='store_true',
+                      help="Print the planned stages and the rows moved filters keep from them, then exit")
+  parser.add_argument('--for-template', action='append', default=[], metavar='TEMPLATE',
+                      help="Only compute and write the columns this label template uses (see labelrender.py). "
+                           "Can be repeated, for outputs feeding several templates")
+  parser.add_argument('--keep-column', action='append', default=[], metavar='COLUMN',
+                      help="Also keep this column with --for-template")
+  parser.add_argument('scripts', nargs='+',
+                      help="Annotator scripts, in pipeline order")
+  args = parser.parse_args()
+  format_from_args(args)
+  groupby_from_args(args)
+  join_from_args(args)
+  profile_from_args(args)
+
+  keep_columns = None
+  if args.for_template:
+    from labelrender import TemplatePlan  # only needed here, and slow to import
+    keep_columns = set()
+    for template in args.for_template:
+      keep_columns.update(TemplatePlan(template).fields)
+    keep_columns.update(args.keep_column)
+
+  if args.explain:
+    explain_pipeline(args.input, args.scripts, where=where_from_args(args), keep_columns=keep_columns)
+    sys.exit(0)
+  run_pipeline(args.input, args.output, args.scripts, checkpoints=args.checkpoints,
+               stream=args.stream, columnar=args.columnar, row_cache=args.row_cache,
+               where=where_from_args(args), plan=not args.no_plan, keep_columns=keep_columns)
@@ -0,0 +1,185 @@
+from labelannotator import read_csv
+
+# Query planning for annotator pipelines (see pipeline.py). Each stage's annotate(rows) is first
+# called on a PlanRecorder, which records the collection operations the stage chains instead of
+# running them, giving the whole pipeline as one list of steps. The planner then moves each filter
+# whose reads attribute only lists columns of the pipeline input ahead of the map_append steps
+# before it (up to a join, lookup or groupby, or the start of the pipeline), so the rows it drops
+# are not crawled and processed by earlier stages only to be dropped later.
+# Appended columns may not overlap existing ones, so map_append steps never change input columns,
+# and a moved filter sees the same values and keeps the same rows. The only visible difference is
+# that a column which only rows dropped by a moved filter would have had is not in the output.
+# If only some columns of the output are used (like the fields of a label template), the planner
+# also drops the map steps whose writes attribute lists only columns no later step reads and the
+# output does not keep, and ends the pipeline by selecting the kept columns.
+
+# Operations which can be recorded, and those filters can be moved ahead of.
+RECORDED_OPERATIONS = ['filter', 'map_append', 'map_append_batch', 'join', 'lookup', 'groupby', 'group_map',
+                       'select_columns']
+MOVABLE_PAST = {'filter', 'map_append', 'map_append_batch'}
+MAP_OPERATIONS = {'map_append', 'map_append_batch'}
+
+# Raised when a stage's annotate does something other than chaining recordable operations.
+class PlanUnsupported(Exception):
+  pass
+
+# One recorded collection operation, from the stage (script index) which called it. call is the
+# position of map steps among the stage's map steps, which their row cache keys use.
+class PlanStep:
+  def __init__(self, stage, kind, args, kwargs, call=None):
+    self.stage = stage
+    self.kind = kind
+    self.args = args
+    self.kwargs = kwargs
+    self.call = call
+    self.moved_past = 0  # number of steps this step was moved ahead of
+
+  @property
+  def fn(self):
+    return self.args[0] if self.args else self.kwargs.get('fn')
+
+  def reads(self):
+    return getattr(self.fn, 'reads', None)
+
+  def writes(self):
+    return getattr(self.fn, 'writes', None) if self.kind in MAP_OPERATIONS else None
+
+  def describe(self):
+    if self.kind == 'select_columns':
+      return '%s %s' % (self.kind, ', '.join(sorted(self.fn)))
+    name = getattr(self.fn, '__qualname__', type(self.fn).__name__).split('.<locals>')[0]
+    if self.kind == 'filter' and self.reads() is not None:
+      return '%s %s (reads %s)' % (self.kind, name, ', '.join(self.reads()))
+    return '%s %s' % (self.kind, name)
+
+  def apply(self, rows):
+    return getattr(rows, self.kind)(*self.args, **self.kwargs)
+
+# Stand-in collection handed to a stage's annotate(rows) while planning. Each operation appends a
+# PlanStep and returns a recorder for the result; operations must form a single chain.
+class PlanRecorder:
+  def __init__(self, steps, stage):
+    self._steps = steps
+    self._stage = stage
+    self._position = len(steps)  # steps recorded before this collection
+
+  def __getattr__(self, name):
+    if name not in RECORDED_OPERATIONS:
+      raise PlanUnsupported("'%s' on a collection cannot be planned" % name)
+
+    def record(*args, **kwargs):
+      if self._position != len(self._steps):
+        raise PlanUnsupported("'%s' on an earlier collection in the chain cannot be planned" % name)
+      call = None
+      if name in MAP_OPERATIONS:
+        call = sum(1 for step in self._steps if step.stage == self._stage and step.kind in MAP_OPERATIONS)
+      self._steps.append(PlanStep(self._stage, name, args, kwargs, call))
+      return PlanRecorder(self._steps, self._stage)
+    return record
+
+# Returns the list of steps of the stages (annotator modules) run in order.
+def record_plan(modules):
+  steps = []
+  for stage, module in enumerate(modules):
+    result = module.annotate(PlanRecorder(steps, stage))
+    if not isinstance(result, PlanRecorder) or result._position != len(steps):
+      raise PlanUnsupported("stage %i does not return the end of its chain" % stage)
+  return steps
+
+def _source_filter(step, source_columns):
+  return step.kind == 'filter' and step.reads() is not None and set(step.reads()) <= source_columns
+
+# Returns the steps reordered with filters of source columns moved ahead (see above). Such filters
+# keep their order among themselves.
+def optimize(steps, source_columns):
+  source_columns = set(source_columns)
+  planned = []
+  for step in steps:
+    position = len(planned)
+    if _source_filter(step, source_columns):
+      while position > 0 and planned[position - 1].kind in MOVABLE_PAST and \
+          not _source_filter(planned[position - 1], source_columns):
+        position -= 1
+    step.moved_past = len(planned) - position
+    planned.insert(position, step)
+  return planned
+
+# Returns the steps without the map steps which only write columns not in keep_columns and not
+# read by a later step, followed by a step selecting keep_columns. Steps which do not declare
+# their reads (and joins and groups) could read anything, so every step before them is kept.
+def prune(steps, keep_columns):
+  needed = set(keep_columns)
+  needs_all = False
+  kept = []
+  for step in reversed(steps):
+    writes = step.writes()
+    if not needs_all and writes is not None and needed.isdisjoint(writes):
+      continue
+    if step.kind in MOVABLE_PAST and step.reads() is not None:
+      needed.update(step.reads())
+    else:
+      needs_all = True
+    kept.append(step)
+  kept.reverse()
+  return kept + [PlanStep(steps[-1].stage if steps else 0, 'select_columns', (sorted(keep_columns),), {})]
+
+# Returns the planned steps for the stages (annotator modules) over an input with source_columns,
+# only keeping keep_columns if passed, or None (printing why) if some stage cannot be planned, in
+# which case it should be run as is.
+def plan_pipeline(modules, source_columns, keep_columns=None):
+  try:
+    steps = optimize(record_plan(modules), source_columns)
+  except PlanUnsupported as e:
+    print("Not planning pipeline: %s" % e)
+    return None
+  if keep_columns is not None:
+    steps = prune(steps, keep_columns)
+  return steps
+
+# Returns the lines describing the planned steps, with the rows each moved filter drops and the
+# rows each step no longer processes because of moved filters, counted by running the filters of
+# source columns over the input rows, and the steps dropped as their columns are not used.
+def explain(steps, planned, input, script_names, where=None):
+  source_columns = set(read_csv(input, None, stream=True, where=where).header)
+  source_filters = [step for step in steps if _source_filter(step, source_columns)]
+  passes = []  # per input row, the set of source filters (by index) it passes
+  for row_dict in read_csv(input, None, stream=True, where=where).row_dicts():
+    passes.append({i for (i, step) in enumerate(source_filters) if step.fn(row_dict)})
+  filter_index = {id(step): i for (i, step) in enumerate(source_filters)}
+
+  # Returns the number of rows passing every filter in before but failing one of the others.
+  def skipped(before, others):
+    others = others - before
+    return sum(1 for row_passes in passes if before <= row_passes and not others <= row_passes)
+
+  lines = ["Plan of %i steps over %i input rows:" % (len(planned), len(passes))]
+  original_position = {id(step): i for (i, step) in enumerate(steps)}
+  total_skipped = 0
+  skipping_steps = 0
+  for position, step in enumerate(planned):
+    if id(step) not in original_position:
+      lines.append("  %2i. %s" % (position + 1, step.describe()))
+      continue
+    filters_now = {filter_index[id(other)] for other in planned[:position] if id(other) in filter_index}
+    filters_before = {filter_index[id(other)] for other in steps[:original_position[id(step)]]
+                      if id(other) in filter_index}
+    note = ''
+    if id(step) in filter_index:
+      dropped = skipped(filters_now, filters_now | {filter_index[id(step)]})
+      note = ', drops %i rows' % dropped
+      if step.moved_past:
+        note = ', moved ahead of %i steps%s' % (step.moved_past, note)
+    elif step.kind != 'filter':
+      rows_skipped = skipped(filters_before, filters_now)
+      if rows_skipped:
+        note = ', skips %i rows' % rows_skipped
+        total_skipped += rows_skipped
+        skipping_steps += 1
+    lines.append("  %2i. [%s] %s%s" % (position + 1, script_names[step.stage], step.describe(), note))
+  lines.append("Rows avoided: %i row evaluations over %i steps" % (total_skipped, skipping_steps))
+  planned_ids = {id(step) for step in planned}
+  for step in steps:
+    if id(step) not in planned_ids:
+      lines.append("Skipped, writes unused columns: [%s] %s (%s)" % (script_names[step.stage], step.describe(),
+                                                                    ', '.join(step.writes())))
+  return lines
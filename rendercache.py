@@ -0,0 +1,114 @@
+import sqlite3
+import time
+
+from rowcache import row_hash
+
+# Per-label cache for labelrender.py: the rendered content of each label is stored by a fingerprint
+# of the compiled template (see TemplatePlan.fingerprint) and a hash of the row's values for the
+# fields the template uses, so a rebuild after an input edit only renders new or edited labels, and
+# assembles the other sheets from stored fragments. Labels are placed on their sheet outside the
+# stored fragment, so a row moving to another cell or sheet (like after an inserted row) still
+# reuses its fragment.
+# The least recently used fragments are evicted to keep the cache under a size budget, so the
+# fragments of old template versions age out.
+
+# Recency is kept apart from the fragments, so updating it does not rewrite the fragments.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fragments (
+  key TEXT PRIMARY KEY,
+  fragment TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fragment_use (
+  key TEXT PRIMARY KEY,
+  last_used REAL NOT NULL,
+  size INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS fragment_use_last_used ON fragment_use (last_used);
+"""
+
+DEFAULT_RENDER_CACHE_MB = 256
+
+# Number of new fragments buffered before they are written to the cache file.
+RENDER_CACHE_FLUSH_LABELS = 1000
+
+# Keys per lookup query, under the SQLite limit on query parameters.
+LOOKUP_CHUNK_KEYS = 500
+
+class RenderCache:
+  # plan_key: fingerprint of the compiled template, part of every label key.
+  # fields: the row columns the template uses, which are hashed for label keys.
+  # max_mb: the least recently used fragments are evicted when the stored fragments exceed this.
+  def __init__(self, path, plan_key, fields, max_mb=DEFAULT_RENDER_CACHE_MB):
+    self.path = path
+    self.plan_key = plan_key
+    self.fields = sorted(fields)
+    self.max_bytes = max_mb * 1024 * 1024
+    self.db = sqlite3.connect(path, timeout=30)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(SCHEMA)
+    self.db.commit()
+    self.total_size = self._stored_size()
+    self.pending = []  # new (key, fragment) not yet written
+    self.used = []  # keys of fragments looked up since the last flush, whose recency is updated then
+    self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+  def label_key(self, row_dict):
+    return '%s:%s' % (self.plan_key, row_hash(row_dict, self.fields))
+
+  # Returns the stored fragments for a list of keys, with None for missing ones.
+  def get_many(self, keys):
+    found = {}
+    for start in range(0, len(keys), LOOKUP_CHUNK_KEYS):
+      chunk = keys[start:start + LOOKUP_CHUNK_KEYS]
+      found.update(self.db.execute("SELECT key, fragment FROM fragments WHERE key IN (%s)" %
+                                   ','.join('?' * len(chunk)), chunk))
+    self.used.extend(found.keys())
+    self.stats['hits'] += len(found)
+    self.stats['misses'] += len(keys) - len(found)
+    return [found.get(key) for key in keys]
+
+  def put(self, key, fragment):
+    self.pending.append((key, fragment))
+    if len(self.pending) >= RENDER_CACHE_FLUSH_LABELS:
+      self._flush()
+
+  def _flush(self):
+    now = time.time()
+    self.db.executemany("UPDATE fragment_use SET last_used = ? WHERE key = ?", [(now, key) for key in self.used])
+    self.db.executemany("INSERT OR REPLACE INTO fragments VALUES (?, ?)", self.pending)
+    self.db.executemany("INSERT OR REPLACE INTO fragment_use VALUES (?, ?, ?)",
+                        [(key, now, len(fragment)) for (key, fragment) in self.pending])
+    self.total_size += sum(len(fragment) for (key, fragment) in self.pending)
+    self.pending = []
+    self.used = []
+    if self.total_size > self.max_bytes:
+      self._evict()
+    self.db.commit()
+
+  def _stored_size(self):
+    return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM fragment_use").fetchone()[0]
+
+  # Deletes least recently used fragments until the total size is within max_bytes.
+  def _evict(self):
+    self.total_size = self._stored_size()  # other processes may have written since
+    if self.total_size <= self.max_bytes:
+      return
+    for key, size in self.db.execute("SELECT key, size FROM fragment_use ORDER BY last_used").fetchall():
+      self.db.execute("DELETE FROM fragment_use WHERE key = ?", (key,))
+      self.db.execute("DELETE FROM fragments WHERE key = ?", (key,))
+      self.stats['evicted'] += 1
+      self.total_size -= size
+      if self.total_size <= self.max_bytes:
+        break
+
+  # Writes out new fragments and recency updates. Call once the output is written.
+  def finish(self):
+    self._flush()
+
+  # Starts another run through the same cache, for long-running processes (see watch.py).
+  def start_run(self):
+    self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+  def close(self):
+    self.db.close()
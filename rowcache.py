@@ -0,0 +1,271 @@
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Row-level incremental execution for annotator pipelines: the columns each map_append stage
+# appends to a row are stored by a hash of that input row and a fingerprint of the stage, so when
+# an input changes only new or edited rows go through the stage functions again, and unchanged rows
+# get their stored results (merged back in their original order, since the collection itself is
+# still processed in full).
+# Results are used until the row or the stage code changes: stage functions are assumed to be
+# deterministic, so anything they depend on besides the row (like the crawl cache TTL) is not
+# rechecked for cached rows. Delete the cache file to force a full rebuild.
+# Results are looked up a batch of rows at a time, so memory does not grow with the cache, and are
+# deleted once no run has used them for ROW_CACHE_KEEP_DAYS. Runs over part of the input (like with
+# --where, or an interrupted shard) therefore keep the results of the other rows, while those of
+# edited rows and old versions of a stage age out.
+
+# Recency is kept apart from the results, so updating it does not rewrite the results.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS row_results (
+  stage TEXT NOT NULL,
+  row_hash TEXT NOT NULL,
+  result TEXT NOT NULL,
+  PRIMARY KEY (stage, row_hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS row_use (
+  stage TEXT NOT NULL,
+  row_hash TEXT NOT NULL,
+  last_used REAL NOT NULL,
+  PRIMARY KEY (stage, row_hash)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS row_use_last_used ON row_use (last_used);
+"""
+
+# Number of new results (and recency updates) buffered before they are written to the cache file.
+ROW_CACHE_FLUSH_ROWS = 10000
+
+# Results not used by any run for this long are deleted.
+ROW_CACHE_KEEP_DAYS = 14
+
+# Keys per lookup query, under the SQLite limit on query parameters.
+LOOKUP_CHUNK_KEYS = 500
+
+# Column holding a row's position in a sharded input (see shards.py). It is not part of the row's
+# content, so it is left out of row hashes, and rows keep their results when they move.
+SHARD_ROW_COLUMN = '_shard_row'
+
+# Returns the hash of a row (dict or row view) by its column names and values. If reads is passed,
+# only those columns are hashed (see the reads attribute of row functions, in labelannotator.py).
+def row_hash(row_dict, reads=None):
+  if reads is None:
+    items = [(key, value) for (key, value) in row_dict.items() if key != SHARD_ROW_COLUMN]
+  else:
+    items = [(key, row_dict.get(key)) for key in reads]
+  row_text = '\x1e'.join(['%s\x1f%r' % item for item in items])
+  return hashlib.blake2b(row_text.encode('utf-8'), digest_size=16).hexdigest()
+
+# Returns the (name, filename) of a loaded annotator module and of every module in the same directory
+# that it refers to (like labelannotator.py), sorted by name.
+def module_dependencies(module):
+  module_dir = os.path.dirname(os.path.abspath(module.__file__))
+  module_names = {module.__name__}
+  for value in vars(module).values():
+    if inspect.ismodule(value):
+      module_names.add(value.__name__)
+    elif getattr(value, '__module__', None):
+      module_names.add(value.__module__)
+
+  dependencies = []
+  for name in sorted(module_names):
+    if name == module.__name__:
+      filename = module.__file__
+    else:
+      filename = getattr(sys.modules.get(name), '__file__', None)
+    if filename and os.path.dirname(os.path.abspath(filename)) == module_dir:
+      dependencies.append((name, filename))
+  return dependencies
+
+# Returns a fingerprint of a loaded annotator module: a hash of its source and of the source of
+# its dependencies (see module_dependencies), so editing any of them invalidates its stored results.
+def module_fingerprint(module):
+  digest = hashlib.blake2b(digest_size=16)
+  for name, filename in module_dependencies(module):
+    with open(filename, 'rb') as source:
+      digest.update(name.encode('utf-8') + b'\0' + source.read() + b'\0')
+  return digest.hexdigest()
+
+class RowResultCache:
+  # keep_days: results no run has used for this long are deleted when a run finishes.
+  def __init__(self, path, keep_days=ROW_CACHE_KEEP_DAYS):
+    self.path = path
+    self.keep_seconds = keep_days * 24 * 60 * 60
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(SCHEMA)
+    if self.db.execute("SELECT 1 FROM row_use LIMIT 1").fetchone() is None:
+      # Results stored before recency was kept count as used now.
+      self.db.execute("INSERT OR IGNORE INTO row_use SELECT stage, row_hash, ? FROM row_results", (time.time(),))
+    self.db.commit()
+    self.pending = {}  # new (stage key, row hash) -> result JSON not yet written
+    self.used = []  # (stage key, row hash) looked up since the last flush, whose recency is updated then
+    self.stats = {'hits': 0, 'misses': 0}
+
+  # Returns the stored results (dicts) for a list of row hashes in a stage, with None for missing ones.
+  def get_many(self, stage_key, keys):
+    with self.lock:
+      found = {}
+      missing = []
+      for key in keys:
+        if (stage_key, key) in self.pending:
+          found[key] = self.pending[(stage_key, key)]
+        else:
+          missing.append(key)
+      missing = list(dict.fromkeys(missing))
+      for start in range(0, len(missing), LOOKUP_CHUNK_KEYS):
+        chunk = missing[start:start + LOOKUP_CHUNK_KEYS]
+        found.update(self.db.execute("SELECT row_hash, result FROM row_results WHERE stage = ? AND row_hash IN (%s)" %
+                                     ','.join('?' * len(chunk)), [stage_key] + chunk))
+      self.used.extend((stage_key, key) for key in found)
+      hits = sum(1 for key in keys if key in found)
+      self.stats['hits'] += hits
+      self.stats['misses'] += len(keys) - hits
+      if len(self.used) >= ROW_CACHE_FLUSH_ROWS:
+        self._flush()
+    return [json.loads(found[key]) if key in found else None for key in keys]
+
+  # Returns the stored result (a dict) for a row hash in a stage, or None.
+  def get(self, stage_key, key):
+    return self.get_many(stage_key, [key])[0]
+
+  def put(self, stage_key, key, result):
+    result_json = json.dumps(result, ensure_ascii=False)
+    with self.lock:
+      self.pending[(stage_key, key)] = result_json
+      if len(self.pending) >= ROW_CACHE_FLUSH_ROWS:
+        self._flush()
+
+  def _flush(self):
+    now = time.time()
+    self.db.executemany("UPDATE row_use SET last_used = ? WHERE stage = ? AND row_hash = ?",
+                        [(now, stage_key, key) for (stage_key, key) in self.used])
+    self.db.executemany("INSERT OR REPLACE INTO row_results VALUES (?, ?, ?)",
+                        [(stage_key, key, result) for ((stage_key, key), result) in self.pending.items()])
+    self.db.executemany("INSERT OR REPLACE INTO row_use VALUES (?, ?, ?)",
+                        [(stage_key, key, now) for (stage_key, key) in self.pending])
+    self.db.commit()
+    self.pending = {}
+    self.used = []
+
+  # Returns fn wrapped to use stored results for rows already seen by this stage.
+  def cached_row_fn(self, fn, stage_key):
+    reads = getattr(fn, 'reads', None)
+    def cached_fn(row_dict):
+      key = row_hash(row_dict, reads)
+      result = self.get(stage_key, key)
+      if result is None:
+        result = fn(row_dict)
+        self.put(stage_key, key, result)
+      return result
+    return cached_fn
+
+  # Returns a map_append_batch function wrapped so only rows not seen by this stage are passed on
+  # to fn.
+  def cached_batch_fn(self, fn, stage_key):
+    reads = getattr(fn, 'reads', None)
+    def cached_fn(row_dicts):
+      keys = [row_hash(row_dict, reads) for row_dict in row_dicts]
+      results = self.get_many(stage_key, keys)
+      missing = [i for (i, result) in enumerate(results) if result is None]
+      if missing:
+        for i, result in zip(missing, fn([row_dicts[i] for i in missing])):
+          self.put(stage_key, keys[i], result)
+          results[i] = result
+      return results
+    return cached_fn
+
+  # Writes out new results and recency updates, and deletes the results no run has used for
+  # keep_days. Call once the pipeline output is written.
+  def finish(self):
+    with self.lock:
+      self._flush()
+      cutoff = time.time() - self.keep_seconds
+      self.db.execute("DELETE FROM row_results WHERE (stage, row_hash) IN "
+                      "(SELECT stage, row_hash FROM row_use WHERE last_used < ?)", (cutoff,))
+      self.db.execute("DELETE FROM row_use WHERE last_used < ?", (cutoff,))
+      self.db.commit()
+
+  # Starts another run through the same cache, for long-running processes (see watch.py).
+  def start_run(self):
+    with self.lock:
+      self.stats = {'hits': 0, 'misses': 0}
+
+  def close(self):
+    self.db.close()
+
+# Returns a map_append function as a map_append_batch function, calling it on each row.
+def per_row_batch_fn(fn):
+  def batch_fn(row_dicts):
+    return [fn(row_dict) for row_dict in row_dicts]
+  if hasattr(fn, 'reads'):
+    batch_fn.reads = fn.reads
+  return batch_fn
+
+# Collection wrapper handed to a stage's annotate(rows), which routes map_append and
+# map_append_batch through the row cache. Each call within the stage is a separate cache stage,
+# keyed by the stage fingerprint and the call's position in the stage. Serial map_append calls are
+# run as map_append_batch, so their rows are looked up in batches too.
+# Functions with a false row_cache attribute are not cached: looking up a row costs about as much as
+# running a simple function like PriorityMap, so only functions doing real work (crawling, parsing,
+# rule matching) benefit. Process-parallel map_append calls are not cached either, since the cached
+# function cannot be sent to worker processes.
+class RowCachedCollection:
+  def __init__(self, rows, cache, fingerprint, calls=None):
+    self.rows = rows
+    self.cache = cache
+    self.fingerprint = fingerprint
+    self.calls = calls if calls is not None else [0]  # shared by every collection of the stage
+
+  def _next_stage_key(self):
+    stage_key = '%s:%i' % (self.fingerprint, self.calls[0])
+    self.calls[0] += 1
+    return stage_key
+
+  def _wrap(self, rows):
+    return RowCachedCollection(rows, self.cache, self.fingerprint, self.calls)
+
+  def map_append(self, fn, workers=None, backend='thread', chunk_size=None):
+    stage_key = self._next_stage_key()
+    if getattr(fn, 'row_cache', True) and not (workers and workers > 1):
+      # Serial stages run as batches, so their rows are looked up a batch at a time.
+      return self._wrap(self.rows.map_append_batch(self.cache.cached_batch_fn(per_row_batch_fn(fn), stage_key)))
+    if getattr(fn, 'row_cache', True) and backend != 'process':
+      fn = self.cache.cached_row_fn(fn, stage_key)
+    return self._wrap(self.rows.map_append(fn, workers, backend, chunk_size))
+
+  def map_append_batch(self, fn):
+    stage_key = self._next_stage_key()
+    if getattr(fn, 'row_cache', True):
+      fn = self.cache.cached_batch_fn(fn, stage_key)
+    return self._wrap(self.rows.map_append_batch(fn))
+
+  def filter(self, fn):
+    return self._wrap(self.rows.filter(fn))
+
+  def select_columns(self, columns):
+    return self._wrap(self.rows.select_columns(columns))
+
+  def join(self, *args, **kwargs):
+    return self._wrap(self.rows.join(*args, **kwargs))
+
+  def lookup(self, *args, **kwargs):
+    return self._wrap(self.rows.lookup(*args, **kwargs))
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getattr__(self, name):
+    return getattr(self.rows, name)
+
+# Returns the underlying collection of a (possibly) RowCachedCollection.
+def unwrap_rows(rows):
+  while isinstance(rows, RowCachedCollection):
+    rows = rows.rows
+  return rows
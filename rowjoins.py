@@ -0,0 +1,209 @@
+import itertools
+
+from spillgroups import ROW_SIZE_SAMPLE_ROWS, SortSpool, row_size
+
+# Joins of a collection (the left side) with another collection (the right side) on key columns,
+# for the join and lookup operations of CsvRowCollection and friends.
+# Rows are matched with a hash index, built once on the smaller side, while the index fits in the
+# join memory budget (--join-memory-mb). Past the budget, joins fall back to a sort-merge join:
+# both sides are sorted on disk (see spillgroups.SortSpool) and merged, so only the rows of one key
+# are in memory at a time. Either way, output rows are in left order, and the matches of a left row
+# in right order.
+
+# Kinds of join: inner keeps a row per matching (left, right) pair, left also keeps unmatched left
+# rows (with empty right columns), and anti only keeps unmatched left rows (without right columns).
+# lookup is the left join keeping only the first match of each left row, for join tables.
+JOIN_HOWS = ['inner', 'left', 'anti', 'lookup']
+JOIN_METHODS = [None, 'hash', 'merge']
+
+DEFAULT_JOIN_MEMORY_MB = 256
+
+# Memory budget for join hash indexes and sorts, in MB (None for no limit).
+join_memory_mb = DEFAULT_JOIN_MEMORY_MB
+
+class JoinIndexTooLarge(Exception):
+  pass
+
+def key_columns(on):
+  return [on] if isinstance(on, str) else list(on)
+
+def key_fn(columns):
+  def row_key(row_dict):
+    return tuple(row_dict[column] for column in columns)
+  return row_key
+
+def memory_budget():
+  return join_memory_mb * 1024 * 1024 if join_memory_mb is not None else None
+
+# Returns the number of rows in a collection, or None for a CsvRowStream.
+def collection_len(collection):
+  if hasattr(collection, 'row_source'):
+    return None
+  return len(collection)
+
+# Generator over the rows of the right side, as (key, row dict without the key columns). columns is
+# filled with the right columns, in the order they first appear.
+def right_items(row_dicts, on, columns):
+  row_key = key_fn(on)
+  seen = set(on)
+  for row_dict in row_dicts:
+    for key in row_dict:
+      if key not in seen:
+        seen.add(key)
+        columns.append(key)
+    yield row_key(row_dict), {key: value for (key, value) in row_dict.items() if key not in on}
+
+# Returns a dict of key -> list of row dicts. Raises JoinIndexTooLarge past budget (bytes, or None).
+def build_index(items, budget):
+  index = {}
+  size = 0
+  sampled_size = 0
+  for i, (key, row_dict) in enumerate(items):
+    if key not in index:
+      index[key] = []
+    index[key].append(row_dict)
+    if budget is not None:
+      if i % ROW_SIZE_SAMPLE_ROWS == 0:
+        sampled_size = row_size(row_dict)
+      size += sampled_size
+      if size > budget:
+        raise JoinIndexTooLarge()
+  return index
+
+# Returns the hash index (see build_index) of a right side collection, with its right columns, as
+# (columns, index), or None if method is None and the index is over the join memory budget.
+def right_index(other, other_on, method=None):
+  columns = []
+  try:
+    index = build_index(right_items(other.row_dicts(), other_on, columns),
+                        memory_budget() if method is None else None)
+  except JoinIndexTooLarge:
+    return None
+  return columns, index
+
+# Returns the (left row, matches) of rows from left_row_dicts (a list), indexing the left side.
+def _left_indexed_matches(left_row_dicts, left_key, right):
+  index = {}
+  for i, row_dict in enumerate(left_row_dicts):
+    index.setdefault(left_key(row_dict), []).append(i)
+  matches = [[] for _ in left_row_dicts]
+  for key, right_row in right:
+    for i in index.get(key, ()):
+      matches[i].append(right_row)
+  return zip(left_row_dicts, matches)
+
+def _seq_row_size(item):
+  return row_size(item[1])
+
+def _matches_size(item):
+  row_dict, matches = item
+  return row_size(row_dict) + sum(row_size(match) for match in matches)
+
+# Sort-merge matching. The left rows are read (and sorted to disk) when this is constructed, and
+# iterating gives (left row, matches) in left order; it can be iterated more than once.
+class MergeMatches:
+  def __init__(self, left_row_dicts, left_key, right_spool):
+    self.left_spool = SortSpool(join_memory_mb, _seq_row_size)
+    for seq, row_dict in enumerate(left_row_dicts):
+      self.left_spool.add(left_key(row_dict), (seq, row_dict))
+    self.right_spool = right_spool
+
+  # Generator over ((seq, left row), matches), in key order.
+  def _merged(self):
+    right_groups = itertools.groupby(self.right_spool.items(), key=lambda entry: entry[0])
+    right_key, right_group = next(right_groups, (None, None))
+    for key, left_group in itertools.groupby(self.left_spool.items(), key=lambda entry: entry[0]):
+      while right_group is not None and right_key < key:
+        right_key, right_group = next(right_groups, (None, None))
+      matches = []
+      if right_group is not None and right_key == key:
+        matches = [right_row for (_, right_row) in right_group]
+        right_key, right_group = next(right_groups, (None, None))
+      for (_, left_item) in left_group:
+        yield left_item, matches
+
+  def __iter__(self):
+    # Back into left order, with a second sort by left position.
+    ordered = SortSpool(join_memory_mb, _matches_size)
+    for (seq, row_dict), matches in self._merged():
+      ordered.add(seq, (row_dict, matches))
+    try:
+      for seq, item in ordered.items():
+        yield item
+    finally:
+      ordered.close()
+
+# Returns (right columns, iterable of (left row dict, list of matching right row dicts)) for the
+# rows of left_row_dicts (a list, or for the merge method any iterable), in left order. The right
+# row dicts do not have the key columns, and are shared between left rows, so must not be modified.
+# method is 'hash' or 'merge' to force one, or None to pick one by the join memory budget.
+def match_rows(left_row_dicts, other, on, other_on=None, method=None):
+  assert method in JOIN_METHODS, "unknown join method '%s', expected one of %s" % (method, JOIN_METHODS)
+  on = key_columns(on)
+  other_on = key_columns(other_on) if other_on is not None else on
+  assert len(on) == len(other_on), "join on %s and %s" % (on, other_on)
+  left_key = key_fn(on)
+
+  if method != 'merge':
+    other_len = collection_len(other)
+    if isinstance(left_row_dicts, list) and other_len is not None and len(left_row_dicts) < other_len:
+      # The left side is already in memory, so it is indexed with no budget.
+      columns = []
+      return columns, _left_indexed_matches(left_row_dicts, left_key,
+                                            right_items(other.row_dicts(), other_on, columns))
+    indexed = right_index(other, other_on, method)
+    if indexed is not None:
+      columns, index = indexed
+      return columns, ((row_dict, index.get(left_key(row_dict), [])) for row_dict in left_row_dicts)
+
+  columns = []
+  right_spool = SortSpool(join_memory_mb)
+  for key, right_row in right_items(other.row_dicts(), other_on, columns):
+    right_spool.add(key, right_row)
+  return columns, MergeMatches(left_row_dicts, left_key, right_spool)
+
+# Asserts the right columns do not overlap the left columns, as for map_append.
+def check_overlap(header, columns):
+  overlap = set(header) & set(columns)
+  assert not overlap, "overlap between row %s and join %s" % (list(header), list(columns))
+
+# Returns the output row dicts for a left row and its matches.
+def joined_row_dicts(row_dict, matches, how):
+  if how == 'anti':
+    return [] if matches else [row_dict]
+  if how == 'lookup':
+    matches = matches[:1]
+  if not matches:
+    return [row_dict] if how != 'inner' else []
+  joined = []
+  for match in matches:
+    joined_row = type(row_dict)(row_dict)
+    joined_row.update(match)
+    joined.append(joined_row)
+  return joined
+
+# Returns the output header and rows of a join of an in-memory collection (see
+# CsvRowCollection.join), given its header and row dicts.
+def join_rows(header, left_row_dicts, other, on, how, other_on, method):
+  assert how in JOIN_HOWS, "unknown join '%s', expected one of %s" % (how, JOIN_HOWS)
+  columns, matches = match_rows(left_row_dicts, other, on, other_on, method)
+  check_overlap(header, columns)
+  new_rows = []
+  if how == 'anti':
+    new_header = list(header)
+  else:
+    new_header = list(header) + sorted(columns)
+  for row_dict, row_matches in matches:
+    for joined_row in joined_row_dicts(row_dict, row_matches, how):
+      new_rows.append([joined_row.get(key, "") for key in new_header])
+  return new_header, new_rows
+
+# Adds the join options to an argument parser.
+def add_join_args(parser):
+  parser.add_argument('--join-memory-mb', type=float, default=DEFAULT_JOIN_MEMORY_MB,
+                      help="Memory budget for join indexes; larger joins sort-merge on disk instead")
+
+# Sets the join memory budget from the options from add_join_args.
+def join_from_args(args):
+  global join_memory_mb
+  join_memory_mb = args.join_memory_mb
@@ -0,0 +1,317 @@
+import argparse
+import bisect
+import csv
+import hashlib
+import heapq
+import os
+import shlex
+import subprocess
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from columnfile import add_format_args, format_from_args, open_output
+from crawlcache import ParametricsCache
+from labelannotator import add_representation_args, read_csv, read_csv_header
+from rowcache import SHARD_ROW_COLUMN
+
+# Sharded execution of annotator pipelines, for inventories too large to rebuild as one serial
+# pipeline run. The input is split by a key column into shard CSV files, each row tagged with its
+# position in the input (SHARD_ROW_COLUMN), the whole pipeline (pipeline.py) runs on each shard, and
+# the shard outputs are merged back in input order under one header. Shards run as processes on
+# this host (run), or on several hosts sharing a directory (split, one pipeline.py per shard, then
+# merge).
+# Rows are assigned to shards by a hash of the key, which keeps a key in the same shard across runs
+# (so each shard's row cache stays useful), or by ranges of key values of about equal size. Either
+# way rows with the same key are in the same shard, so groupby stages on the key see whole groups.
+# Workers look parts up in the build's crawl cache read only and write the parts they fetch to
+# their own crawl cache (see DigikeyCrawler.py), which are merged into the build's cache at the end.
+
+SHARD_METHODS = ['hash', 'range']
+
+PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.py')
+
+def shard_input_name(work_dir, i):
+  return os.path.join(work_dir, 'shard_%i.csv' % i)
+
+def shard_output_name(work_dir, i):
+  return os.path.join(work_dir, 'shard_%i.out' % i)
+
+def shard_crawl_cache_name(work_dir, i):
+  return os.path.join(work_dir, 'shard_%i.crawlcache.sqlite' % i)
+
+def shard_log_name(work_dir, i):
+  return os.path.join(work_dir, 'shard_%i.log' % i)
+
+# The build's crawl cache and its size budget, from the same environment as DigikeyCrawler.py.
+def crawl_cache_path():
+  return os.environ.get('DIGIKEY_CRAWL_CACHE', '.crawlcache.sqlite')
+
+def crawl_cache_bytes():
+  return int(float(os.environ.get('DIGIKEY_CRAWL_CACHE_MB', '64')) * 1024 * 1024)
+
+# Creates the build's crawl cache if missing, since workers open it read only.
+def create_crawl_cache():
+  ParametricsCache(crawl_cache_path(), None, max_bytes=crawl_cache_bytes()).close()
+
+# Returns the shard of a key value by hash, which unlike hash() is the same in every process.
+def hash_shard(value, num_shards):
+  return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little') % num_shards
+
+# Returns the key values splitting values into num_shards ranges of about equal size. A value equal
+# to a bound goes in the range above it.
+def range_bounds(values, num_shards):
+  values = sorted(values)
+  if not values:
+    return []
+  return [values[len(values) * i // num_shards] for i in range(1, num_shards)]
+
+# Splits the rows of input into num_shards shard CSV files in work_dir by the key column, with the
+# position of each row appended as SHARD_ROW_COLUMN. Returns the number of rows in each shard.
+def split_input(input, work_dir, num_shards, key, method='hash'):
+  assert method in SHARD_METHODS, "unknown shard method '%s', expected one of %s" % (method, SHARD_METHODS)
+  source = read_csv(input, None, stream=True)
+  header = source.header
+  assert key in header, "no column '%s' in %s, columns are %s" % (key, input, header)
+  assert SHARD_ROW_COLUMN not in header, "%s is already sharded" % input
+  key_index = header.index(key)
+
+  def padded_rows():
+    for row in source.row_source():
+      yield row + [''] * (len(header) - len(row))
+
+  if method == 'range':
+    bounds = range_bounds([row[key_index] for row in padded_rows()], num_shards)
+    shard_of = lambda value: bisect.bisect_right(bounds, value)
+  else:
+    shard_of = lambda value: hash_shard(value, num_shards)
+
+  os.makedirs(work_dir, exist_ok=True)
+  counts = [0] * num_shards
+  with ExitStack() as exit_stack:
+    writers = []
+    for i in range(num_shards):
+      outfile = exit_stack.enter_context(open(shard_input_name(work_dir, i), 'w', newline='', encoding='utf-8'))
+      writers.append(csv.writer(outfile, delimiter=','))
+      writers[-1].writerow(header + [SHARD_ROW_COLUMN])
+    for position, row in enumerate(padded_rows()):
+      shard = shard_of(row[key_index])
+      writers[shard].writerow(row + [str(position)])
+      counts[shard] += 1
+  return counts
+
+# Returns the pipeline.py command running scripts over shard i. pipeline_args are passed on (like
+# --stream or --for-template); row_cache, if set, is suffixed with the shard number, since each shard
+# keeps its own row cache.
+def shard_command(work_dir, i, scripts, pipeline_args=(), row_cache=None):
+  command = [sys.executable, PIPELINE, '-i', shard_input_name(work_dir, i), '-o', shard_output_name(work_dir, i),
+             '--output-format', 'columns', '--output-compression', 'zlib', '--keep-column', SHARD_ROW_COLUMN]
+  if row_cache:
+    command += ['--row-cache', '%s.shard%i' % (row_cache, i)]
+  return command + list(pipeline_args) + list(scripts)
+
+# Returns the environment of the worker running shard i out of workers running at once: the build's
+# crawl cache is shared read only, new parts go to the shard's own crawl cache, and the crawl rate
+# and connection limits are divided between the workers.
+def shard_environment(work_dir, i, workers):
+  env = dict(os.environ)
+  env['DIGIKEY_CRAWL_SHARED_CACHE'] = os.path.abspath(crawl_cache_path())
+  env['DIGIKEY_CRAWL_CACHE'] = os.path.abspath(shard_crawl_cache_name(work_dir, i))
+  requests_per_second = float(env.get('DIGIKEY_CRAWL_RPS', '4'))
+  if requests_per_second > 0:
+    env['DIGIKEY_CRAWL_RPS'] = str(requests_per_second / workers)
+  env['DIGIKEY_CRAWL_CONNECTIONS'] = str(max(1, int(env.get('DIGIKEY_CRAWL_CONNECTIONS', '4')) // workers))
+  return env
+
+# Returns the command line running shard i on another host sharing work_dir, with its environment.
+# pipeline_args and row_cache are as in shard_command.
+def shard_command_line(work_dir, i, scripts, workers, pipeline_args=(), row_cache=None):
+  env = shard_environment(work_dir, i, workers)
+  settings = ['%s=%s' % (name, shlex.quote(env[name])) for name in
+              ['DIGIKEY_CRAWL_SHARED_CACHE', 'DIGIKEY_CRAWL_CACHE', 'DIGIKEY_CRAWL_RPS', 'DIGIKEY_CRAWL_CONNECTIONS']]
+  command = shard_command(work_dir, i, scripts, pipeline_args, row_cache)
+  return ' '.join(settings + [shlex.quote(arg) for arg in command])
+
+# Runs the pipeline over every shard in work_dir, on up to workers processes at once, then merges
+# the parts the shards crawled into the build's crawl cache.
+def run_shards(work_dir, num_shards, scripts, pipeline_args=(), row_cache=None, workers=None):
+  workers = min(workers or num_shards, num_shards)
+  create_crawl_cache()
+
+  def run_shard(i):
+    with open(shard_log_name(work_dir, i), 'w', encoding='utf-8') as log_file:
+      result = subprocess.run(shard_command(work_dir, i, scripts, pipeline_args, row_cache),
+                              env=shard_environment(work_dir, i, workers), stdout=log_file,
+                              stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+      with open(shard_log_name(work_dir, i), 'r', encoding='utf-8') as log_file:
+        log_tail = log_file.read()[-2000:]
+      raise Exception("shard %i failed with exit status %i, see %s:\n%s" %
+                      (i, result.returncode, shard_log_name(work_dir, i), log_tail))
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    list(executor.map(run_shard, range(num_shards)))
+  merge_crawl_caches(work_dir, num_shards)
+
+# Merges the crawl caches written by the shard workers into the build's crawl cache.
+def merge_crawl_caches(work_dir, num_shards):
+  crawl_cache = ParametricsCache(crawl_cache_path(), None, max_bytes=crawl_cache_bytes())
+  try:
+    for i in range(num_shards):
+      if os.path.exists(shard_crawl_cache_name(work_dir, i)):
+        crawl_cache.merge(shard_crawl_cache_name(work_dir, i))
+  finally:
+    crawl_cache.close()
+
+# Returns a header with the columns of every header, in an order consistent with each of them.
+# Shard outputs can miss columns only appended to rows of other shards; columns whose relative
+# order no header gives are placed alphabetically, like the columns appended by one map_append.
+def merge_headers(headers):
+  successors = {}
+  num_predecessors = {}
+  first_seen = []
+  for header in headers:
+    for key in header:
+      if key not in successors:
+        successors[key] = set()
+        num_predecessors[key] = 0
+        first_seen.append(key)
+    for key, next_key in zip(header, header[1:]):
+      if next_key not in successors[key]:
+        successors[key].add(next_key)
+        num_predecessors[next_key] += 1
+
+  merged = []
+  ready = [key for key in first_seen if num_predecessors[key] == 0]
+  heapq.heapify(ready)
+  while ready:
+    key = heapq.heappop(ready)
+    merged.append(key)
+    for next_key in successors[key]:
+      num_predecessors[next_key] -= 1
+      if num_predecessors[next_key] == 0:
+        heapq.heappush(ready, next_key)
+  # Headers ordering columns differently leave a cycle; those columns go last.
+  return merged + [key for key in first_seen if key not in set(merged)]
+
+# Deletes the files of the shards in work_dir, and work_dir if that leaves it empty.
+def remove_shards(work_dir, num_shards):
+  for i in range(num_shards):
+    for filename in [shard_input_name(work_dir, i), shard_output_name(work_dir, i),
+                     shard_crawl_cache_name(work_dir, i), shard_log_name(work_dir, i)]:
+      if os.path.exists(filename):
+        os.remove(filename)
+  if not os.listdir(work_dir):
+    os.rmdir(work_dir)
+
+# Generator over (input position, row dict) of a shard output, which must be in input order.
+def shard_rows(filename):
+  last_position = -1
+  for row_dict in read_csv(filename, None, stream=True).row_dicts():
+    position = int(row_dict[SHARD_ROW_COLUMN])
+    assert position >= last_position, \
+        "rows of %s are not in input order, which sharded pipelines must keep (like groupby stages do not)" % filename
+    last_position = position
+    yield position, row_dict
+
+# Merges the shard outputs of work_dir into output (in the format set by add_format_args), in input
+# order and without SHARD_ROW_COLUMN. Returns the number of rows written.
+def merge_outputs(work_dir, num_shards, output):
+  shard_outputs = [shard_output_name(work_dir, i) for i in range(num_shards)]
+  header = [key for key in merge_headers([read_csv_header(filename) for filename in shard_outputs])
+            if key != SHARD_ROW_COLUMN]
+  num_rows = 0
+  with open_output(output, header) as output_writer:
+    for position, row_dict in heapq.merge(*[shard_rows(filename) for filename in shard_outputs],
+                                          key=lambda item: item[0]):
+      output_writer.writerow([row_dict[key] for key in header])
+      num_rows += 1
+  return num_rows
+
+def add_shard_args(parser):
+  parser.add_argument('--work-dir', required=True,
+                      help="Directory of the shard files, shared by every host running shards")
+  parser.add_argument('--shards', type=int, required=True,
+                      help="Number of shards")
+
+def add_split_args(parser):
+  parser.add_argument('--input', '-i', required=True,
+                      help="Input CSV file")
+  parser.add_argument('--shard-by', default='serial', metavar='COLUMN',
+                      help="Key column rows are split by; rows with the same key are in the same shard")
+  parser.add_argument('--shard-method', choices=SHARD_METHODS, default='hash',
+                      help="Split by a hash of the key, or by ranges of key values")
+
+# Options passed on to the pipeline of every shard, by split (in the printed commands) and run.
+def add_pipeline_args(parser):
+  parser.add_argument('--row-cache', default=None,
+                      help="Cache file of per-row stage results, suffixed with .shardN for each shard")
+  parser.add_argument('--for-template', action='append', default=[], metavar='TEMPLATE',
+                      help="Only compute and write the columns this label template uses (see pipeline.py)")
+  add_representation_args(parser)
+
+# Returns the pipeline.py arguments of the options from add_pipeline_args, except --row-cache which
+# differs between shards (see shard_command).
+def pipeline_args_from_args(args):
+  pipeline_args = []
+  for template in args.for_template:
+    pipeline_args += ['--for-template', template]
+  if args.stream:
+    pipeline_args.append('--stream')
+  if args.columnar:
+    pipeline_args.append('--columnar')
+  return pipeline_args
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="sharded annotator pipeline runner")
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  split_parser = commands.add_parser('split', help="Split an input into shards, printing the pipeline "
+                                                   "command of each shard if scripts are given")
+  add_shard_args(split_parser)
+  add_split_args(split_parser)
+  add_pipeline_args(split_parser)
+  split_parser.add_argument('scripts', nargs='*',
+                            help="Annotator scripts, in pipeline order")
+
+  merge_parser = commands.add_parser('merge', help="Merge the outputs and crawl caches of finished shards")
+  add_shard_args(merge_parser)
+  merge_parser.add_argument('--output', '-o', required=True,
+                            help="Output CSV file")
+  add_format_args(merge_parser)
+
+  run_parser = commands.add_parser('run', help="Split an input, run the pipeline on every shard on local "
+                                               "worker processes, and merge the outputs")
+  add_shard_args(run_parser)
+  add_split_args(run_parser)
+  run_parser.add_argument('--output', '-o', required=True,
+                          help="Output CSV file")
+  run_parser.add_argument('--workers', type=int, default=None,
+                          help="Number of shards running at once (default: all of them)")
+  add_pipeline_args(run_parser)
+  add_format_args(run_parser)
+  run_parser.add_argument('scripts', nargs='+',
+                          help="Annotator scripts, in pipeline order")
+  args = parser.parse_args()
+
+  if args.command in ('split', 'run'):
+    counts = split_input(args.input, args.work_dir, args.shards, args.shard_by, args.shard_method)
+    print("Split %i rows of %s into %i shards of %s rows" %
+          (sum(counts), args.input, args.shards, ', '.join(str(count) for count in counts)))
+  if args.command == 'split':
+    create_crawl_cache()
+    for i in range(args.shards if args.scripts else 0):
+      print(shard_command_line(args.work_dir, i, args.scripts, args.shards, pipeline_args_from_args(args),
+                               args.row_cache))
+  if args.command == 'run':
+    run_shards(args.work_dir, args.shards, args.scripts, pipeline_args_from_args(args), args.row_cache,
+               args.workers)
+  if args.command in ('merge', 'run'):
+    format_from_args(args)
+    if args.command == 'merge':
+      merge_crawl_caches(args.work_dir, args.shards)
+    num_rows = merge_outputs(args.work_dir, args.shards, args.output)
+    print("Merged %i rows of %i shards into %s" % (num_rows, args.shards, args.output))
+  if args.command == 'run':
+    remove_shards(args.work_dir, args.shards)
@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import pickle
+import sys
+import tempfile
+
+# Out-of-core grouping for CsvRowCollection.groupby and friends. Rows are buffered in memory by
+# group until their estimated size passes a memory budget, then the buffer is spilled to a temporary
+# run file (ordered by group), and the groups are read back by merging the runs, one group at a
+# time. Groups come out in the order their first row was added, and each group's rows in the order
+# they were added, whether or not anything was spilled. Only the group keys (and their order) stay
+# in memory, so grouping a file much larger than memory only needs the budget plus one group.
+
+DEFAULT_GROUPBY_MEMORY_MB = 256
+
+# Memory budget of the GroupSpools made by new_group_spool, in MB (None for no limit).
+groupby_memory_mb = DEFAULT_GROUPBY_MEMORY_MB
+
+# Rows are sized (see row_size) once every ROW_SIZE_SAMPLE_ROWS rows, and the rows in between are
+# assumed to be the same size, since sizing every row would cost more than grouping it.
+ROW_SIZE_SAMPLE_ROWS = 64
+
+# Returns a rough estimate of the memory used by a row dict, in bytes.
+def row_size(row_dict):
+  return sys.getsizeof(row_dict) + sum(sys.getsizeof(value) for value in row_dict.values())
+
+# Runs are merged into one once there are more than MAX_SPILL_RUNS of them, which bounds the number
+# of open temporary files.
+MAX_SPILL_RUNS = 64
+
+# Items per record in SortSpool run files.
+SORT_RUN_CHUNK_ITEMS = 1024
+
+# Generator over the records of a run file: (group ordinal, group key, row dicts) for a GroupSpool,
+# or a list of (sort key, item) for a SortSpool.
+def _run_records(run_file):
+  run_file.seek(0)
+  while True:
+    try:
+      yield pickle.load(run_file)
+    except EOFError:
+      return
+
+# Merges iterables of records ordered by group ordinal into one, with the records of each group
+# joined. heapq.merge keeps records of the same group in iterable order, so iterables must be passed
+# oldest first for rows to stay in the order they were added.
+def _merge_records(record_iterables):
+  current_ordinal, current_group, current_rows = None, None, []
+  for ordinal, group, row_dicts in heapq.merge(*record_iterables, key=lambda record: record[0]):
+    if ordinal != current_ordinal:
+      if current_ordinal is not None:
+        yield current_ordinal, current_group, current_rows
+      current_ordinal, current_group, current_rows = ordinal, group, []
+    current_rows.extend(row_dicts)
+  if current_ordinal is not None:
+    yield current_ordinal, current_group, current_rows
+
+def _write_run(records, spill_dir):
+  run_file = tempfile.TemporaryFile(dir=spill_dir)
+  for record in records:
+    pickle.dump(record, run_file, pickle.HIGHEST_PROTOCOL)
+  return run_file
+
+class GroupSpool:
+  # memory_mb: memory budget for buffered rows, in MB, or None for no limit (never spill).
+  # spill_dir: directory for the run files, by default the system temporary directory.
+  def __init__(self, memory_mb=DEFAULT_GROUPBY_MEMORY_MB, spill_dir=None):
+    self.memory_budget = memory_mb * 1024 * 1024 if memory_mb is not None else None
+    self.spill_dir = spill_dir
+    self.ordinals = {}  # group key -> position of the group, by first row added
+    self.buffer = {}  # group ordinal -> row dicts added since the last spill
+    self.buffer_size = 0
+    self.sampled_row_size = 0
+    self.runs = []  # spilled run files, oldest first
+    self.row_count = 0
+
+  def __len__(self):
+    return len(self.ordinals)
+
+  def add(self, group, row_dict):
+    ordinal = self.ordinals.setdefault(group, len(self.ordinals))
+    if ordinal not in self.buffer:
+      self.buffer[ordinal] = []
+    self.buffer[ordinal].append(row_dict)
+    if self.memory_budget is not None:
+      if self.row_count % ROW_SIZE_SAMPLE_ROWS == 0:
+        self.sampled_row_size = row_size(row_dict)
+      self.buffer_size += self.sampled_row_size
+      if self.buffer_size > self.memory_budget:
+        self.spill()
+    self.row_count += 1
+
+  def _buffered_records(self):
+    keys = list(self.ordinals.keys())
+    return [(ordinal, keys[ordinal], self.buffer[ordinal]) for ordinal in sorted(self.buffer.keys())]
+
+  # Writes the buffered rows out to a new run file, ordered by group ordinal.
+  def spill(self):
+    if not self.buffer:
+      return
+    self.runs.append(_write_run(self._buffered_records(), self.spill_dir))
+    self.buffer = {}
+    self.buffer_size = 0
+    if len(self.runs) > MAX_SPILL_RUNS:
+      merged_run = _write_run(_merge_records([_run_records(run_file) for run_file in self.runs]), self.spill_dir)
+      self.close()
+      self.runs = [merged_run]
+
+  # Generator over (group key, row dicts) in group order. Runs are merged lazily, so only one
+  # group is read back into memory at a time. Do not add rows while iterating.
+  def items(self):
+    keys = list(self.ordinals.keys())
+    if not self.runs:
+      for ordinal, row_dicts in self.buffer.items():
+        yield keys[ordinal], row_dicts
+      return
+
+    record_iterables = [_run_records(run_file) for run_file in self.runs] + [self._buffered_records()]
+    for ordinal, group, row_dicts in _merge_records(record_iterables):
+      yield group, row_dicts
+
+  def close(self):
+    for run_file in self.runs:
+      run_file.close()
+    self.runs = []
+
+# External sort, used by sort-merge joins (see rowjoins.py). Items are added with a sort key and
+# buffered in memory up to a memory budget, past which the buffer is sorted and spilled to a run
+# file. Reading merges the runs, giving the items in key order, and items with equal keys in the
+# order they were added. Spools can be read any number of times, but not by two readers at once.
+class SortSpool:
+  # memory_mb: memory budget for buffered items, in MB, or None for no limit (never spill).
+  # size_fn: function returning the estimated size of an item in bytes (by default row_size).
+  def __init__(self, memory_mb=DEFAULT_GROUPBY_MEMORY_MB, size_fn=row_size, spill_dir=None):
+    self.memory_budget = memory_mb * 1024 * 1024 if memory_mb is not None else None
+    self.size_fn = size_fn
+    self.spill_dir = spill_dir
+    self.buffer = []  # (sort key, item) added since the last spill
+    self.buffer_size = 0
+    self.sampled_item_size = 0
+    self.runs = []  # spilled run files, oldest first
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def add(self, key, item):
+    self.buffer.append((key, item))
+    if self.memory_budget is not None:
+      if self.count % ROW_SIZE_SAMPLE_ROWS == 0:
+        self.sampled_item_size = self.size_fn(item)
+      self.buffer_size += self.sampled_item_size
+      if self.buffer_size > self.memory_budget:
+        self.spill()
+    self.count += 1
+
+  def _sorted_buffer(self):
+    self.buffer.sort(key=lambda entry: entry[0])  # stable, so equal keys keep their order
+    return self.buffer
+
+  def _run_items(self, run_file):
+    return itertools.chain.from_iterable(_run_records(run_file))
+
+  # Writes the buffered items out to a new run file, in key order.
+  def spill(self):
+    if not self.buffer:
+      return
+    entries = self._sorted_buffer()
+    chunks = [entries[start:start + SORT_RUN_CHUNK_ITEMS] for start in range(0, len(entries), SORT_RUN_CHUNK_ITEMS)]
+    self.runs.append(_write_run(chunks, self.spill_dir))
+    self.buffer = []
+    self.buffer_size = 0
+    if len(self.runs) > MAX_SPILL_RUNS:
+      merged = heapq.merge(*[self._run_items(run_file) for run_file in self.runs], key=lambda entry: entry[0])
+      chunks = iter(lambda: list(itertools.islice(merged, SORT_RUN_CHUNK_ITEMS)), [])
+      merged_run = _write_run(chunks, self.spill_dir)
+      self.close()
+      self.runs = [merged_run]
+
+  # Generator over (sort key, item) in key order.
+  def items(self):
+    if not self.runs:
+      yield from self._sorted_buffer()
+      return
+    yield from heapq.merge(*[self._run_items(run_file) for run_file in self.runs], self._sorted_buffer(),
+                           key=lambda entry: entry[0])
+
+  def close(self):
+    for run_file in self.runs:
+      run_file.close()
+    self.runs = []
+
+# Returns an empty GroupSpool with the configured memory budget.
+def new_group_spool():
+  return GroupSpool(groupby_memory_mb)
+
+# Adds the groupby options to an argument parser.
+def add_groupby_args(parser):
+  parser.add_argument('--groupby-memory-mb', type=float, default=DEFAULT_GROUPBY_MEMORY_MB,
+                      help="Memory budget for groupby; groups past it are spilled to temporary files")
+
+# Sets the groupby memory budget from the options from add_groupby_args.
+def groupby_from_args(args):
+  global groupby_memory_mb
+  groupby_memory_mb = args.groupby_memory_mb
@@ -0,0 +1,20 @@
+import os
+import sys
+
+# Tests import the root-level modules, and the benchmark helpers (synthetic inventories and the stub
+# Digikey server).
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+
+from stubserver import start_stub_server
+
+# A stub Digikey server (see benchmarks/stubserver.py) serving the fixture product pages.
+@pytest.fixture
+def stub_server():
+  server = start_stub_server()
+  yield server
+  server.shutdown()
+  server.server_close()
@@ -0,0 +1,51 @@
+import csv
+import io
+
+import pytest
+
+from columnfile import ColumnFileReader, ColumnFileWriter, encode_column, is_column_file
+from labelannotator import read_csv
+
+HEADER = ['serial', 'package', 'parametrics']
+ROWS = [['S%03i' % i, ['0603', 'SOT-23', ''][i % 3], '{"Categories": "Part %i", "Note": "ü"}' % i]
+        for i in range(10)]
+
+def csv_text(rows):
+  text = io.StringIO()
+  csv.writer(text).writerows(rows)
+  return text.getvalue()
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_round_trip_over_row_groups(tmp_path, compression):
+  filename = str(tmp_path / 'rows.cols')
+  with ColumnFileWriter(filename, HEADER, compression, group_rows=4) as writer:
+    writer.writerows(ROWS)
+  assert is_column_file(filename)
+  with ColumnFileReader(filename) as reader:
+    assert reader.header == HEADER
+    assert len(reader.groups) == 3
+    assert list(reader.rows()) == ROWS
+    assert reader.group_columns(1, ['package']) == [[row[1] for row in ROWS[4:8]]]
+
+def test_repeated_values_are_dictionary_encoded():
+  assert encode_column(['a', 'b', 'a', 'a'])[0] == 'dict'
+  assert encode_column(['a', 'b', 'c', 'd'])[0] == 'plain'
+
+# Values which are not strings are written as the csv module writes them.
+def test_non_string_values_are_written_like_csv(tmp_path):
+  rows = [['S001', 3, 2.5], ['S002', None, True], ['S003', 3, None]]
+  filename = str(tmp_path / 'rows.cols')
+  with ColumnFileWriter(filename, ['serial', 'count', 'value']) as writer:
+    writer.writerows(rows)
+  with ColumnFileReader(filename) as reader:
+    assert csv_text(reader.rows()) == csv_text(rows)
+
+def test_read_csv_detects_column_files(tmp_path):
+  filename = str(tmp_path / 'rows.cols')
+  with ColumnFileWriter(filename, HEADER, 'zlib') as writer:
+    writer.writerows(ROWS)
+  rows = read_csv(filename, None)
+  assert rows.header == HEADER
+  assert rows.rows == ROWS
+  assert [row_dict['serial'] for row_dict in read_csv(filename, None, stream=True).row_dicts()] == \
+      [row[0] for row in ROWS]
@@ -0,0 +1,84 @@
+import sqlite3
+import time
+
+from crawlcache import ParametricsCache
+
+def last_used(path, part_number):
+  db = sqlite3.connect(path)
+  value, = db.execute("SELECT last_used FROM parametrics WHERE part_number = ?", (part_number,)).fetchone()
+  db.close()
+  return value
+
+def test_hits_misses_and_stale_entries(tmp_path):
+  path = str(tmp_path / 'crawl.sqlite')
+  cache = ParametricsCache(path, 1)
+  cache.put('P1', {'Resistance': '10k'})
+  assert cache.get('P1') == {'Resistance': '10k'}
+  assert cache.get('P2') is None
+  cache.close()
+
+  newer_parser = ParametricsCache(path, 2)
+  assert newer_parser.get('P1') is None
+  assert newer_parser.stats == {'hits': 0, 'misses': 0, 'stale': 1, 'evicted': 0}
+  newer_parser.close()
+
+  expired = ParametricsCache(path, 1, ttl_days=0)
+  assert expired.get('P1') is None
+  expired.close()
+
+# Hits update recency when the cache is closed, not one commit at a time.
+def test_recency_is_written_on_close(tmp_path):
+  path = str(tmp_path / 'crawl.sqlite')
+  cache = ParametricsCache(path, 1)
+  cache.put('P1', {'Resistance': '10k'})
+  stored = last_used(path, 'P1')
+  time.sleep(0.01)
+  cache.get('P1')
+  assert last_used(path, 'P1') == stored
+  cache.close()
+  assert last_used(path, 'P1') > stored
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+  path = str(tmp_path / 'crawl.sqlite')
+  cache = ParametricsCache(path, 1, max_bytes=60)
+  cache.put('P1', {'value': 'a' * 10})
+  cache.put('P2', {'value': 'b' * 10})
+  time.sleep(0.01)
+  cache.get('P1')
+  cache.put('P3', {'value': 'c' * 10})
+  assert cache.get('P1') is not None
+  assert cache.get('P2') is None
+  cache.close()
+
+# Read-only paths are passed to SQLite as URIs, so they can hold URI syntax characters.
+def test_read_only_base_with_uri_characters(tmp_path):
+  shared_path = str(tmp_path / 'shared?mode=rwc#1%20.sqlite')
+  shared = ParametricsCache(shared_path, 1)
+  shared.put('P1', {'Resistance': '10k'})
+  shared.close()
+
+  base = ParametricsCache(shared_path, 1, read_only=True)
+  cache = ParametricsCache(str(tmp_path / 'own.sqlite'), 1, base=base)
+  assert cache.get('P1') == {'Resistance': '10k'}
+  cache.put('P2', {'Resistance': '1k'})
+  cache.close()
+  base.put('P3', {'Resistance': '1'})
+  assert base.get('P3') is None
+  base.close()
+  assert not (tmp_path / 'shared').exists()
+
+# Merging copies in entries missing here or fetched later.
+def test_merge(tmp_path):
+  main = ParametricsCache(str(tmp_path / 'main.sqlite'), 1)
+  main.put('P1', {'value': 'old'})
+  main.put('P2', {'value': 'kept'})
+  worker = ParametricsCache(str(tmp_path / 'worker.sqlite'), 1)
+  worker.put('P1', {'value': 'new'})
+  worker.put('P3', {'value': 'added'})
+  worker.close()
+  main.merge(str(tmp_path / 'worker.sqlite'))
+  assert main.get('P1') == {'value': 'new'}
+  assert main.get('P2') == {'value': 'kept'}
+  assert main.get('P3') == {'value': 'added'}
+  assert main.summary()[0] == 3
+  main.close()
@@ -0,0 +1,81 @@
+import csv
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conftest import ROOT
+from digikeypage import extract_parametrics
+from labelannotator import format_parametrics
+from stubserver import DEFAULT_FIXTURES
+
+PARTS = sorted(filename[:-len('.html')] for filename in os.listdir(DEFAULT_FIXTURES))
+
+# Returns the parametrics column value expected for a part, as DigikeyCrawler.py writes it.
+def expected_parametrics(digikey_pn):
+  with open(os.path.join(DEFAULT_FIXTURES, digikey_pn + '.html'), 'r', encoding='utf-8') as fixture:
+    return format_parametrics(extract_parametrics(fixture.read()))
+
+# Writes an inventory listing every fixture part twice, and a row without a part number.
+def write_inventory(filename):
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'digikey_pn'])
+    writer.writerows([['S%02i' % i, digikey_pn] for (i, digikey_pn) in enumerate(PARTS + PARTS)])
+    writer.writerow(['S99', ''])
+
+# Runs DigikeyCrawler.py against the stub server, returning the output rows and the number of
+# requests the server got.
+def crawl(tmp_path, server, backend, **env_settings):
+  env = dict(os.environ, DIGIKEY_BACKEND=backend, DIGIKEY_URL_PREFIX=server.url_prefix(),
+             DIGIKEY_BATCH_URL=server.batch_url(), DIGIKEY_CRAWL_RPS='0',
+             DIGIKEY_CRAWL_CACHE=str(tmp_path / ('%s.crawlcache.sqlite' % backend)), **env_settings)
+  write_inventory(tmp_path / 'in.csv')
+  requests_before = server.stats['requests']
+  subprocess.run([sys.executable, os.path.join(ROOT, 'pipeline.py'), '-i', 'in.csv', '-o', 'out.csv',
+                  os.path.join(ROOT, 'DigikeyCrawler.py')], cwd=tmp_path, env=env, check=True, capture_output=True)
+  with open(tmp_path / 'out.csv', newline='', encoding='utf-8') as infile:
+    rows = list(csv.DictReader(infile))
+  return rows, server.stats['requests'] - requests_before
+
+def check_parametrics(rows):
+  assert len(rows) == 2 * len(PARTS) + 1
+  for row in rows:
+    if row['digikey_pn']:
+      assert row['parametrics'] == expected_parametrics(row['digikey_pn'])
+    else:
+      assert row['parametrics'] == ''
+
+# Each part is fetched once, and not at all once it is in the crawl cache.
+def test_html_backend(tmp_path, stub_server):
+  rows, requests = crawl(tmp_path, stub_server, 'html')
+  check_parametrics(rows)
+  assert requests == len(PARTS)
+  rows, requests = crawl(tmp_path, stub_server, 'html')
+  check_parametrics(rows)
+  assert requests == 0
+
+# The JSON backend fetches the parts in batches, in fewer requests than one per part.
+def test_json_batch_backend(tmp_path, stub_server):
+  rows, requests = crawl(tmp_path, stub_server, 'json', DIGIKEY_BATCH_SIZE='4')
+  check_parametrics(rows)
+  assert requests == 2
+
+# Failed requests (503) are retried.
+def test_retries(tmp_path, stub_server):
+  stub_server.fail_every = 3
+  rows, requests = crawl(tmp_path, stub_server, 'html', DIGIKEY_CRAWL_CONNECTIONS='1')
+  check_parametrics(rows)
+  assert requests > len(PARTS)
+
+# Cache hits update the recency of the entries when the crawler exits.
+def test_cache_hits_update_recency(tmp_path, stub_server):
+  crawl(tmp_path, stub_server, 'html')
+  db = sqlite3.connect(tmp_path / 'html.crawlcache.sqlite')
+  first_used = dict(db.execute("SELECT part_number, last_used FROM parametrics"))
+  db.close()
+  crawl(tmp_path, stub_server, 'html')
+  db = sqlite3.connect(tmp_path / 'html.crawlcache.sqlite')
+  for part_number, last_used in db.execute("SELECT part_number, last_used FROM parametrics"):
+    assert last_used > first_used[part_number]
+  db.close()
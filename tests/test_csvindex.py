@@ -0,0 +1,50 @@
+import csv
+import os
+
+from csvindex import CsvIndex, parse_where, select_rows, where_filter
+
+ROWS = [
+  ['S001', 'A1', 'plain'],
+  ['S002', 'A2', 'with, comma'],
+  ['S003', 'B1', 'multi\nline "quoted"'],
+  ['S004', 'B2', 'µ unicode'],
+  ['S005', 'A1', ''],
+]
+
+def write_rows(filename, rows):
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'gridid', 'desc'])
+    writer.writerows(rows)
+
+def test_point_and_range_lookups(tmp_path):
+  filename = str(tmp_path / 'parts.csv')
+  write_rows(filename, ROWS)
+  assert select_rows(filename, [parse_where('gridid=A1')]) == (['serial', 'gridid', 'desc'], [ROWS[0], ROWS[4]])
+  assert select_rows(filename, [parse_where('serial=S002..S003')])[1] == [ROWS[1], ROWS[2]]
+  assert select_rows(filename, [parse_where('gridid=B1..B2'), parse_where('serial=S004')])[1] == [ROWS[3]]
+  assert select_rows(filename, [parse_where('serial=S999')])[1] == []
+
+# Lookups return the same rows as filtering the whole file.
+def test_matches_filter(tmp_path):
+  filename = str(tmp_path / 'parts.csv')
+  write_rows(filename, ROWS)
+  where = [parse_where('gridid=A1..B1')]
+  keep = where_filter(where)
+  expected = [row for row in ROWS if keep(dict(zip(['serial', 'gridid', 'desc'], row)))]
+  assert select_rows(filename, where)[1] == expected
+
+# The index is rebuilt when the file changes, and keeps the columns indexed before.
+def test_rebuilt_when_file_changes(tmp_path):
+  filename = str(tmp_path / 'parts.csv')
+  write_rows(filename, ROWS)
+  assert select_rows(filename, [parse_where('serial=S001')])[1] == [ROWS[0]]
+  assert select_rows(filename, [parse_where('gridid=B2')])[1] == [ROWS[3]]
+  write_rows(filename, [['S000', 'C1', 'new']] + ROWS)
+  os.utime(filename, ns=(1, 1))
+  index = CsvIndex(filename, [])
+  try:
+    assert sorted(column for (column,) in index.db.execute("SELECT DISTINCT column FROM records")) == [0, 1]
+    assert list(index.read_rows(index.select([parse_where('serial=S001')]))) == [ROWS[0]]
+  finally:
+    index.close()
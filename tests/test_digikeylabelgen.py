@@ -0,0 +1,11 @@
+from DigikeyLabelGen import select_package
+
+# Digi-Key lists a package by several names; the most specific known name is picked, whatever their
+# order in the list.
+def test_select_package_prefers_specific_names():
+  assert select_package('TO-236-3, SC-59, SOT-23-3') == 'SOT-23'
+  assert select_package('SC-74A, SOT-753') == 'SOT-23'
+  assert select_package('TO-220-3') == 'TO-220'
+  assert select_package('TO-92-3') == 'TO-92'
+  assert select_package('TO-261-4, TO-261AA') == 'TO-261'
+  assert select_package('8-SOIC') == '8-SOIC'
@@ -0,0 +1,41 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+ANNOTATOR = """from labelannotator import *
+
+def Grow(row_dict):
+  return {'big': 'x' * 100000}
+
+def annotate(rows):
+  return rows.map_append(Grow)
+"""
+
+def run_profiled(tmp_path, *args):
+  (tmp_path / 'grow.py').write_text(ANNOTATOR)
+  with open(tmp_path / 'in.csv', 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial'])
+    writer.writerows([['S%03i' % i] for i in range(200)])
+  subprocess.run([sys.executable, os.path.join(ROOT, 'pipeline.py'), '-i', 'in.csv', '-o', 'out.csv',
+                  '--profile', 'report.json'] + list(args) + ['grow.py'], cwd=tmp_path, check=True, capture_output=True)
+  with open(tmp_path / 'report.json', encoding='utf-8') as report_file:
+    return {stage['kind']: stage for stage in json.load(report_file)['stages']}
+
+# Eager stages report how much they raised the process peak, and their own traced peak.
+def test_eager_stage_memory(tmp_path):
+  stages = run_profiled(tmp_path, '--profile-tracemalloc')
+  stage = stages['map_append']
+  assert stage['rows_in'] == 200 and stage['calls'] == 200
+  assert stage['process_peak_rss_mb_after'] >= stage['peak_rss_growth_mb'] >= 0
+  assert stage['traced_peak_mb'] > 10
+
+# Lazy stages run at write time, so they have no memory figures of their own.
+def test_lazy_stage_memory(tmp_path):
+  stage = run_profiled(tmp_path, '--stream', '--profile-tracemalloc')['map_append']
+  assert stage['lazy'] and stage['calls'] == 200
+  assert stage['peak_rss_growth_mb'] is None and 'traced_peak_mb' not in stage
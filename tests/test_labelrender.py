@@ -0,0 +1,107 @@
+import csv
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from labelrender import INKSCAPE_NS, SVG_NS, SheetLayout, TemplatePlan, code128_bars, render_labels
+
+TEMPLATE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+     width="40mm" height="20mm" viewBox="0 0 80 40" version="1.1">
+  <sodipodi:namedview id="base" inkscape:document-units="mm" />
+  <g id="layer1" inkscape:groupmode="layer">
+    <g id="swatch">
+      <text>#style fill=%(color)</text>
+      <rect x="0" y="0" width="10" height="10" style="fill:#ffffff;stroke:#000000" />
+    </g>
+    <text x="12" y="8" id="name">%(name) (%(serial))</text>
+    <g id="barcode">
+      <text>#code128 align=xMid %(serial)</text>
+      <rect x="0" y="20" width="80" height="16" />
+    </g>
+  </g>
+</svg>
+"""
+
+CONFIG = """[label]
+sizex = 44 mm
+sizey = 24 mm
+
+[sheet]
+sizex = 100 mm
+sizey = 60 mm
+offx = 5 mm
+offy = 6 mm
+incx = 45 mm
+incy = 25 mm
+nrows = 2
+ncols = 2
+"""
+
+@pytest.fixture
+def label_files(tmp_path):
+  (tmp_path / 'template.svg').write_text(TEMPLATE)
+  (tmp_path / 'sheet.ini').write_text(CONFIG)
+  with open(tmp_path / 'labels.csv', 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'name', 'color'])
+    writer.writerows([['S%02i' % i, 'Part <%i> & "co"' % i, '#%02x0000' % (i * 20)] for i in range(10)])
+  return tmp_path
+
+# Returns the sheet layers of a rendered document, as lists of label groups.
+def sheet_labels(svg_text):
+  root = ET.fromstring(svg_text)
+  layers = [elem for elem in root if elem.get('{%s}groupmode' % INKSCAPE_NS) == 'layer']
+  return root, [list(layer) for layer in layers]
+
+def test_code128_check_symbol():
+  # Start B (104), then 'A' (33), 'B' (34) and 'C' (35) at positions 1 to 3: 310 % 103 = 1.
+  bars, modules = code128_bars('ABC')
+  assert modules == 5 * 11 + 13  # start, 3 characters and the check symbol, then the stop symbol
+  check_bars = [(offset - 44, width) for (offset, width) in bars if 44 <= offset < 55]
+  assert check_bars == [(0, 2), (4, 2), (7, 2)]  # symbol 1, '222122'
+  # The check symbol of 'PJJ123C' is 879 % 103 = 55, '311321'.
+  bars, modules = code128_bars('PJJ123C')
+  assert [(offset - 88, width) for (offset, width) in bars if 88 <= offset < 99] == [(0, 3), (4, 1), (8, 2)]
+
+def test_sheet_layout(label_files):
+  layout = SheetLayout(str(label_files / 'sheet.ini'))
+  assert layout.labels_per_sheet == 4
+  assert layout.label_origin(0) == (5, 6)
+  assert layout.label_origin(3) == (50, 31)
+  assert layout.page_y(2) == 2 * (60 + 20)
+
+def test_template_plan(label_files):
+  plan = TemplatePlan(str(label_files / 'template.svg'))
+  assert plan.fields == {'serial', 'name', 'color'}
+  label = plan.render({'serial': 'S1', 'name': 'a < b', 'color': '#00ff00'})
+  assert '%(' not in label and '#code128' not in label and '#style' not in label
+  assert 'a &lt; b (S1)' in label
+  assert 'fill:#00ff00;stroke:#000000' in label
+  assert label.count('<path ') == 1
+
+def test_rendered_document(label_files):
+  output = str(label_files / 'out.svg')
+  assert render_labels(str(label_files / 'template.svg'), str(label_files / 'sheet.ini'),
+                       str(label_files / 'labels.csv'), output, workers=1) == (10, 3)
+  with open(output, encoding='utf-8') as infile:
+    svg_text = infile.read()
+  assert '%(' not in svg_text
+  root, sheets = sheet_labels(svg_text)
+  assert root.tag == '{%s}svg' % SVG_NS
+  assert [len(labels) for labels in sheets] == [4, 4, 2]
+  assert len(root.findall('.//{%s}page' % INKSCAPE_NS)) == 3
+  texts = [''.join(elem.itertext()) for elem in root.iter('{%s}text' % SVG_NS)]
+  assert texts == ['Part <%i> & "co" (S%02i)' % (i, i) for i in range(10)]
+
+# Sheets rendered on worker processes, or reused from the render cache, give the same output.
+def test_workers_and_cache_output_identical(label_files):
+  args = [str(label_files / 'template.svg'), str(label_files / 'sheet.ini'), str(label_files / 'labels.csv')]
+  render_labels(*args, str(label_files / 'serial.svg'), workers=1)
+  render_labels(*args, str(label_files / 'parallel.svg'), workers=3)
+  render_labels(*args, str(label_files / 'cached.svg'), workers=3, cache_file=str(label_files / 'render.cache'))
+  render_labels(*args, str(label_files / 'reused.svg'), workers=1, cache_file=str(label_files / 'render.cache'))
+  serial = (label_files / 'serial.svg').read_bytes()
+  for name in ['parallel.svg', 'cached.svg', 'reused.svg']:
+    assert (label_files / name).read_bytes() == serial
@@ -0,0 +1,66 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+from partsearch import ConditionError, parse_condition, parse_quantity, search_parts
+
+PARTS = [
+  ('S1', {'Categories': 'Chip Resistor - Surface Mount', 'Resistance': '4.7 kOhms', 'Package / Case': '0603 (1608 Metric)'}),
+  ('S2', {'Categories': 'Chip Resistor - Surface Mount', 'Resistance': '10 kOhms', 'Package / Case': '0805 (2012 Metric)'}),
+  ('S3', {'Categories': 'Chip Resistor - Surface Mount', 'Resistance': '1 MOhms', 'Package / Case': '0603 (1608 Metric)'}),
+  ('S4', {'Categories': 'Ceramic Capacitors', 'Capacitance': '0.1µF', 'Voltage - Rated': '50V',
+          'Package / Case': '0603 (1608 Metric)'}),
+  ('S5', {'Categories': 'PMIC - Voltage Regulators', 'Voltage - Output': '1.25V ~ 37V'}),
+]
+
+@pytest.fixture
+def inventory(tmp_path):
+  filename = str(tmp_path / 'parts.csv')
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'digikey_pn', 'parametrics'])
+    writer.writerows([[serial, 'PN-' + serial, json.dumps(parametrics, ensure_ascii=False)]
+                      for (serial, parametrics) in PARTS])
+  return filename
+
+def serials(filename, *conditions):
+  return [row_dict['serial'] for row_dict in search_parts(filename, conditions)]
+
+def test_parse_quantity():
+  assert parse_quantity('4.7 kOhms') == ('Ω', 4700.0, 4700.0)
+  assert parse_quantity('1.25V ~ 37V') == ('V', 1.25, 37.0)
+  assert parse_quantity('M3') is None
+
+def test_quantities_and_words(inventory):
+  assert serials(inventory, 'Capacitance=100nF') == ['S4']
+  assert serials(inventory, 'Resistance>=10kOhm') == ['S2', 'S3']
+  assert serials(inventory, 'category=Ceramic Capacitors', 'Voltage - Rated>=25V') == ['S4']
+  assert serials(inventory, '0603') == ['S1', 'S3', 'S4']
+  assert serials(inventory, 'Voltage - Output=5V') == ['S5']
+
+# A bound with a prefix and no unit takes the other bound's unit, or matches any unit.
+def test_prefix_only_quantities(inventory):
+  assert serials(inventory, 'Resistance>=10k') == ['S2', 'S3']
+  assert serials(inventory, 'Resistance=4.7k') == ['S1']
+  assert serials(inventory, 'Resistance=1k..10kOhm') == ['S1', 'S2']
+  assert serials(inventory, 'Resistance=1kOhm..10k') == ['S1', 'S2']
+  assert parse_condition('Resistance=1kOhm..10k')[3] == ('Ω', 1000.0, 10000.0)
+
+def test_bad_conditions():
+  with pytest.raises(ConditionError):
+    parse_condition('Resistance>=big')
+  with pytest.raises(ConditionError):
+    parse_condition('Resistance=1kOhm..10kHz')
+  with pytest.raises(ConditionError):
+    parse_condition('Resistance=1k..lots')
+
+def test_bad_condition_is_a_usage_error(inventory):
+  result = subprocess.run([sys.executable, os.path.join(ROOT, 'partsearch.py'), inventory, 'Resistance>=big'],
+                          capture_output=True, text=True)
+  assert result.returncode == 2
+  assert "'big' is not a quantity" in result.stderr
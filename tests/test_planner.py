@@ -0,0 +1,96 @@
+import csv
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+from planner import optimize, prune, record_plan
+
+CRAWL_STAGE = """from labelannotator import *
+
+def Upper(row_dict):
+  return {'upper': row_dict['name'].upper()}
+Upper.reads = ('name',)
+Upper.writes = ('upper',)
+
+def Length(row_dict):
+  return {'length': str(len(row_dict['name']))}
+Length.reads = ('name',)
+Length.writes = ('length',)
+
+def annotate(rows):
+  return rows.map_append(Upper).map_append(Length)
+"""
+
+FILTER_STAGE = """from labelannotator import *
+
+def InDrawer(row_dict):
+  return row_dict['gridid'] != ''
+InDrawer.reads = ('gridid',)
+
+def ShortUpper(row_dict):
+  return len(row_dict['upper']) < 4
+ShortUpper.reads = ('upper',)
+
+def annotate(rows):
+  return rows.filter(InDrawer).filter(ShortUpper)
+"""
+
+# Reads the header of its collection, which cannot be recorded.
+UNPLANNABLE_STAGE = """from labelannotator import *
+
+def Upper(row_dict):
+  return {'upper': row_dict['name'].upper()}
+
+def annotate(rows):
+  assert 'name' in rows.header
+  return rows.map_append(Upper)
+"""
+
+class Module:
+  def __init__(self, source):
+    exec(source, self.__dict__)
+
+def write_stages(tmp_path, *sources):
+  scripts = []
+  for i, source in enumerate(sources):
+    (tmp_path / ('stage%i.py' % i)).write_text(source)
+    scripts.append('stage%i.py' % i)
+  with open(tmp_path / 'in.csv', 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'gridid', 'name'])
+    writer.writerows([['S%02i' % i, 'A%i' % i if i % 3 else '', 'n' * (i % 6)] for i in range(30)])
+  return scripts
+
+def run_pipeline(tmp_path, output, scripts, *args):
+  return subprocess.run([sys.executable, os.path.join(ROOT, 'pipeline.py'), '-i', 'in.csv', '-o', output] +
+                        list(args) + scripts, cwd=tmp_path, capture_output=True, text=True, check=True).stdout
+
+def test_planned_output_matches_unplanned(tmp_path):
+  scripts = write_stages(tmp_path, CRAWL_STAGE, FILTER_STAGE)
+  run_pipeline(tmp_path, 'planned.csv', scripts)
+  run_pipeline(tmp_path, 'unplanned.csv', scripts, '--no-plan')
+  assert (tmp_path / 'planned.csv').read_text() == (tmp_path / 'unplanned.csv').read_text()
+
+# A filter of input columns moves ahead of the map steps; one reading an appended column stays.
+def test_only_source_filters_move():
+  steps = record_plan([Module(CRAWL_STAGE), Module(FILTER_STAGE)])
+  planned = optimize(steps, ['serial', 'gridid', 'name'])
+  assert [(step.kind, step.fn.__name__) for step in planned] == \
+    [('filter', 'InDrawer'), ('map_append', 'Upper'), ('map_append', 'Length'), ('filter', 'ShortUpper')]
+  assert [step.moved_past for step in planned] == [2, 0, 0, 0]
+
+# Map steps writing only columns nothing later reads or keeps are dropped.
+def test_prune_drops_unused_map_steps():
+  planned = optimize(record_plan([Module(CRAWL_STAGE), Module(FILTER_STAGE)]), ['serial', 'gridid', 'name'])
+  kept = prune(planned, ['serial', 'upper'])
+  assert [step.kind for step in kept] == ['filter', 'map_append', 'filter', 'select_columns']
+  assert kept[1].fn.__name__ == 'Upper'
+
+# Stages doing more than chaining operations run unplanned, with the reason printed.
+def test_unplannable_stage_runs_unplanned(tmp_path):
+  scripts = write_stages(tmp_path, UNPLANNABLE_STAGE, FILTER_STAGE)
+  output = run_pipeline(tmp_path, 'planned.csv', scripts)
+  assert "Not planning pipeline: 'header' on a collection cannot be planned" in output
+  run_pipeline(tmp_path, 'unplanned.csv', scripts, '--no-plan')
+  assert (tmp_path / 'planned.csv').read_text() == (tmp_path / 'unplanned.csv').read_text()
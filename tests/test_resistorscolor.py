@@ -0,0 +1,46 @@
+from ResistorsColor import AddColorBatch, band_colors, resistor_colors, resistor_tolerance_colors
+
+def three_band(colors):
+  return [colors['res_color%i' % i] for i in (1, 2, 3)]
+
+def full_code(colors):
+  return [colors['res_band%i' % (i + 1)] for i in range(int(colors['res_bands']))]
+
+# The res_color columns are always digit, digit, multiplier, as 3-band templates draw them.
+def test_three_band_code_ignores_tolerance():
+  for tolerance in [None, 5.0, 1.0]:
+    colors = band_colors('4.7kΩ', tolerance)
+    assert three_band(colors) == [resistor_colors[4], resistor_colors[7], resistor_colors[2]]
+    assert colors['res_stroke'] == '#000000'
+
+def test_precision_part_gets_five_bands():
+  colors = band_colors('4.7kΩ', 1.0)
+  assert full_code(colors) == [resistor_colors[4], resistor_colors[7], resistor_colors[0], resistor_colors[1],
+                               resistor_tolerance_colors[1]]
+
+def test_four_and_three_band_codes():
+  assert full_code(band_colors('4.7kΩ', 5.0)) == [resistor_colors[4], resistor_colors[7], resistor_colors[2],
+                                                  resistor_tolerance_colors[5]]
+  assert full_code(band_colors('4.7kΩ')) == [resistor_colors[4], resistor_colors[7], resistor_colors[2]]
+
+# A value 2 digits cannot represent is blank in the 3-band columns rather than a different value.
+def test_three_digit_value_is_blank_in_three_band_columns():
+  colors = band_colors('4.75kΩ', 5.0)
+  assert three_band(colors) == ['#FFFFFF'] * 3
+  assert colors['res_stroke'] == '#FFFFFF'
+  assert full_code(colors) == [resistor_colors[4], resistor_colors[7], resistor_colors[5], resistor_colors[1],
+                               resistor_tolerance_colors[5]]
+
+def test_sub_ohm_and_unparseable_values():
+  assert three_band(band_colors('0.22Ω')) == [resistor_colors[2], resistor_colors[2], resistor_colors[-2]]
+  assert three_band(band_colors('R22')) == three_band(band_colors('0.22Ω'))
+  assert band_colors('not a value')['res_bands'] == '0'
+  assert band_colors('')['res_stroke'] == '#FFFFFF'
+
+def test_batch_suffixes_every_value_column():
+  rows = [{'desc': '±1%, 1/4W', 'val_1': '10kΩ', 'val_2': '', 'val_3': '4k7'}]
+  result, = AddColorBatch(rows)
+  assert result['res_color1_1'] == resistor_colors[1]
+  assert result['res_bands_1'] == '5'
+  assert result['res_stroke_2'] == '#FFFFFF'
+  assert result['res_color3_3'] == resistor_colors[2]
@@ -0,0 +1,67 @@
+import csv
+import os
+import subprocess
+import sys
+import time
+
+from conftest import ROOT
+from rowcache import RowResultCache, row_hash
+
+ANNOTATOR = """from labelannotator import *
+
+def Upper(row_dict):
+  return {'upper': row_dict['name'].upper()}
+Upper.reads = ('name',)
+
+def annotate(rows):
+  return rows.map_append(Upper)
+"""
+
+def write_rows(filename, names):
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'name'])
+    writer.writerows([['S%03i' % i, name] for (i, name) in enumerate(names)])
+
+# Runs pipeline.py with a row cache, returning (hits, misses) from its report.
+def run_cached(tmp_path, *args):
+  script = tmp_path / 'upper.py'
+  script.write_text(ANNOTATOR)
+  output = subprocess.run([sys.executable, os.path.join(ROOT, 'pipeline.py'), '-i', str(tmp_path / 'in.csv'),
+                           '-o', str(tmp_path / 'out.csv'), '--row-cache', str(tmp_path / 'out.rowcache')] +
+                          list(args) + [str(script)], capture_output=True, text=True, check=True).stdout
+  report = [line for line in output.splitlines() if line.startswith('Row cache:')][0]
+  words = report.split()
+  return int(words[2]), int(words[5])
+
+def test_rerun_reuses_rows(tmp_path):
+  write_rows(tmp_path / 'in.csv', ['a', 'b', 'c'])
+  assert run_cached(tmp_path) == (0, 3)
+  first = (tmp_path / 'out.csv').read_text()
+  assert run_cached(tmp_path) == (3, 0)
+  assert (tmp_path / 'out.csv').read_text() == first
+  write_rows(tmp_path / 'in.csv', ['a', 'B', 'c'])
+  assert run_cached(tmp_path, '--stream') == (2, 1)
+
+# A run over part of the input keeps the results of the other rows.
+def test_narrowed_run_keeps_other_rows(tmp_path):
+  write_rows(tmp_path / 'in.csv', ['a', 'b', 'c', 'd'])
+  assert run_cached(tmp_path) == (0, 4)
+  assert run_cached(tmp_path, '--where', 'name=b') == (1, 0)
+  assert run_cached(tmp_path) == (4, 0)
+
+def test_unused_results_age_out(tmp_path):
+  cache = RowResultCache(str(tmp_path / 'cache'), keep_days=1)
+  cache.put('stage', 'old', {'x': '1'})
+  cache.put('stage', 'recent', {'x': '2'})
+  cache.finish()
+  cache.db.execute("UPDATE row_use SET last_used = ? WHERE row_hash = 'old'", (time.time() - 2 * 24 * 60 * 60,))
+  cache.db.commit()
+  cache.finish()
+  assert cache.get_many('stage', ['old', 'recent', 'missing']) == [None, {'x': '2'}, None]
+  assert cache.stats == {'hits': 1, 'misses': 2}
+  cache.close()
+
+def test_row_hash_ignores_unread_columns():
+  assert row_hash({'name': 'a', 'other': '1'}, ('name',)) == row_hash({'name': 'a', 'other': '2'}, ('name',))
+  assert row_hash({'name': 'a', 'other': '1'}) != row_hash({'name': 'a', 'other': '2'})
@@ -0,0 +1,78 @@
+import csv
+import os
+import shlex
+import subprocess
+import sys
+
+from conftest import ROOT
+from shards import merge_headers, shard_command_line, split_input
+
+ANNOTATOR = """from labelannotator import *
+
+def Length(row_dict):
+  return {'length': str(len(row_dict['name']))}
+
+def annotate(rows):
+  return rows.map_append(Length)
+"""
+
+def write_rows(filename, count):
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'name'])
+    writer.writerows([['S%03i' % (i % 7), 'name' * (i % 5)] for i in range(count)])
+
+def run(tmp_path, script, *args):
+  env = dict(os.environ, DIGIKEY_CRAWL_CACHE=str(tmp_path / 'crawl.sqlite'))
+  return subprocess.run([sys.executable, os.path.join(ROOT, script)] + [str(arg) for arg in args],
+                        cwd=tmp_path, env=env, capture_output=True, text=True, check=True).stdout
+
+def test_split_keeps_keys_together(tmp_path):
+  write_rows(tmp_path / 'in.csv', 50)
+  for method in ['hash', 'range']:
+    counts = split_input(str(tmp_path / 'in.csv'), str(tmp_path / method), 3, 'serial', method)
+    assert sum(counts) == 50
+    shard_serials = []
+    for i in range(3):
+      with open(tmp_path / method / ('shard_%i.csv' % i), newline='', encoding='utf-8') as infile:
+        shard_serials.append({row['serial'] for row in csv.DictReader(infile)})
+    assert sum(len(serials) for serials in shard_serials) == 7
+
+# Sharded runs write the same output as a serial run, in input order.
+def test_run_matches_serial_pipeline(tmp_path):
+  write_rows(tmp_path / 'in.csv', 50)
+  (tmp_path / 'length.py').write_text(ANNOTATOR)
+  run(tmp_path, 'pipeline.py', '-i', 'in.csv', '-o', 'serial.csv', 'length.py')
+  run(tmp_path, 'shards.py', 'run', '-i', 'in.csv', '-o', 'sharded.csv', '--work-dir', 'work', '--shards', '3',
+      '--row-cache', 'rows.cache', '--stream', 'length.py')
+  assert (tmp_path / 'sharded.csv').read_text() == (tmp_path / 'serial.csv').read_text()
+  assert not (tmp_path / 'work').exists()
+  assert sorted(name for name in os.listdir(tmp_path) if name.startswith('rows.cache')) == \
+    ['rows.cache.shard0', 'rows.cache.shard1', 'rows.cache.shard2']
+
+# The commands printed by split run each shard like run does, and merge puts them back together.
+def test_split_commands_and_merge(tmp_path):
+  write_rows(tmp_path / 'in.csv', 20)
+  (tmp_path / 'length.py').write_text(ANNOTATOR)
+  output = run(tmp_path, 'shards.py', 'split', '-i', 'in.csv', '--work-dir', 'work', '--shards', '2',
+               '--row-cache', 'rows.cache', '--stream', 'length.py')
+  command_lines = output.splitlines()[1:]
+  assert len(command_lines) == 2
+  for i, command_line in enumerate(command_lines):
+    args = shlex.split(command_line)
+    assert args[args.index('--row-cache') + 1] == 'rows.cache.shard%i' % i
+    assert '--stream' in args
+    subprocess.run(command_line, shell=True, cwd=tmp_path, check=True, capture_output=True)
+  run(tmp_path, 'shards.py', 'merge', '--work-dir', 'work', '--shards', '2', '-o', 'merged.csv')
+  run(tmp_path, 'pipeline.py', '-i', 'in.csv', '-o', 'serial.csv', 'length.py')
+  assert (tmp_path / 'merged.csv').read_text() == (tmp_path / 'serial.csv').read_text()
+
+def test_command_line_passes_pipeline_args():
+  args = shlex.split(shard_command_line('work', 0, ['a.py'], 2, ['--for-template', 't.svg'], 'rows.cache'))
+  assert args[-3:] == ['--for-template', 't.svg', 'a.py']
+  assert 'rows.cache.shard0' in args
+
+def test_merge_headers():
+  assert merge_headers([['serial', 'a', '_shard_row'], ['serial', 'b', '_shard_row']]) == \
+    ['serial', 'a', 'b', '_shard_row']
+  assert merge_headers([['serial', 'name', 'x'], ['serial', 'x', 'name']])[0] == 'serial'
@@ -0,0 +1,44 @@
+import csv
+
+import pytest
+
+import spillgroups
+from labelannotator import read_csv
+
+# Returns one summary row per drawer, with its movements in input order.
+def DrawerSummary(gridid, row_dicts):
+  return [{'gridid': gridid, 'movements': ' '.join(row_dict['serial'] for row_dict in row_dicts),
+           'net_quantity': str(sum(int(row_dict['quantity']) for row_dict in row_dicts))}]
+
+def write_movements(filename):
+  with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'gridid', 'quantity', 'notes'])
+    writer.writerows([['M%04i' % i, 'D%i' % (i * 37 % 23), str(i % 9 - 4), 'note ' * 20] for i in range(2000)])
+
+def group_output(tmp_path, memory_mb, stream, monkeypatch):
+  monkeypatch.setattr(spillgroups, 'groupby_memory_mb', memory_mb)
+  output = tmp_path / ('out_%s_%s.csv' % (memory_mb, stream))
+  read_csv(str(tmp_path / 'in.csv'), str(output), stream=stream) \
+      .groupby(lambda row_dict: row_dict['gridid']).group_map(DrawerSummary).write()
+  return output.read_text()
+
+# Groups spilled to disk give the same output, in the same group order, as groups kept in memory.
+@pytest.mark.parametrize('stream', [False, True])
+def test_spilled_groups_match_in_memory(tmp_path, monkeypatch, stream):
+  write_movements(tmp_path / 'in.csv')
+  in_memory = group_output(tmp_path, None, stream, monkeypatch)
+
+  spills = []
+  write_run = spillgroups._write_run
+  def counted_write_run(*args):
+    spills.append(args)
+    return write_run(*args)
+  monkeypatch.setattr(spillgroups, '_write_run', counted_write_run)
+  spilled = group_output(tmp_path, 0.01, stream, monkeypatch)
+  assert len(spills) > 1
+  assert spilled == in_memory
+
+  rows = list(csv.DictReader(in_memory.splitlines()))
+  assert [row['gridid'] for row in rows] == ['D%i' % (i * 37 % 23) for i in range(23)]
+  assert rows[1]['movements'].split()[:2] == ['M0001', 'M0024']
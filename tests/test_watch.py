@@ -0,0 +1,73 @@
+import csv
+import os
+
+from watch import LabelWatcher
+
+HELPER = """def suffix():
+  return %r
+"""
+
+STAGE = """from labelannotator import *
+from watchhelper import suffix
+
+def Mark(row_dict):
+  return {'mark': row_dict['name'] + suffix()}
+Mark.reads = ('name',)
+
+def annotate(rows):
+  return rows.map_append(Mark)
+"""
+
+TEMPLATE = """<svg xmlns="http://www.w3.org/2000/svg" width="40mm" height="20mm" viewBox="0 0 40 20" version="1.1">
+  <text x="1" y="10">%(mark)</text>
+</svg>
+"""
+
+CONFIG = """[label]
+sizex = 40 mm
+sizey = 20 mm
+
+[sheet]
+sizex = 100 mm
+sizey = 100 mm
+offx = 0 mm
+offy = 0 mm
+incx = 50 mm
+incy = 25 mm
+nrows = 4
+ncols = 2
+"""
+
+# Writes a file with a modification time after any it had, so the change is seen.
+def write_file(path, text, mtime_ns=None):
+  path.write_text(text)
+  if mtime_ns is not None:
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+# Editing a module a script imports reloads both, and recomputes the stage's rows.
+def test_imported_module_edit_rebuilds(tmp_path, monkeypatch):
+  monkeypatch.syspath_prepend(str(tmp_path))
+  write_file(tmp_path / 'watchhelper.py', HELPER % '!')
+  write_file(tmp_path / 'stage.py', STAGE)
+  write_file(tmp_path / 'template.svg', TEMPLATE)
+  write_file(tmp_path / 'sheet.ini', CONFIG)
+  with open(tmp_path / 'in.csv', 'w', newline='', encoding='utf-8') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(['serial', 'name'])
+    writer.writerows([['S%i' % i, 'part%i' % i] for i in range(5)])
+
+  output = tmp_path / 'out.svg'
+  watcher = LabelWatcher(str(tmp_path / 'in.csv'), [str(tmp_path / 'stage.py')], str(tmp_path / 'template.svg'),
+                         str(tmp_path / 'sheet.ini'), str(output))
+  watcher.rebuild(watcher.changed_files())
+  assert 'part3!' in output.read_text()
+  assert str(tmp_path / 'watchhelper.py') in watcher.watched_files()
+  assert watcher.changed_files() == []
+
+  helper_mtime = os.stat(tmp_path / 'watchhelper.py').st_mtime_ns
+  write_file(tmp_path / 'watchhelper.py', HELPER % '?', helper_mtime + 10 ** 9)
+  changed = watcher.changed_files()
+  assert changed == [str(tmp_path / 'watchhelper.py')]
+  watcher.rebuild(changed)
+  assert 'part3?' in output.read_text() and 'part3!' not in output.read_text()
+  assert watcher.row_cache.stats == {'hits': 0, 'misses': 5}
@@ -0,0 +1,195 @@
+import argparse
+import importlib
+import os
+import sys
+import time
+import traceback
+
+from labelannotator import read_csv
+from labelrender import SheetLayout, TemplatePlan, group_sheets, write_sheets
+from pipeline import run_stages, stage_modules
+from rendercache import RenderCache
+from rowcache import RowResultCache, module_dependencies
+
+# Watch mode for iterating on labels during an inventory session: one long-running process which
+# builds a label sheet document from an input CSV, annotator scripts and a template, like an
+# Annotator target feeding a Labels target in SConscript, then rebuilds it whenever one of those
+# files changes. Everything stays loaded between rebuilds: annotator scripts are only re-imported
+# when they change (see pipeline.load_stage), so the crawl cache and compiled rules of the others
+# stay in memory, the per-row stage results are kept in an in-memory row cache (see rowcache.py),
+# and rendered labels in an in-memory render cache (see rendercache.py). Editing an input row then
+# only recomputes that row. Editing a script, or a module in its directory it imports (like
+# digikeypage.py), changes that stage's fingerprint, so every row of that stage is recomputed;
+# other stages only recompute the rows whose input it changed, and only the labels whose content
+# changed are re-rendered.
+# Those imported modules are watched too, and reloaded with the scripts using them when they change.
+# Modules the watcher itself runs on (like labelannotator.py, loaded once at startup) cannot be
+# reloaded in place: changes to them are reported, and take effect when watch.py is restarted.
+
+# Seconds between checks for changed files.
+DEFAULT_POLL_SECONDS = 0.1
+
+# Returns the modification time of a file, or None if it is missing (like mid-save).
+def modification_time(filename):
+  try:
+    return os.stat(filename).st_mtime_ns
+  except FileNotFoundError:
+    return None
+
+class LabelWatcher:
+  # csv_output: if set, the annotated rows are also written to this file.
+  # row_cache / render_cache: cache files to use instead of in-memory caches, which then persist
+  # across sessions (and can be shared with the SCons targets' caches).
+  def __init__(self, input, scripts, template, config, output, csv_output=None, row_cache=None,
+               render_cache=None):
+    self.input = input
+    self.scripts = scripts
+    self.template = template
+    self.config = config
+    self.output = output
+    self.csv_output = csv_output
+    self.row_cache = RowResultCache(row_cache or ':memory:')
+    self.render_cache_file = render_cache or ':memory:'
+    self.render_cache = None
+    self.plan = None
+    self.layout = None
+    self.rows = None
+    self.mtimes = {}
+    self.own_modules = self.loaded_modules()
+
+  # Returns the names of the loaded modules in the watcher's directory.
+  @staticmethod
+  def loaded_modules():
+    watch_dir = os.path.dirname(os.path.abspath(__file__))
+    return {name for (name, module) in list(sys.modules.items())
+            if os.path.dirname(os.path.abspath(getattr(module, '__file__', None) or '')) == watch_dir}
+
+  # Returns {filename: module name} of the modules the loaded scripts import (see
+  # rowcache.module_dependencies), other than the scripts themselves.
+  def dependency_files(self):
+    script_paths = {os.path.abspath(script) for script in self.scripts}
+    dependencies = {}
+    for path, (mtime, module) in list(stage_modules.items()):
+      if path in script_paths:
+        for name, filename in module_dependencies(module):
+          if os.path.abspath(filename) not in script_paths:
+            dependencies[filename] = name
+    return dependencies
+
+  def watched_files(self):
+    return [self.input] + list(self.scripts) + [self.template, self.config] + sorted(self.dependency_files())
+
+  # Returns the watched files changed since the last call (every file, on the first call). Files
+  # newly watched (like modules imported by a reloaded script) are not reported as changed. While
+  # any file is missing, like during an editor's save, returns none and checks again next call.
+  def changed_files(self):
+    mtimes = {filename: modification_time(filename) for filename in self.watched_files()}
+    if None in mtimes.values():
+      return []
+    changed = [filename for filename in mtimes if mtimes[filename] != self.mtimes.get(filename) and
+               (filename in self.mtimes or not self.mtimes)]
+    self.mtimes = mtimes
+    return changed
+
+  # Reloads the changed modules imported by scripts, and drops the scripts using them so they are
+  # re-imported. Returns whether any was reloaded.
+  def reload_dependencies(self, changed):
+    dependencies = self.dependency_files()
+    reloaded = set()
+    for filename in changed:
+      name = dependencies.get(filename)
+      if name is None:
+        continue
+      if name in self.own_modules:
+        print("%s changed, restart watch.py to use it" % filename)
+        continue
+      importlib.reload(sys.modules[name])
+      reloaded.add(name)
+    if not reloaded:
+      return False
+    for path, (mtime, module) in list(stage_modules.items()):
+      if reloaded & {name for (name, filename) in module_dependencies(module)}:
+        del stage_modules[path]
+    return True
+
+  # Rebuilds what depends on the changed files: the template or layout, then the rows if the input,
+  # a script, a module a script imports or the template's fields changed, then the document.
+  def rebuild(self, changed):
+    rerun = self.rows is None or self.input in changed or any(script in changed for script in self.scripts)
+    rerun = self.reload_dependencies(changed) or rerun
+    if self.plan is None or self.template in changed:
+      plan = TemplatePlan(self.template)
+      rerun = rerun or self.plan is None or plan.fields != self.plan.fields
+      if self.render_cache is not None:
+        self.render_cache.close()
+      self.render_cache = RenderCache(self.render_cache_file, plan.fingerprint, plan.fields)
+      self.plan = plan
+    if self.layout is None or self.config in changed:
+      self.layout = SheetLayout(self.config)
+
+    if rerun:
+      self.row_cache.start_run()
+      # Columnar collections append columns without rebuilding every row, which dominates reruns.
+      rows = read_csv(self.input, self.csv_output, columnar=True)
+      rows = run_stages(rows, self.scripts, cache=self.row_cache, keep_columns=self.plan.fields)
+      if self.csv_output:
+        rows.write()
+      self.row_cache.finish()
+      self.rows = list(rows.row_dicts())
+
+    self.render_cache.start_run()
+    num_sheets = max(1, -(-len(self.rows) // self.layout.labels_per_sheet))
+    write_sheets(self.plan, self.layout, group_sheets(self.rows, self.layout.labels_per_sheet), num_sheets,
+                 self.output, self.render_cache)
+    self.render_cache.finish()
+
+  # Checks for changes every poll_seconds, rebuilding on each, until interrupted.
+  def run(self, poll_seconds=DEFAULT_POLL_SECONDS):
+    while True:
+      changed = self.changed_files()
+      if changed:
+        start = time.perf_counter()
+        try:
+          self.rebuild(changed)
+          print("Rebuilt %s in %.2fs after changes to %s: %i rows reused, %i computed; "
+                "%i labels reused, %i rendered" %
+                (self.output, time.perf_counter() - start, ', '.join(changed),
+                 self.row_cache.stats['hits'], self.row_cache.stats['misses'],
+                 self.render_cache.stats['hits'], self.render_cache.stats['misses']))
+        except Exception:
+          # Keep watching, so a broken edit can just be fixed and saved again.
+          traceback.print_exc()
+          self.rows = None  # recompute the rows on the next change
+          print("Rebuild of %s failed, waiting for changes" % self.output)
+        sys.stdout.flush()
+      time.sleep(poll_seconds)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="label watch mode, rebuilding a label document on changes")
+  parser.add_argument('--input', '-i', required=True,
+                      help="Input CSV file")
+  parser.add_argument('--template', '-t', required=True,
+                      help="SVG template of a single label")
+  parser.add_argument('--config', '-c', required=True,
+                      help="Label and sheet geometry ini file")
+  parser.add_argument('--output', '-o', required=True,
+                      help="Output SVG file")
+  parser.add_argument('--csv-output', default=None,
+                      help="Also write the annotated rows to this CSV file")
+  parser.add_argument('--row-cache', default=None,
+                      help="Cache file of per-row stage results, instead of an in-memory cache")
+  parser.add_argument('--render-cache', default=None,
+                      help="Cache file of rendered labels, instead of an in-memory cache")
+  parser.add_argument('--poll', type=float, default=DEFAULT_POLL_SECONDS,
+                      help="Seconds between checks for changed files")
+  parser.add_argument('scripts', nargs='+',
+                      help="Annotator scripts, in pipeline order")
+  args = parser.parse_args()
+
+  watcher = LabelWatcher(args.input, args.scripts, args.template, args.config, args.output,
+                         args.csv_output, args.row_cache, args.render_cache)
+  print("Watching %s" % ', '.join(watcher.watched_files()))
+  try:
+    watcher.run(args.poll)
+  except KeyboardInterrupt:
+    pass